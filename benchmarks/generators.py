@@ -0,0 +1,189 @@
+"""
+Synthetic data generators shaped like the FRED and QuanDL SCF/PRICES data.
+
+The scale factor multiplies the current universe (number of FRED codes and
+QuanDL tickers), so `scale=10` means ten times the codes/tickers we track today.
+"""
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+# Size of the universe in the configs today.
+FRED_UNIVERSE: int = 225
+QUANDL_UNIVERSE: int = 141
+SCALES: typing.Tuple[int, ...] = (1, 10, 100)
+
+QUANDL_EXCHANGES: typing.List[str] = ['CBOE', 'CME', 'EUREX', 'ICE', 'LIFFE', 'MGEX']
+QUANDL_START_DATE: str = '2000-01-03'
+QUANDL_END_DATE: str = '2022-03-31'
+
+# frequency -> (pandas offset, first observation, report lag in days)
+FRED_FREQUENCIES: typing.Dict[str, typing.Tuple[str, str, int]] = {
+    'daily': ('B', '2000-01-03', 1),
+    'weekly': ('W-FRI', '1985-01-04', 5),
+    'monthly': ('MS', '1970-01-01', 30),
+    'quarterly': ('QS', '1960-01-01', 60),
+}
+FRED_FREQUENCY_WEIGHTS: typing.List[float] = [0.15, 0.15, 0.5, 0.2]
+FRED_REALTIME_END: str = '2022-03-31'
+
+
+def fred_codes(scale: int = 1) -> typing.List[str]:
+    return [f'CODE{i:06d}' for i in range(FRED_UNIVERSE * scale)]
+
+
+def quandl_tickers(scale: int = 1) -> typing.List[str]:
+    tickers: typing.List[str] = []
+
+    for i in range(QUANDL_UNIVERSE * scale):
+        exchange: str = QUANDL_EXCHANGES[i % len(QUANDL_EXCHANGES)]
+        tickers.append(f'{exchange}_S{i // 9:04d}{i % 9 + 1}')
+
+    return tickers
+
+
+def generate_fred_code(code: str, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Generate the vintages of one FRED code, like `Fred.get_series_all_releases`.
+
+    Every observation gets a first release after a frequency dependent lag and
+    a share of them get one or two later revisions. Some codes are discontinued
+    or start late, so the preprocessing filters have something to drop.
+    """
+    frequency: str = rng.choice(list(FRED_FREQUENCIES), p=FRED_FREQUENCY_WEIGHTS)
+    offset, first_observation, lag = FRED_FREQUENCIES[frequency]
+
+    start = pd.Timestamp(first_observation)
+    end = pd.Timestamp(FRED_REALTIME_END)
+    roll: float = rng.random()
+    if roll < 0.05:
+        # Discontinued series.
+        end = pd.Timestamp('2015-12-31')
+    elif roll < 0.1:
+        # Series which started after `first_date`.
+        start = pd.Timestamp('2005-01-01')
+
+    dates = pd.date_range(start, end, freq=offset)
+    n_dates: int = len(dates)
+
+    # First releases, with a bit of jitter on the lag.
+    lags = lag + rng.integers(0, max(lag // 2, 1) + 1, size=n_dates)
+    values = 100 + np.cumsum(rng.normal(0, 1, size=n_dates))
+
+    # Revisions: about a third of the observations get revised, some twice.
+    revision_counts = rng.choice([0, 1, 2], p=[0.65, 0.25, 0.1], size=n_dates)
+    repeated = np.repeat(np.arange(n_dates), revision_counts + 1)
+    revision_number = np.arange(len(repeated)) - np.repeat(
+        np.cumsum(revision_counts + 1) - (revision_counts + 1),
+        revision_counts + 1,
+    )
+
+    observation_dates = dates.values[repeated]
+    realtime_start = observation_dates \
+        + (lags[repeated] + revision_number * 30).astype('timedelta64[D]')
+    revised_values = values[repeated] + rng.normal(0, 0.1, size=len(repeated)) * (revision_number > 0)
+
+    # FRED returns the value column as objects.
+    return pd.DataFrame({
+        'realtime_start': pd.to_datetime(realtime_start),
+        'date': pd.to_datetime(observation_dates),
+        'value': pd.Series(np.round(revised_values, 3), dtype='object'),
+    })
+
+
+def generate_fred_vintages(scale: int = 1, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate the long vintage frame stored as `shared/data/fred/latest/fred.pkl`.
+    """
+    rng = np.random.default_rng(seed)
+    frames: typing.List[pd.DataFrame] = []
+
+    for code in fred_codes(scale):
+        frame: pd.DataFrame = generate_fred_code(code=code, rng=rng)
+        frame['code'] = code
+        frames.append(frame)
+
+    return pd.concat(frames, axis=0)
+
+
+def generate_quandl_ticker(
+    ticker: str,
+    rng: np.random.Generator,
+    start_date: str = QUANDL_START_DATE,
+    end_date: str = QUANDL_END_DATE,
+) -> pd.DataFrame:
+    """
+    Generate the SCF/PRICES rows of one ticker, like `quandl.get_table`.
+    """
+    exchange, contract = ticker.split('_', 1)
+    symbol, depth = contract[:-1], int(contract[-1])
+    method: str = 'EN'
+
+    dates = pd.bdate_range(start_date, end_date)
+    n_dates: int = len(dates)
+
+    settle = 50 * np.exp(np.cumsum(rng.normal(0, 0.01, size=n_dates)))
+    spread = np.abs(rng.normal(0, 0.005, size=n_dates)) * settle
+    open_ = settle + rng.normal(0, 0.003, size=n_dates) * settle
+
+    return pd.DataFrame({
+        'name': f'{exchange} {symbol} futures',
+        'quandl_code': f'{ticker}_{method}',
+        'exchange': exchange,
+        'symbol': symbol,
+        'depth': depth,
+        'method': method,
+        'date': dates,
+        'open': open_,
+        'high': np.maximum(open_, settle) + spread,
+        'low': np.minimum(open_, settle) - spread,
+        'settle': settle,
+        'volume': rng.integers(0, 500_000, size=n_dates).astype('float64'),
+        'prev_day_open_interest': rng.integers(0, 2_000_000, size=n_dates).astype('float64'),
+        'front_contract': f'{symbol}H22',
+    })
+
+
+def generate_quandl_latest(scale: int = 1, seed: int = 0) -> typing.Dict[str, pd.DataFrame]:
+    """
+    Generate the `shared/data/quandl/latest/{ticker}.pkl` files, by ticker.
+    """
+    rng = np.random.default_rng(seed)
+
+    return {
+        ticker: generate_quandl_ticker(ticker=ticker, rng=rng)
+        for ticker in quandl_tickers(scale)
+    }
+
+
+def generate_quandl_daily(
+    latest: typing.Dict[str, pd.DataFrame],
+    new_days: int = 5,
+    revised_days: int = 2,
+    seed: int = 0,
+) -> typing.Dict[str, pd.DataFrame]:
+    """
+    Generate what one daily QuanDL run downloads for tickers in `latest`.
+
+    The download overlaps the latest file (that is what `drop_duplicates`
+    cleans up), revises the settle of the last few days and adds new days.
+    """
+    rng = np.random.default_rng(seed)
+    downloaded: typing.Dict[str, pd.DataFrame] = {}
+
+    for ticker, latest_df in latest.items():
+        last_date = latest_df['date'].max()
+        overlap: pd.DataFrame = latest_df.tail(20).copy()
+        overlap.iloc[-revised_days:, overlap.columns.get_loc('settle')] *= 1.001
+
+        new_rows: pd.DataFrame = generate_quandl_ticker(
+            ticker=ticker,
+            rng=rng,
+            start_date=(last_date + pd.offsets.BDay(1)).strftime('%Y-%m-%d'),
+            end_date=(last_date + pd.offsets.BDay(new_days)).strftime('%Y-%m-%d'),
+        )
+        downloaded[ticker] = pd.concat([overlap, new_rows]).reset_index(drop=True)
+
+    return downloaded
@@ -0,0 +1,86 @@
+"""
+Timing and memory measurement helpers for the benchmark suite.
+"""
+import os
+import gc
+import time
+import typing
+import shutil
+import tempfile
+import tracemalloc
+import statistics
+
+
+# The handlers read their configs from `quandlib-flows/tasks/configs/...`,
+# relative to the folder the agent runs in.
+REPO_FOLDER_NAME: str = 'quandlib-flows'
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Workspace:
+    """
+    A temporary working directory laid out like the agent's one.
+
+    The handlers write to `data/` relative to the working directory, so every
+    benchmark runs inside its own workspace and leaves the repo untouched.
+    """
+
+    def __init__(self) -> None:
+        self.path: str = tempfile.mkdtemp(prefix='quandlib-bench-')
+        self.storage_path: str = os.path.join(self.path, 'storage')
+        self.previous_cwd: typing.Optional[str] = None
+
+        os.symlink(REPO_ROOT, os.path.join(self.path, REPO_FOLDER_NAME))
+        os.makedirs(self.storage_path)
+
+    def __enter__(self) -> 'Workspace':
+        self.previous_cwd = os.getcwd()
+        os.chdir(self.path)
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        if self.previous_cwd is not None:
+            os.chdir(self.previous_cwd)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def measure(
+    run: typing.Callable[..., typing.Any],
+    setup: typing.Callable[[], typing.Tuple[typing.Any, ...]],
+    repeats: int,
+) -> typing.Dict[str, typing.Any]:
+    """
+    Time `run(*setup())` `repeats` times, then measure its memory peak once.
+
+    The memory peak is taken in a separate run because `tracemalloc` slows
+    down the allocations a lot and would distort the timings.
+    """
+    times: typing.List[float] = []
+
+    for _ in range(repeats):
+        args = setup()
+        gc.collect()
+
+        start: float = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+
+        del args
+
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del args
+
+    return {
+        'repeats': repeats,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'peak_memory_bytes': peak_memory,
+    }
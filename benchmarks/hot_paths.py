@@ -0,0 +1,193 @@
+"""
+The pipeline hot paths, wired up to run offline against synthetic data.
+
+The handlers are created without running their `__init__`, which would
+connect to Slack, and they store their blobs on the local filesystem.
+"""
+import os
+import typing
+import configparser
+
+import pandas as pd
+
+from benchmarks import generators
+from benchmarks.harness import Workspace, REPO_FOLDER_NAME
+from utils.storages import BaseStorage, LocalFileSystemStorage
+from utils.delta_log import DeltaLog
+from utils.memory import get_memory_budget
+from utils.registry import Registry
+from utils.validation import QUANDL_RAW_SCHEMA
+
+
+class OfflineSlack:
+    def send(self, message: str) -> None:
+        pass
+
+
+def read_config(file_name: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO_FOLDER_NAME, 'tasks', 'configs', file_name))
+
+    return config
+
+
+def seed_quandl_latest(storage: BaseStorage, latest: typing.Dict[str, pd.DataFrame]) -> None:
+    """
+    Write the `latest/{ticker}.pkl` snapshots into the local storage.
+    """
+    local_file: str = os.path.join('seed.pkl')
+
+    for ticker, df in latest.items():
+        df.to_pickle(local_file)
+        storage.upload_a_file(
+            source_file=local_file,
+            destination_blob=f'shared/data/quandl/latest/{ticker}.pkl',
+        )
+
+    os.remove(local_file)
+
+
+def get_quandl_delta_log(storage: BaseStorage) -> DeltaLog:
+    return DeltaLog(
+        storage=storage,
+        base_root='shared/data/quandl/latest',
+        delta_root='shared/data/quandl/deltas',
+        key_columns=QUANDL_RAW_SCHEMA.key_columns,
+    )
+
+
+class HotPath:
+    """
+    One benchmark: `prepare` generates the data once per scale,
+    `setup` returns fresh arguments for each repeat and `run` is timed.
+    """
+    name: str
+
+    def prepare(self, scale: int, workspace: Workspace) -> typing.Dict[str, typing.Any]:
+        raise NotImplementedError
+
+    def setup(self) -> typing.Tuple[typing.Any, ...]:
+        return ()
+
+    def run(self, *args: typing.Any) -> typing.Any:
+        raise NotImplementedError
+
+
+class FredPreprocessing(HotPath):
+    name = 'fred_preprocessing.process'
+
+    def prepare(self, scale: int, workspace: Workspace) -> typing.Dict[str, typing.Any]:
+        from tasks.preprocessing.fred_preprocessing import PreprocessingFredData, PreprocessingFredDataConfig
+
+        self.handler = object.__new__(PreprocessingFredData)
+        self.handler.config = PreprocessingFredDataConfig()
+        self.fred_raw_df: pd.DataFrame = generators.generate_fred_vintages(scale=scale)
+
+        return {'rows': len(self.fred_raw_df)}
+
+    def setup(self) -> typing.Tuple[typing.Any, ...]:
+        return (self.fred_raw_df.copy(),)
+
+    def run(self, fred_raw_df: pd.DataFrame) -> pd.DataFrame:
+        return self.handler._PreprocessingFredData__process(fred_raw_df)
+
+
+class QuandlLatestMerge(HotPath):
+    name = 'quandl_daily.merge_latest'
+
+    def prepare(self, scale: int, workspace: Workspace) -> typing.Dict[str, typing.Any]:
+        from tasks.data_fetching.quandl_daily import QuandlPremium
+        from utils.sharding import Shard
+
+        latest: typing.Dict[str, pd.DataFrame] = generators.generate_quandl_latest(scale=scale)
+        self.downloaded: typing.Dict[str, pd.DataFrame] = generators.generate_quandl_daily(latest)
+
+        storage = LocalFileSystemStorage(root=workspace.storage_path)
+        seed_quandl_latest(storage=storage, latest=latest)
+
+        self.handler = object.__new__(QuandlPremium)
+        self.handler.config = read_config('quandl_daily.cfg')
+        self.handler.shard = Shard()
+        self.handler.stage_name = 'quandl_daily'
+        self.handler.tickers = list(latest)
+        self.handler.storage = storage
+        self.handler.delta_log = get_quandl_delta_log(storage)
+        self.handler.registry = Registry(storage=storage)
+        self.handler.slack = OfflineSlack()
+
+        return {'rows': sum(len(df) for df in latest.values())}
+
+    def setup(self) -> typing.Tuple[typing.Any, ...]:
+        # The merge writes the local delta files, so start from a clean folder.
+        self.handler.prepare()
+
+        return (self.downloaded,)
+
+    def run(self, downloaded: typing.Dict[str, pd.DataFrame]) -> typing.Dict[str, pd.DataFrame]:
+        return self.handler.merge_batch(downloaded)
+
+
+class QuandlCombineRaw(HotPath):
+    name = 'quandl_combine_raw.load_and_concat'
+
+    def prepare(self, scale: int, workspace: Workspace) -> typing.Dict[str, typing.Any]:
+        from tasks.data_fetching.quandl_combine_raw import QuandlCombineRawTickers
+
+        latest: typing.Dict[str, pd.DataFrame] = generators.generate_quandl_latest(scale=scale)
+
+        storage = LocalFileSystemStorage(root=workspace.storage_path)
+        seed_quandl_latest(storage=storage, latest=latest)
+
+        self.handler = object.__new__(QuandlCombineRawTickers)
+        self.handler.config = read_config('quandl_combine_raw.cfg')
+        self.handler.tickers = list(latest)
+        self.handler.storage = storage
+        self.handler.delta_log = get_quandl_delta_log(storage)
+        self.handler.slack = OfflineSlack()
+        self.handler.memory_budget = get_memory_budget(self.handler.config)
+        self.handler._QuandlCombineRawTickers__pre_start()
+
+        return {'rows': sum(len(df) for df in latest.values())}
+
+    def run(self) -> pd.DataFrame:
+        # No reference to the loaded tickers is kept here, as in `combine`.
+        all_ticker_list: typing.List[pd.DataFrame] = self.handler._QuandlCombineRawTickers__load_all_tickers(
+            self.handler._QuandlCombineRawTickers__load_previous_quandl_latest(tickers=self.handler.tickers)
+        )
+
+        return self.handler._QuandlCombineRawTickers__merge_all_tickers(all_ticker_list)
+
+
+class QuandlPreprocessing(HotPath):
+    name = 'quandl_preprocessing.process'
+
+    def prepare(self, scale: int, workspace: Workspace) -> typing.Dict[str, typing.Any]:
+        from tasks.preprocessing.quandl_preprocessing import QuandlPreprocessing as Handler
+        from utils.pipeline import read_pipeline
+
+        latest: typing.Dict[str, pd.DataFrame] = generators.generate_quandl_latest(scale=scale)
+        self.quandl_raw: pd.DataFrame = pd.concat(list(latest.values()))
+
+        self.handler = object.__new__(Handler)
+        self.handler.config = read_config('quandl_preprocessing.cfg')
+        self.handler.pipeline = read_pipeline(self.handler.config)
+        self.handler.slack = OfflineSlack()
+
+        return {'rows': len(self.quandl_raw)}
+
+    def setup(self) -> typing.Tuple[typing.Any, ...]:
+        return (self.quandl_raw.copy(),)
+
+    def run(self, quandl_raw: pd.DataFrame) -> pd.DataFrame:
+        quandl_df: pd.DataFrame = self.handler.pipeline.run(quandl_raw)
+        self.handler._QuandlPreprocessing__validate(quandl_df)
+
+        return quandl_df
+
+
+HOT_PATHS: typing.List[typing.Type[HotPath]] = [
+    FredPreprocessing,
+    QuandlLatestMerge,
+    QuandlCombineRaw,
+    QuandlPreprocessing,
+]
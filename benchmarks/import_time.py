@@ -0,0 +1,97 @@
+"""
+Import time of the flow modules, measured with `python -X importtime`.
+
+Registering a flow or loading it on the agent only imports its module,
+so this is the start-up cost of every flow run. The heavy dependencies of
+the handlers must not show up here.
+"""
+import os
+import sys
+import typing
+import statistics
+import subprocess
+
+from benchmarks.harness import REPO_ROOT
+
+
+FLOW_MODULES: typing.List[str] = [
+    'flows.fred_download',
+    'flows.fred_preprocessing',
+    'flows.quandl_combine_raw',
+    'flows.quandl_daily',
+    'flows.quandl_preprocessing',
+    'flows.feature_store',
+    'flows.end_to_end',
+]
+HEAVY_MODULES: typing.List[str] = [
+    'pandas',
+    'numpy',
+    'quandl',
+    'fredapi',
+    'google.cloud.storage',
+]
+
+# `flows.base` refuses to load without these.
+FLOW_ENV: typing.Dict[str, str] = {
+    'SLACK_URL': 'http://localhost',
+    'GOOGLE_APPLICATION_CREDENTIALS': 'credentials.json',
+}
+
+CHILD_SCRIPT: str = '''
+import sys, resource
+import {module}
+print(
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    ','.join(m for m in {heavy_modules!r} if m in sys.modules),
+)
+'''
+
+
+def parse_importtime(stderr: str, module: str) -> int:
+    """
+    Return the cumulative import time of `module` in microseconds.
+    """
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        if name == module:
+            return int(cumulative)
+
+    raise Exception(f'No import time for: {module}')
+
+
+def measure_import(module: str, repeats: int) -> typing.Dict[str, typing.Any]:
+    times: typing.List[float] = []
+    peak_memory: int = 0
+    heavy_imported: typing.List[str] = []
+
+    for _ in range(repeats):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                '-X', 'importtime',
+                '-c', CHILD_SCRIPT.format(module=module, heavy_modules=HEAVY_MODULES),
+            ],
+            cwd=REPO_ROOT,
+            env={**os.environ, **FLOW_ENV},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times.append(parse_importtime(completed.stderr, module=module) / 1e6)
+
+        max_rss, _, heavy = completed.stdout.strip().split('\n')[-1].partition(' ')
+        # `ru_maxrss` is in kilobytes on Linux.
+        peak_memory = max(peak_memory, int(max_rss) * 1024)
+        heavy_imported = [m for m in heavy.split(',') if m]
+
+    return {
+        'repeats': repeats,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'peak_memory_bytes': peak_memory,
+        'heavy_modules_imported': heavy_imported,
+    }
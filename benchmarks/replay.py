@@ -0,0 +1,93 @@
+"""
+End-to-end runs of the download handlers, replayed from a recorded bundle.
+
+Record a run once, with the API keys and the bucket of a real run:
+
+    REPLAY_MODE=record REPLAY_BUNDLE=bundles/quandl_daily python -m benchmarks.replay quandl_daily
+
+then replay it offline, as often as needed:
+
+    python -m benchmarks.run --replay quandl_daily=bundles/quandl_daily --replay-latency zero
+
+The replay runs in a workspace, from a fresh copy of the recorded blobs
+each time.
+"""
+import os
+import sys
+import typing
+
+from benchmarks.harness import Workspace, measure
+
+
+def run_quandl_daily() -> None:
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+
+    QuandlPremium().run()
+
+
+def run_fred_download() -> None:
+    from tasks.data_fetching.fred_download import DownloadFredData
+
+    DownloadFredData().run()
+
+
+REPLAY_TARGETS: typing.Dict[str, typing.Callable[[], None]] = {
+    'quandl_daily': run_quandl_daily,
+    'fred_download': run_fred_download,
+}
+
+
+def measure_replay(
+    target: str,
+    bundle_path: str,
+    latency: str,
+    repeats: int,
+) -> typing.Dict[str, typing.Any]:
+    from utils.replay import get_bundle
+
+    os.environ.update({
+        'REPLAY_MODE': 'replay',
+        'REPLAY_BUNDLE': os.path.abspath(bundle_path),
+        'REPLAY_LATENCY': latency,
+    })
+
+    def setup() -> typing.Tuple[typing.Any, ...]:
+        get_bundle().reset()
+
+        return ()
+
+    try:
+        with Workspace():
+            result: typing.Dict[str, typing.Any] = measure(
+                run=REPLAY_TARGETS[target],
+                setup=setup,
+                repeats=repeats,
+            )
+    finally:
+        get_bundle().reset()
+        for name in ('REPLAY_MODE', 'REPLAY_BUNDLE', 'REPLAY_LATENCY'):
+            os.environ.pop(name, None)
+
+    result.update({'bundle': bundle_path, 'latency': latency})
+
+    return result
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    """
+    Run a target once in a workspace, e.g. to record it.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1 or argv[0] not in REPLAY_TARGETS:
+        raise SystemExit(f'usage: python -m benchmarks.replay {{{",".join(REPLAY_TARGETS)}}}')
+
+    # The workspace is another folder.
+    if os.getenv('REPLAY_BUNDLE'):
+        os.environ['REPLAY_BUNDLE'] = os.path.abspath(os.environ['REPLAY_BUNDLE'])
+
+    with Workspace():
+        REPLAY_TARGETS[argv[0]]()
+
+
+if __name__ == '__main__':
+    main()
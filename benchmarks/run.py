@@ -0,0 +1,222 @@
+"""
+Run the benchmark suite and write the results to a JSON file.
+
+    python -m benchmarks.run --scale 1 --scale 10
+    python -m benchmarks.run --bench quandl_combine_raw.load_and_concat --repeats 5
+    python -m benchmarks.run --bench import:flows.end_to_end
+    python -m benchmarks.run --replay quandl_daily=bundles/quandl_daily --replay-latency zero
+    python -m benchmarks.run compare bench_results/before.json bench_results/after.json
+
+The result files carry the versions and commit they were produced with,
+so two runs can be compared with the `compare` command.
+"""
+import os
+import sys
+import json
+import typing
+import logging
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+
+from benchmarks.generators import SCALES
+from benchmarks.harness import Workspace, measure, REPO_ROOT
+from benchmarks.hot_paths import HOT_PATHS, HotPath
+from benchmarks.import_time import FLOW_MODULES, measure_import
+from benchmarks.replay import REPLAY_TARGETS, measure_replay
+
+
+RESULTS_FOLDER: str = os.path.join(REPO_ROOT, 'bench_results')
+
+
+def get_git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=REPO_ROOT,
+            text=True,
+        ).strip()
+    except Exception:
+        return 'unknown'
+
+
+def get_metadata() -> typing.Dict[str, typing.Any]:
+    import numpy as np
+    import pandas as pd
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': get_git_revision(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run_benchmarks(
+    scales: typing.List[int],
+    names: typing.Optional[typing.List[str]],
+    repeats: int,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    results: typing.List[typing.Dict[str, typing.Any]] = []
+
+    for scale in scales:
+        for hot_path_class in HOT_PATHS:
+            hot_path: HotPath = hot_path_class()
+            if names and hot_path.name not in names:
+                continue
+
+            with Workspace() as workspace:
+                print(f'{hot_path.name} - scale {scale}x: preparing', flush=True)
+                info: typing.Dict[str, typing.Any] = hot_path.prepare(scale=scale, workspace=workspace)
+                result: typing.Dict[str, typing.Any] = measure(
+                    run=hot_path.run,
+                    setup=hot_path.setup,
+                    repeats=repeats,
+                )
+
+            result.update(info)
+            result.update({'name': hot_path.name, 'scale': scale})
+            results.append(result)
+            print(
+                f'{hot_path.name} - scale {scale}x: '
+                f'median {result["median"]:.3f}s, '
+                f'peak {result["peak_memory_bytes"] / 2 ** 20:.1f} MiB',
+                flush=True,
+            )
+
+    return results
+
+
+def run_import_benchmarks(
+    names: typing.Optional[typing.List[str]],
+    repeats: int,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    results: typing.List[typing.Dict[str, typing.Any]] = []
+
+    for module in FLOW_MODULES:
+        name: str = f'import:{module}'
+        if names and name not in names:
+            continue
+
+        result: typing.Dict[str, typing.Any] = measure_import(module=module, repeats=repeats)
+        result.update({'name': name, 'scale': 1})
+        results.append(result)
+        print(
+            f'{name}: median {result["median"]:.3f}s, '
+            f'heavy modules: {result["heavy_modules_imported"] or "none"}',
+            flush=True,
+        )
+
+    return results
+
+
+def run_replay_benchmarks(
+    replays: typing.List[str],
+    latency: str,
+    repeats: int,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    results: typing.List[typing.Dict[str, typing.Any]] = []
+
+    for replay in replays:
+        target, _, bundle_path = replay.partition('=')
+        if target not in REPLAY_TARGETS or bundle_path == '':
+            raise Exception(f'Expected {{{",".join(REPLAY_TARGETS)}}}=BUNDLE: {replay}')
+
+        name: str = f'replay:{target}'
+        print(f'{name} - latency {latency}: replaying {bundle_path}', flush=True)
+        result: typing.Dict[str, typing.Any] = measure_replay(
+            target=target,
+            bundle_path=bundle_path,
+            latency=latency,
+            repeats=repeats,
+        )
+        result.update({'name': name, 'scale': 1})
+        results.append(result)
+        print(
+            f'{name}: median {result["median"]:.3f}s, '
+            f'peak {result["peak_memory_bytes"] / 2 ** 20:.1f} MiB',
+            flush=True,
+        )
+
+    return results
+
+
+def compare(base_file: str, head_file: str) -> None:
+    with open(base_file) as f:
+        base: typing.Dict[str, typing.Any] = json.load(f)
+    with open(head_file) as f:
+        head: typing.Dict[str, typing.Any] = json.load(f)
+
+    base_results = {(r['name'], r['scale']): r for r in base['results']}
+
+    print(f'base: {base["metadata"]["git_revision"]} (pandas {base["metadata"]["pandas"]})')
+    print(f'head: {head["metadata"]["git_revision"]} (pandas {head["metadata"]["pandas"]})')
+    print(f'{"benchmark":<40} {"scale":>5} {"time":>9} {"memory":>9}')
+
+    for result in head['results']:
+        key = (result['name'], result['scale'])
+        if key not in base_results:
+            continue
+
+        time_ratio: float = result['median'] / base_results[key]['median']
+        memory_ratio: float = result['peak_memory_bytes'] / max(base_results[key]['peak_memory_bytes'], 1)
+        print(f'{result["name"]:<40} {result["scale"]:>4}x {time_ratio:>8.2f}x {memory_ratio:>8.2f}x')
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] == 'compare':
+        parser = argparse.ArgumentParser(prog='benchmarks.run compare')
+        parser.add_argument('base')
+        parser.add_argument('head')
+        args = parser.parse_args(argv[1:])
+        compare(base_file=args.base, head_file=args.head)
+        return
+
+    parser = argparse.ArgumentParser(prog='benchmarks.run')
+    parser.add_argument('--scale', type=int, action='append', choices=SCALES)
+    parser.add_argument(
+        '--bench',
+        action='append',
+        choices=[h.name for h in HOT_PATHS] + [f'import:{module}' for module in FLOW_MODULES],
+    )
+    parser.add_argument('--replay', action='append', default=[], metavar='TARGET=BUNDLE')
+    parser.add_argument('--replay-latency', default='recorded', help='recorded, zero or a factor')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args(argv)
+
+    # The handlers log every ticker and code, prefect sets its level on import.
+    import prefect  # noqa: F401
+    logging.getLogger('prefect').setLevel(logging.WARNING)
+
+    metadata: typing.Dict[str, typing.Any] = get_metadata()
+    results: typing.List[typing.Dict[str, typing.Any]] = []
+    # Only the replays when some are asked for.
+    if not args.replay or args.bench or args.scale:
+        results += run_benchmarks(
+            scales=args.scale or [1],
+            names=args.bench,
+            repeats=args.repeats,
+        )
+        results += run_import_benchmarks(names=args.bench, repeats=args.repeats)
+    results += run_replay_benchmarks(replays=args.replay, latency=args.replay_latency, repeats=args.repeats)
+
+    output: str = args.output or os.path.join(
+        RESULTS_FOLDER,
+        f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{metadata["git_revision"]}.json',
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'metadata': metadata, 'results': results}, f, indent=2)
+
+    print(f'Results: {output}')
+
+
+if __name__ == '__main__':
+    main()
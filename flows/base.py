@@ -3,12 +3,19 @@ import typing
 
 from prefect.storage import Git
 from prefect.run_configs import LocalRun
+from prefect.executors import LocalDaskExecutor
+from prefect.schedules import Schedule
+from prefect.schedules.clocks import CronClock
 
 
 SLACK_URL: typing.Optional[str] = os.getenv('SLACK_URL')
 GOOGLE_APPLICATION_CREDENTIALS: typing.Optional[str] = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 FRED_API_KEY: typing.Optional[str] = os.getenv('FRED_API_KEY')
 BUCKET_NAME: typing.Optional[str] = os.getenv('BUCKET_NAME')
+STORAGE_BACKEND: str = os.getenv('STORAGE_BACKEND', 'gcs')
+STORAGE_ROOT: str = os.getenv('STORAGE_ROOT', '')
+# The agents the tickers and FRED codes are split over.
+SHARD_COUNT: int = int(os.getenv('SHARD_COUNT', '1'))
 
 if SLACK_URL is None:
     raise Exception('SLACK_URL is not set.')
@@ -19,7 +26,7 @@ if GOOGLE_APPLICATION_CREDENTIALS is None:
 
 class BaseFlow:
     @staticmethod
-    def get_local_run() -> LocalRun:
+    def get_local_run(env: typing.Optional[typing.Dict[str, str]] = None) -> LocalRun:
         return LocalRun(
             labels=['quandl'],
             env={
@@ -27,9 +34,35 @@ class BaseFlow:
                     'SLACK_URL': SLACK_URL,
                     'GOOGLE_APPLICATION_CREDENTIALS': GOOGLE_APPLICATION_CREDENTIALS,
                     'BUCKET_NAME': BUCKET_NAME,
+                    'STORAGE_BACKEND': STORAGE_BACKEND,
+                    'STORAGE_ROOT': STORAGE_ROOT,
+                    **(env or {}),
                 }
         )
 
+    @staticmethod
+    def get_shard_schedule(cron: str, shard_count: int = SHARD_COUNT) -> Schedule:
+        '''
+        One clock by shard, whose runs get its `shard_index` and `shard_count`
+        parameters and only go to the agents labelled `quandl-shard-{index}`.
+        A single shard runs everything on the `quandl` agents.
+        '''
+        if shard_count == 1:
+            return Schedule(clocks=[CronClock(cron)])
+
+        return Schedule(clocks=[
+            CronClock(
+                cron,
+                parameter_defaults={'shard_index': index, 'shard_count': shard_count},
+                labels=[f'quandl-shard-{index}'],
+            )
+            for index in range(shard_count)
+        ])
+
+    @staticmethod
+    def get_executor(num_workers: int = 4) -> LocalDaskExecutor:
+        return LocalDaskExecutor(scheduler='threads', num_workers=num_workers)
+
     @staticmethod
     def get_storage(flow_file: str) -> Git:
         return Git(repo='bluewhale9981/quandlib-flows', flow_path=f'flows/{flow_file}')
@@ -0,0 +1,61 @@
+from prefect import Flow
+
+import sys
+from pathlib import Path  # if you haven't already done so
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError: # Already removed
+    pass
+
+
+from tasks.flow_tasks import (
+    prepare_quandl_daily,
+    fetch_quandl_batch,
+    merge_quandl_batch,
+    upload_quandl_batch,
+    compact_quandl_batch,
+    finish_quandl_daily,
+    combine_quandl_raw,
+    preprocess_quandl_raw,
+    download_fred,
+    preprocess_fred,
+    update_features,
+)
+from flows.base import BaseFlow
+
+
+# The stages hand their DataFrames to the next one in memory, the uploads to
+# Storage are side outputs, only the combine of the QuanDL raw data waits for
+# them: it records the hashes they register.
+with Flow(
+    'end_to_end',
+    run_config=BaseFlow.get_local_run(),
+    storage=BaseFlow.get_storage(flow_file='end_to_end.py'),
+    executor=BaseFlow.get_executor(),
+) as flow:
+    # QuanDL: daily -> combine raw -> preprocessing.
+    batches = prepare_quandl_daily()
+    downloaded_data = fetch_quandl_batch.map(batches)
+    merged_data = merge_quandl_batch.map(downloaded_data)
+    uploaded = upload_quandl_batch.map(merged_data)
+    compact_quandl_batch.map(uploaded)
+    finish_quandl_daily(batches, uploaded)
+
+    # After the uploads, which register the hashes of the tickers.
+    quandl_raw = combine_quandl_raw(merged_data, upstream_tasks=[uploaded])
+    quandl_processed = preprocess_quandl_raw(quandl_raw)
+    # Read from the published partitions, once they are updated.
+    update_features(upstream_tasks=[quandl_processed])
+
+    # FRED: download -> preprocessing.
+    fred_raw = download_fred()
+    preprocess_fred(fred_raw)
+
+
+if __name__ == '__main__':
+    flow.register(project_name='quandlib', labels=['quandl'])
@@ -0,0 +1,28 @@
+from prefect import Flow, Parameter
+
+import sys
+from pathlib import Path  # if you haven't already done so
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+
+from tasks.flow_tasks import update_features
+from flows.base import BaseFlow
+
+
+# Only the rows added since the last run are computed, `full` recomputes
+# everything and `verify` compares the result with a full recompute.
+with Flow(
+    'feature_store',
+    run_config=BaseFlow.get_local_run(),
+    storage=BaseFlow.get_storage(flow_file='feature_store.py'),
+) as flow:
+    full = Parameter('full', default=False)
+    verify = Parameter('verify', default=False)
+
+    update_features(full=full, verify=verify)
+
+
+if __name__ == '__main__':
+    flow.register(project_name='quandlib', labels=['quandl'])
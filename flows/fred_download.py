@@ -1,4 +1,4 @@
-from prefect import Flow
+from prefect import Flow, Parameter
 
 import sys
 from pathlib import Path  # if you haven't already done so
@@ -13,16 +13,23 @@ except ValueError: # Already removed
     pass
 
 
-from tasks.data_fetching.fred_download import run_download_fred
+from tasks.flow_tasks import run_download_fred
 from flows.base import BaseFlow
 
 
+# Every day, with `SHARD_COUNT` agents, a run of each shard downloads its
+# slice of the codes, the last shard of the day to finish merges the
+# outputs of all of them into the latest FRED data.
 with Flow(
     'fred_download',
     run_config=BaseFlow.get_local_run(),
     storage=BaseFlow.get_storage(flow_file='fred_download.py'),
+    schedule=BaseFlow.get_shard_schedule('0 22 * * *'),
 ) as flow:
-    run_download_fred()
+    shard_index = Parameter('shard_index', default=None)
+    shard_count = Parameter('shard_count', default=None)
+
+    run_download_fred(shard_index=shard_index, shard_count=shard_count)
 
 
 if __name__ == '__main__':
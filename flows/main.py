@@ -21,8 +21,7 @@ except ValueError: # Already removed
     pass
 
 
-from tasks.data_fetching.fred_download import run_download_fred
-from tasks.preprocessing.fred_preprocessing import run_preprocess_fred
+from tasks.flow_tasks import run_download_fred, run_preprocess_fred
 
 
 SLACK_URL: typing.Optional[str] = os.getenv('SLACK_URL')
@@ -40,6 +39,8 @@ base_env = {
     'FRED_API_KEY': FRED_API_KEY,
     'SLACK_URL': SLACK_URL,
     'GOOGLE_APPLICATION_CREDENTIALS': GOOGLE_APPLICATION_CREDENTIALS,
+    'STORAGE_BACKEND': os.getenv('STORAGE_BACKEND', 'gcs'),
+    'STORAGE_ROOT': os.getenv('STORAGE_ROOT', ''),
 }
 
 with Flow(
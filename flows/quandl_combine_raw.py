@@ -13,7 +13,7 @@ except ValueError: # Already removed
     pass
 
 
-from tasks.data_fetching.quandl_combine_raw import run_quandl_combine_raw
+from tasks.flow_tasks import run_quandl_combine_raw
 from flows.base import BaseFlow
 
 
@@ -0,0 +1,51 @@
+from prefect import Flow, Parameter
+
+import sys
+from pathlib import Path # if you haven't already done so
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError: # Already removed
+    pass
+
+
+from tasks.flow_tasks import (
+    prepare_quandl_daily,
+    fetch_quandl_batch,
+    merge_quandl_batch,
+    upload_quandl_batch,
+    compact_quandl_batch,
+    finish_quandl_daily,
+)
+from flows.base import BaseFlow
+
+
+# Every hour, only the tickers whose exchange published a new session are
+# fetched (see `tasks/configs/exchanges.cfg`), the other runs do nothing.
+# With `SHARD_COUNT` agents, each one fetches its slice of the tickers.
+with Flow(
+    'quandl_daily',
+    run_config=BaseFlow.get_local_run(),
+    storage=BaseFlow.get_storage(flow_file='quandl_daily.py'),
+    executor=BaseFlow.get_executor(),
+    schedule=BaseFlow.get_shard_schedule('15 * * * *'),
+) as flow:
+    tickers = Parameter('tickers', default=None)
+    force = Parameter('force', default=False)
+    shard_index = Parameter('shard_index', default=None)
+    shard_count = Parameter('shard_count', default=None)
+
+    batches = prepare_quandl_daily(tickers=tickers, force=force, shard_index=shard_index, shard_count=shard_count)
+    downloaded_data = fetch_quandl_batch.map(batches)
+    merged_data = merge_quandl_batch.map(downloaded_data)
+    uploaded = upload_quandl_batch.map(merged_data)
+    compact_quandl_batch.map(uploaded)
+    finish_quandl_daily(batches, uploaded, shard_index=shard_index, shard_count=shard_count)
+
+
+if __name__ == '__main__':
+    flow.register(project_name='quandlib', labels=['quandl'])
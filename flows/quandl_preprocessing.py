@@ -7,7 +7,7 @@ parent, root = file.parent, file.parents[1]
 sys.path.append(str(root))
 
 
-from tasks.preprocessing.quandl_preprocessing import run_quandl_preprocessing
+from tasks.flow_tasks import run_quandl_preprocessing
 from flows.base import BaseFlow
 
 
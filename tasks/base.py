@@ -2,7 +2,8 @@ import os
 import typing
 import configparser
 import shutil
-from datetime import datetime
+
+from utils.replay import get_current_time
 
 
 class BaseConfiguration:
@@ -39,7 +40,7 @@ class BaseHandler:
         try:
             today = self.config['default']['end_date']
         except:
-            today = datetime.now().strftime(output_format)
+            today = get_current_time().strftime(output_format)
 
         return today
 
@@ -51,9 +52,9 @@ class BaseHandler:
         return default
 
     @staticmethod
-    def remove_previous() -> None:
-        if os.path.isdir('data'):
-            shutil.rmtree('data')
+    def remove_previous(folder_path: str = 'data') -> None:
+        if os.path.isdir(folder_path):
+            shutil.rmtree(folder_path)
 
     @staticmethod
     def create_folder(folder_path: str) -> None:
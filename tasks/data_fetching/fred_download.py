@@ -4,18 +4,25 @@ This is the script to fetch data from FRED to local machine.
 from __future__ import absolute_import
 
 import os
-import time
 import typing
 import configparser
 
 import prefect
-from prefect import task
 import pandas as pd
 from fredapi import Fred  # type: ignore
 
 from tasks.base import BaseHandler
-from utils.storages import GoogleCloudStorage
+from utils.storages import get_storage
+from utils.archives import ContentAddressedArchive
+from utils.arrow_io import IpcAppendStore
+from utils.datasets import archive_partitions, load_dataset
+from utils.memory import MemoryBudget, get_memory_budget
+from utils.rate_limiter import RateLimiter, get_rate_limiter
+from utils.registry import Registry, get_frame_state, get_now
+from utils.replay import get_replay_mode, wrap_api
+from utils.sharding import Shard, ShardReports, get_shard
 from utils.slackbot import Slack
+from utils.validation import FRED_INFO_SCHEMA, FRED_RAW_SCHEMA, QualityReport, Schema, validate
 
 
 logger = prefect.context.get('logger')
@@ -25,7 +32,7 @@ class DownloadFredData(BaseHandler):
     exceed_point_number_message: str = 'This exceeds the maximum number of vintage dates allowed'
     earliest_realtime_start = '2000-01-01'
 
-    def __init__(self) -> None:
+    def __init__(self, shard: typing.Optional[Shard] = None) -> None:
         logger.info('Init fred_download_data script')
         # Set config file path.
         self.config_file: str = 'quandlib-flows/tasks/configs/fred_download.cfg'
@@ -34,19 +41,49 @@ class DownloadFredData(BaseHandler):
         # Get the Fred API key from the environment
         self.api_key: typing.Optional[str] = os.getenv('FRED_API_KEY', default=None)
 
-        assert self.api_key is not None
+        # A replay answers from its bundle, without a key.
+        assert self.api_key is not None or get_replay_mode() == 'replay'
 
         # Initialize fred instance
-        self.fred: Fred = Fred(api_key=self.api_key)
+        self.fred: Fred = wrap_api('fred', lambda: Fred(api_key=self.api_key))
+        # Shared with the other flows calling FRED on this host.
+        self.rate_limiter: RateLimiter = get_rate_limiter('fred')
 
         # Create storage.
-        self.storage = GoogleCloudStorage(bucket_name=self.config['storage']['bucket_name'])
+        self.storage = get_storage(
+            bucket_name=self.config['storage']['bucket_name'],
+            config=self.config['storage'],
+        )
+        self.archive = ContentAddressedArchive(
+            storage=self.storage,
+            root='shared/data/fred/archives',
+            writer='fred_download',
+        )
+        self.registry = Registry(storage=self.storage)
+        self.memory_budget: MemoryBudget = get_memory_budget(self.config)
 
         # Create Slack instace to send messages.
         self.slack = Slack(title='FRED download')
 
-        self.fred_codes: typing.List[str] = self.config['fred']['fred_codes'].split('\n')
-
+        # All the codes, in the order of the output, and the ones of the shard.
+        self.all_fred_codes: typing.List[str] = self.config['fred']['fred_codes'].split('\n')
+        self.shard: Shard = shard or get_shard()
+        self.fred_codes: typing.List[str] = self.shard.select(self.all_fred_codes)
+
+        # The shards of the same scheduled run are merged together.
+        scheduled_start_time: typing.Any = prefect.context.get('scheduled_start_time')
+        self.refresh: str = os.getenv('SHARD_REFRESH', '') \
+            or (scheduled_start_time.strftime('%Y-%m-%d') if scheduled_start_time else self.get_today())
+        self.shard_reports = ShardReports(registry=self.registry, job='fred_download', refresh=self.refresh)
+
+        # The checkpoints of a run are tied by its id, the Prefect flow run by default.
+        self.run_id: str = os.getenv('FRED_RUN_ID', '') \
+            or prefect.context.get('flow_run_id') \
+            or self.get_today()
+        self.resume: bool = os.getenv('FRED_RESUME', '').lower() in ('1', 'true') \
+            or self.config.getboolean('fred', 'resume', fallback=False)
+        self.checkpoint_path: str = os.path.join('data', 'fred', 'checkpoints', self.run_id)
+        self.checkpoint_blob_prefix: str = f'shared/data/fred/checkpoints/{self.run_id}/'
 
     def __prestart(self) -> None:
         self.config: configparser.ConfigParser = self.get_config()
@@ -55,6 +92,56 @@ class DownloadFredData(BaseHandler):
         if not os.path.isdir(data_path):
             self.create_folder(data_path)
 
+    def __prepare_checkpoints(self) -> None:
+        '''
+        Drop the local checkpoints of other runs, they are stale.
+        '''
+        checkpoints_path: str = os.path.join('data', 'fred', 'checkpoints')
+        self.create_folder(self.checkpoint_path)
+
+        for run_id in os.listdir(checkpoints_path):
+            if run_id != self.run_id:
+                self.remove_previous(os.path.join(checkpoints_path, run_id))
+
+    def __save_checkpoint(self, code: str, data: pd.DataFrame) -> None:
+        local_file: str = os.path.join(self.checkpoint_path, f'{code}.pkl')
+        data.to_pickle(local_file)
+
+        self.storage.upload_a_file(
+            source_file=local_file,
+            destination_blob=f'{self.checkpoint_blob_prefix}{code}.pkl',
+        )
+
+    def __list_checkpoints(self) -> typing.Set[str]:
+        '''
+        The codes completed by this run so far, on Storage in case the run
+        moved to another machine.
+        '''
+        checkpoint_codes: typing.Set[str] = set(
+            blob[len(self.checkpoint_blob_prefix):-len('.pkl')]
+            for blob in self.storage.list_files(self.checkpoint_blob_prefix)
+        ) & set(self.fred_codes)
+
+        logger.info(f'Resume run {self.run_id}: {len(checkpoint_codes)} codes from checkpoints')
+
+        return checkpoint_codes
+
+    def __load_checkpoint(self, code: str) -> pd.DataFrame:
+        local_file: str = os.path.join(self.checkpoint_path, f'{code}.pkl')
+        if not os.path.isfile(local_file):
+            self.storage.download_a_file(
+                source_blob_name=f'{self.checkpoint_blob_prefix}{code}.pkl',
+                destination_file_name=local_file,
+            )
+
+        return pd.read_pickle(local_file)
+
+    def __remove_checkpoints(self) -> None:
+        for blob in self.storage.list_files(self.checkpoint_blob_prefix):
+            self.storage.delete_a_file(blob)
+
+        self.remove_previous(self.checkpoint_path)
+
     def __download_all_fred_info(self) -> pd.DataFrame:
         """
         This is a private method for getting code info using fred instance.
@@ -66,7 +153,8 @@ class DownloadFredData(BaseHandler):
         for code in self.fred_codes:
             logger.info(f'Getting fred code Info: {code}')
             try:
-                code_info: typing.Optional[pd.Series[typing.Any]] = self.fred.get_series_info(code)  # type: ignore
+                with self.rate_limiter.limit():
+                    code_info: typing.Optional[pd.Series[typing.Any]] = self.fred.get_series_info(code)  # type: ignore
                 if code_info is not None:
                     code_info_list.append(code_info)
             except Exception as ex:
@@ -74,9 +162,6 @@ class DownloadFredData(BaseHandler):
                 bad_codes.append(code)
                 logger.info(f'Code is failed to fetch: {code}')
 
-            # Wait a bit for the next iteration.
-            time.sleep(1)
-
         logger.info(f'Unable to download: {bad_codes}')
 
         # Convert the data to dataframe.
@@ -84,42 +169,125 @@ class DownloadFredData(BaseHandler):
 
         return df_code_info
 
-    def __download_all_fred_codes(self) -> pd.DataFrame:
+    @staticmethod
+    def __get_last_updated(fred_info_df: pd.DataFrame) -> typing.Dict[str, str]:
+        return {
+            code: str(last_updated)
+            for code, last_updated in zip(fred_info_df['id'], fred_info_df['last_updated'])
+            if pd.notna(last_updated)
+        }
+
+    def __append_unchanged_codes(self, store: IpcAppendStore, last_updated: typing.Dict[str, str]) -> None:
+        """
+        Append the codes not updated by FRED since they were downloaded, from
+        their archived partitions instead of the API.
+        """
+        unchanged_codes: typing.List[str] = [
+            code for code in self.fred_codes
+            if self.registry.is_unchanged('fred', code, field='source_updated', value=last_updated.get(code))
+        ]
+        if not unchanged_codes:
+            return
+
+        try:
+            fred_df: pd.DataFrame = load_dataset(name='fred', tickers=unchanged_codes, storage=self.storage)
+        except Exception as ex:
+            logger.error(ex)
+            return
+
+        for code, df in fred_df.groupby('code', sort=False):
+            self.__append(store=store, code=code, data=df)
+
+        logger.info(f'Unchanged codes: {fred_df["code"].nunique()}')
+
+    def __register_codes(self, fred_df: pd.DataFrame, last_updated: typing.Dict[str, str]) -> None:
+        fetched_at: str = get_now()
+
+        self.registry.update('fred', {
+            code: {**get_frame_state(df), 'source_updated': last_updated.get(code), 'fetched_at': fetched_at}
+            for code, df in fred_df.groupby('code', sort=False)
+        })
+
+    @staticmethod
+    def __get_store_schema() -> typing.Any:
+        import pyarrow as pa
+
+        return pa.schema([
+            ('realtime_start', pa.timestamp('ns')),
+            ('date', pa.timestamp('ns')),
+            ('value', pa.float64()),
+            ('code', pa.string()),
+        ])
+
+    @staticmethod
+    def __append(store: IpcAppendStore, code: str, data: pd.DataFrame) -> None:
+        # FRED sends the values as float objects (NaN for '.'), the store
+        # column holds them as float64, anything else is an error.
+        store.append(key=code, df=data.assign(value=pd.to_numeric(data['value'])))
+
+    def __download_all_fred_codes(self, last_updated: typing.Dict[str, str]) -> pd.DataFrame:
         """
         This is a private method to download the fred codes.
+
+        Each code is appended to a store on disk as it arrives and the
+        codes are only read back together at the end, in the order of the
+        config, so only one copy of the data is ever in memory.
         """
-        all_codes: pd.DataFrame
-        data_series: typing.Dict[str, pd.DataFrame] = {}
         failed_codes: typing.Set[str] = set()
+        checkpoint_codes: typing.Set[str] = set()
         i = 0
 
-        for code in self.fred_codes:
-            data = self.__download_fred_code(code=code)
-            if data is not None:
-                data_series[code] = data
-            else:
-                failed_codes.add(code)
+        self.__prepare_checkpoints()
+        if self.resume:
+            checkpoint_codes = self.__list_checkpoints()
 
-            # logger about the progress.
-            i = i + 1
-            if i % 10 == 0:
-                logger.info(f'fred code downloaded: {i}')
+        store = IpcAppendStore(
+            path=os.path.join(self.checkpoint_path, 'fred.arrow'),
+            schema=self.__get_store_schema(),
+        )
+        with store:
+            self.__append_unchanged_codes(store=store, last_updated=last_updated)
+
+            for code in self.fred_codes:
+                if code in store:
+                    continue
+
+                if code in checkpoint_codes:
+                    self.__append(store=store, code=code, data=self.__load_checkpoint(code=code))
+                    continue
+
+                data = self.__download_fred_code(code=code)
+                if data is not None:
+                    data = data.assign(code=code)
+                    self.__save_checkpoint(code=code, data=data)
+                    self.__append(store=store, code=code, data=data)
+                else:
+                    failed_codes.add(code)
+
+                # logger about the progress.
+                i = i + 1
+                if i % 10 == 0:
+                    logger.info(f'fred code downloaded: {i}')
 
         logger.info(f"{str(len(failed_codes))} codes failed to download data")
         logger.info(failed_codes)
 
-        for k, v in data_series.items():
-            v.loc[:, "code"] = k
-        all_codes = pd.concat(list(data_series.values()), axis=0)
+        # The uncompressed store is about the size of the frame read from it.
+        spill_folder: typing.Optional[str] = self.memory_budget.get_spill_folder(
+            size=os.path.getsize(store.path),
+            folder=os.path.join('data', 'fred', 'spill'),
+        )
 
-        return all_codes
+        # The raw data keeps the objects of the API, the preprocessing makes them numbers.
+        return store.read(keys=self.fred_codes, spill_folder=spill_folder, dtypes={'value': object})
 
     def __download_fred_code(self, code: str) -> typing.Optional[pd.DataFrame]:
         data: typing.Optional[pd.DataFrame] = None
 
         logger.info(f"Getting FRED code Data: {code}")
         try:
-            data = self.fred.get_series_all_releases(code, realtime_start=self.earliest_realtime_start)
+            with self.rate_limiter.limit():
+                data = self.fred.get_series_all_releases(code, realtime_start=self.earliest_realtime_start)
         except Exception as ex:
             logger.error(f"Failed to download data: {code}")
             logger.error(ex)
@@ -139,8 +307,10 @@ class DownloadFredData(BaseHandler):
         data: typing.Optional[pd.DataFrame] = None
 
         try:
-            part_one: pd.DataFrame = self.fred.get_series_all_releases(code, realtime_end=break_point)
-            part_two: pd.DataFrame = self.fred.get_series_all_releases(code, realtime_start=break_point)
+            with self.rate_limiter.limit():
+                part_one: pd.DataFrame = self.fred.get_series_all_releases(code, realtime_end=break_point)
+            with self.rate_limiter.limit():
+                part_two: pd.DataFrame = self.fred.get_series_all_releases(code, realtime_start=break_point)
             data = pd.concat([part_one, part_two])
 
             logger.info(f'{code}: Getting by multipart OK!')
@@ -150,47 +320,10 @@ class DownloadFredData(BaseHandler):
 
         return data
 
-    @staticmethod
-    def __validate_fred_data(df: pd.DataFrame) -> None:
-        # It should have 4 columns.
-        assert list(df.columns).sort() == [  # type: ignore
-            'realtime_start', 'date', 'value', 'code'
-        ].sort()
-
-        # Check type of each columns
-        assert str(df.dtypes.realtime_start) == 'datetime64[ns]'  # type: ignore
-        assert str(df.dtypes.date) == 'datetime64[ns]'  # type: ignore
-        assert str(df.dtypes.value) == 'object'  # type: ignore
-        assert str(df.dtypes.code) == 'object'  # type: ignore
-
-    @staticmethod
-    def __validate_fred_info_data(df: pd.DataFrame) -> None:
-        """
-        Validate file `data/fred/download/fred_data_info.pkl`
-        """
-        required_columns = [
-            'id',
-            'realtime_start',
-            'realtime_end',
-            'title',
-            'observation_start',
-            'observation_end',
-            'frequency',
-            'frequency_short',
-            'units',
-            'units_short',
-            'seasonal_adjustment',
-            'seasonal_adjustment_short',
-            'last_updated',
-            'popularity',
-            'notes',
-        ]
-        # Validate columns
-        assert list(df.columns).sort() == required_columns.sort()  # type: ignore
-
-        # Validate type of each columns
-        for column in required_columns:
-            assert str(df.dtypes[column]) == 'object'  # type: ignore
+    def __validate(self, df: pd.DataFrame, schema: Schema) -> None:
+        report: QualityReport = validate(df=df, schema=schema)
+        logger.info(report.summary())
+        report.raise_for_errors()
 
     def __upload_fred_data(self, df: pd.DataFrame) -> None:
         self.__upload(file_name='fred.pkl', df=df)
@@ -204,7 +337,6 @@ class DownloadFredData(BaseHandler):
             f'{file_name}',
         )
         latest_blob_file: str = f'shared/data/fred/latest/{file_name}'
-        archive_blob_file: str = f'shared/data/fred/archives/{self.get_today}/{file_name}'
 
         # Save file to local first.
         df.to_pickle(local_file)
@@ -215,33 +347,126 @@ class DownloadFredData(BaseHandler):
             destination_blob=latest_blob_file,
         )
 
-        # Upload one for archive.
+        # Archive it, the content is only stored once.
+        self.archive.add(local_file=local_file, name=file_name)
+
+    def __get_shard_blob(self, shard: Shard, file_name: str) -> str:
+        return f'shared/data/fred/shards/{self.refresh}/{shard.name}/{file_name}'
+
+    def __upload_shard(self, file_name: str, df: pd.DataFrame) -> None:
+        local_file: str = os.path.join('data', 'fred', 'shards', f'{self.shard.name}.{file_name}')
+        self.create_folder(os.path.dirname(local_file))
+        df.to_pickle(local_file)
+
         self.storage.upload_a_file(
             source_file=local_file,
-            destination_blob=archive_blob_file,
+            destination_blob=self.__get_shard_blob(shard=self.shard, file_name=file_name),
         )
 
-    def run(self) -> None:
+    def __load_shards(self, file_name: str, code_column: str) -> pd.DataFrame:
         """
-        The main method to run.
+        The outputs of all the shards, back in the order of the config.
         """
-        logger.info('Start running the Fred download.')
-        self.slack.send(f'Start with: {len(self.fred_codes)} codes')
+        frames: typing.List[pd.DataFrame] = []
+        for index in range(self.shard.count):
+            shard: Shard = Shard(index=index, count=self.shard.count)
+            local_file: str = os.path.join('data', 'fred', 'shards', f'{shard.name}.{file_name}')
+            self.storage.download_a_file(
+                source_blob_name=self.__get_shard_blob(shard=shard, file_name=file_name),
+                destination_file_name=local_file,
+            )
+            frames.append(pd.read_pickle(local_file))
+
+        df: pd.DataFrame = pd.concat(frames, ignore_index=True)
+        positions: pd.Series = df[code_column].map({code: i for i, code in enumerate(self.all_fred_codes)})
+
+        return df.iloc[positions.to_numpy().argsort(kind='stable')].reset_index(drop=True)
+
+    def __remove_previous_shards(self) -> None:
+        # A later refresh may already be running, only the older ones go.
+        shards_prefix: str = 'shared/data/fred/shards/'
+
+        for blob in self.storage.list_files(shards_prefix):
+            if blob[len(shards_prefix):].split('/', 1)[0] < self.refresh:
+                self.storage.delete_a_file(blob)
+
+    def __archive_partitions(self, df: pd.DataFrame) -> None:
+        archive_partitions(
+            archive=self.archive,
+            dataset_name='fred',
+            df=df,
+            local_folder=os.path.join('data', 'fred', 'partitions'),
+        )
+
+    def merge_shards(self) -> typing.Optional[pd.DataFrame]:
+        """
+        Merge the outputs of the shards of the refresh into the latest FRED
+        data, once all of them reported, return it. Two shards finishing
+        together may both merge, to the same output.
+        """
+        if self.shard_reports.get_outputs(count=self.shard.count) is None:
+            logger.info(f'Waiting for the other shards of {self.refresh} to report.')
+            return None
+
+        with self.memory_budget.stage('merge'):
+            fred_df: pd.DataFrame = self.__load_shards(file_name='fred.pkl', code_column='code')
+            fred_info_df: pd.DataFrame = self.__load_shards(file_name='fred_info.pkl', code_column='id')
+        self.__validate(df=fred_df, schema=FRED_RAW_SCHEMA)
 
-        # Download FRED data.
-        fred_df: pd.DataFrame = self.__download_all_fred_codes()
-        self.__validate_fred_data(df=fred_df)
         self.__upload_fred_data(df=fred_df)
+        self.__archive_partitions(df=fred_df)
+        self.__upload_fred_info_data(df=fred_info_df)
+        self.archive.commit(day=self.get_today())
+        self.__remove_previous_shards()
+        self.shard_reports.prune()
 
-        # Download FRED info data.
-        fred_info_df: pd.DataFrame = self.__download_all_fred_info()
-        self.__validate_fred_info_data(df=fred_info_df)
-        self.__upload_fred_info_data(df=fred_df)
+        self.slack.send(f'Merged {self.shard.count} shards of {self.refresh}: {fred_df["code"].nunique()} codes')
 
-        self.slack.send(f'Task finished!')
+        return fred_df
 
+    def run(self) -> pd.DataFrame:
+        """
+        The main method to run, returns the downloaded FRED data, only the
+        codes of the shard when sharded.
+        """
+        logger.info('Start running the Fred download.')
+        self.slack.send(f'Start with: {len(self.fred_codes)} codes - Shard: {self.shard.name}')
+
+        # Download FRED info data first, its last update tells which codes changed.
+        fred_info_df: pd.DataFrame = self.__download_all_fred_info()
+        self.__validate(df=fred_info_df, schema=FRED_INFO_SCHEMA)
+        last_updated: typing.Dict[str, str] = self.__get_last_updated(fred_info_df)
+
+        # Download FRED data.
+        with self.memory_budget.stage('download'):
+            fred_df: pd.DataFrame = self.__download_all_fred_codes(last_updated=last_updated)
+        self.__validate(df=fred_df, schema=FRED_RAW_SCHEMA)
+        with self.memory_budget.stage('upload'):
+            if self.shard.is_sharded():
+                self.__upload_shard(file_name='fred.pkl', df=fred_df)
+            else:
+                self.__upload_fred_data(df=fred_df)
+
+        if self.shard.is_sharded():
+            self.__upload_shard(file_name='fred_info.pkl', df=fred_info_df)
+        else:
+            # The partitions index lists all the codes, the merge archives it when sharded.
+            self.__archive_partitions(df=fred_df)
+            self.__upload_fred_info_data(df=fred_info_df)
+        self.archive.commit(day=self.get_today())
+        self.__register_codes(fred_df=fred_df, last_updated=last_updated)
+
+        # The run is complete, its checkpoints are not needed anymore.
+        self.__remove_checkpoints()
+
+        if self.shard.is_sharded():
+            self.shard_reports.report(self.shard, {'codes': int(fred_df['code'].nunique()), 'rows': len(fred_df)})
+            # The last shard to report merges the outputs of all of them.
+            self.merge_shards()
+
+        self.slack.send(
+            message=f'Task finished! {self.storage.get_transfer_report()} - '
+                    f'Memory: {self.memory_budget.get_report()}'
+        )
 
-@task
-def run_download_fred():
-    fred = DownloadFredData()
-    fred.run()
+        return fred_df
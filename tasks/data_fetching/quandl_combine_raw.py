@@ -6,14 +6,21 @@ from __future__ import absolute_import
 import os
 import typing
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 import prefect
-from prefect import task
 import pandas as pd
 
 from tasks.base import BaseHandler
-from utils.storages import GoogleCloudStorage
+from utils.storages import get_storage
+from utils.archives import ContentAddressedArchive
+from utils.arrow_io import get_intermediate_format, write_ipc
+from utils.delta_log import DeltaLog
+from utils.frames import concat_frames
+from utils.memory import MemoryBudget, get_memory_budget
+from utils.registry import Registry, get_frame_hash, get_now
 from utils.slackbot import Slack
+from utils.validation import QUANDL_RAW_SCHEMA, QualityReport, validate
 
 
 logger = prefect.context.get('logger')
@@ -32,7 +39,25 @@ class QuandlCombineRawTickers(BaseHandler):
         self.tickers: typing.List[str] = self.config['quandl']['tickers'].split('\n')
 
         # Create storage.
-        self.storage = GoogleCloudStorage(bucket_name=os.getenv('BUCKET_NAME'))
+        self.storage = get_storage(
+            bucket_name=os.getenv('BUCKET_NAME'),
+            config=self.get_config_key(self.config, 'storage', None),
+        )
+        self.archive = ContentAddressedArchive(
+            storage=self.storage,
+            root='shared/data/quandl/archives',
+            writer='quandl_combine_raw',
+        )
+        self.delta_log = DeltaLog(
+            storage=self.storage,
+            base_root='shared/data/quandl/latest',
+            delta_root='shared/data/quandl/deltas',
+            key_columns=QUANDL_RAW_SCHEMA.key_columns,
+        )
+        self.registry = Registry(storage=self.storage)
+
+        self.intermediate_format: str = get_intermediate_format(self.get_config_key(self.config, 'storage', None))
+        self.memory_budget: MemoryBudget = get_memory_budget(self.config)
 
         # Create Slack instace to send messages.
         self.slack = Slack(title='QuanDL combine raw tickers')
@@ -40,65 +65,108 @@ class QuandlCombineRawTickers(BaseHandler):
         self.__pre_start()
 
     def __pre_start(self) -> None:
-        self.remove_previous()
-
         self.create_folder(os.path.join('data'))
         self.create_folder(os.path.join('data', 'quandl'))
-        self.create_folder(os.path.join('data', 'quandl', 'latest'))
 
-        self.__download_previous_quandl_latest()
-
-    def __download_previous_quandl_latest(self) -> None:
-        ticker: str
-
-        for ticker in self.tickers:
-            logger.info(f'Download ticker: {ticker}')
-
-            latest_ticker_blob = f'shared/data/quandl/latest/{ticker}.pkl'
-            latest_ticker_local_path = os.path.join(
-                'data',
-                'quandl',
-                'latest',
-                f'{ticker}.pkl',
+    def __load_previous_quandl_latest(self, tickers: typing.List[str]) -> typing.Dict[str, pd.DataFrame]:
+        '''
+        Load the latest data of the tickers, their snapshot merged with the
+        delta segments appended since. The downloads wait on the network,
+        so the tickers are loaded by a pool of threads.
+        '''
+        workers: int = self.config.getint('quandl', 'load_workers', fallback=8)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded: typing.Dict[str, typing.Optional[pd.DataFrame]] = dict(
+                zip(tickers, executor.map(self.__load_previous_quandl_ticker, tickers))
             )
-            if self.storage.is_file_exists(latest_ticker_blob):
-                self.storage.download_a_file(
-                    source_blob_name=latest_ticker_blob,
-                    destination_file_name=latest_ticker_local_path,
-                )
 
-    def __load_all_tickers(self) -> typing.List[pd.DataFrame]:
+        return {ticker: df for ticker, df in loaded.items() if df is not None}
+
+    def __load_previous_quandl_ticker(self, ticker: str) -> typing.Optional[pd.DataFrame]:
+        logger.info(f'Download ticker: {ticker}')
+
+        try:
+            return self.delta_log.load(ticker)
+        except Exception as ex:
+            logger.error(ex)
+            return None
+
+    def __get_unchanged_tickers(self, hashes: typing.Dict[str, str]) -> typing.List[str]:
+        '''
+        Return the tickers with the same latest data as in the last raw data.
+        '''
+        combined: typing.Dict[str, typing.Any] = self.registry.get('stages', 'quandl_combine_raw') or {}
+        combined_hashes: typing.Dict[str, str] = combined.get('items', {})
+
+        return [
+            ticker for ticker in self.tickers
+            if ticker in hashes and combined_hashes.get(ticker) == hashes[ticker]
+        ]
+
+    def __load_previous_raw_tickers(self, tickers: typing.List[str]) -> typing.Dict[str, pd.DataFrame]:
+        '''
+        Load the tickers from the last raw data, one download for all of them.
+        '''
+        quandl_raw_path: str = os.path.join('data', 'quandl', 'previous_raw.pickle')
+
+        try:
+            self.storage.download_a_file(
+                source_blob_name='shared/data/quandl/raw.pickle',
+                destination_file_name=quandl_raw_path,
+            )
+            quandl_raw: pd.DataFrame = pd.read_pickle(quandl_raw_path)
+        except Exception as ex:
+            logger.error(ex)
+            return {}
+        finally:
+            if os.path.isfile(quandl_raw_path):
+                os.remove(quandl_raw_path)
+
+        # The QuanDL code is the ticker and the splice method.
+        raw_tickers: pd.Series = quandl_raw['quandl_code'].str.rsplit('_', n=1).str[0]
+
+        return {
+            ticker: df.reset_index(drop=True)
+            for ticker, df in quandl_raw.groupby(raw_tickers, sort=False)
+            if ticker in tickers
+        }
+
+    def __load_all_tickers(
+        self,
+        latest_data: typing.Optional[typing.Dict[str, pd.DataFrame]] = None,
+    ) -> typing.List[pd.DataFrame]:
         all_ticker_list: typing.List[pd.DataFrame] = []
         ticker: str
 
         for ticker in self.tickers:
-            try:
-                latest_ticker_file: str = os.path.join(
-                    'data',
-                    'quandl',
-                    'latest',
-                    f'{ticker}.pkl',
-                )
-                latest_ticker_df: pd.DataFrame = pd.read_pickle(latest_ticker_file)
-                all_ticker_list.append(latest_ticker_df)
-            except Exception as ex:
-                logger.error(ex)
-                self.slack.send(message=f'Unable to load ticker: {ticker}')
+            if latest_data is not None and ticker in latest_data:
+                all_ticker_list.append(latest_data[ticker])
+                continue
+
+            logger.error(f'No latest data for ticker: {ticker}')
+            self.slack.send(message=f'Unable to load ticker: {ticker}')
 
         return all_ticker_list
 
     def __merge_all_tickers(self, all_ticker_list: typing.List[pd.DataFrame]) -> pd.DataFrame:
-        return pd.concat(all_ticker_list)
+        # The strings are shared with the tickers, only their pointers are copied.
+        size: int = sum(int(df.memory_usage(index=True, deep=False).sum()) for df in all_ticker_list)
+        spill_folder: typing.Optional[str] = self.memory_budget.get_spill_folder(
+            size=size,
+            folder=os.path.join('data', 'quandl', 'spill'),
+        )
+
+        # The list is emptied as the tickers are copied.
+        return concat_frames(all_ticker_list, spill_folder=spill_folder)
 
     def __upload_raw_quandl(self, all_tickers_df: pd.DataFrame) -> None:
-        today = self.get_today()
         local_path: str = os.path.join(
             'data',
             'quandl',
             'quandl_raw.pickle',
         )
         latest_blob: str = 'shared/data/quandl/raw.pickle'
-        historical_blob: str = f'shared/data/quandl/archives/{today}/raw.pickle'
 
         logger.info(f'Upload ticker - shape: {all_tickers_df.shape}')
 
@@ -107,27 +175,70 @@ class QuandlCombineRawTickers(BaseHandler):
 
         # Upload to cloud
         self.storage.upload_a_file(source_file=local_path, destination_blob=latest_blob)
-        self.storage.upload_a_file(source_file=local_path, destination_blob=historical_blob)
-
-    def run(self) -> None:
+        self.archive.add(local_file=local_path, name='raw.pickle')
+        self.archive.commit(day=self.get_today())
+
+        # As uncompressed Arrow IPC too, for the readers which memory-map it.
+        if self.intermediate_format == 'arrow':
+            arrow_path: str = os.path.join('data', 'quandl', 'quandl_raw.arrow')
+            write_ipc(all_tickers_df, arrow_path)
+            self.storage.upload_a_file(source_file=arrow_path, destination_blob='shared/data/quandl/raw.arrow')
+
+    def combine(
+        self,
+        latest_data: typing.Optional[typing.Dict[str, pd.DataFrame]] = None,
+    ) -> pd.DataFrame:
+        '''
+        Combine the latest data of all the tickers. The tickers in `latest_data`
+        are used as they are, only the other ones are downloaded from Storage.
+        '''
         self.slack.send('Start')
-
-        # Download all latest tickers from Storage.
-        self.__download_previous_quandl_latest()
-
-        # Load all tickers which have been downloaded.
-        all_ticker_list: typing.List[pd.DataFrame] = self.__load_all_tickers()
+        latest_data = latest_data or {}
+
+        # The registry tells which tickers changed since the last raw data,
+        # the ones in memory are hashed as they are combined, in case their
+        # upload did not register them (yet).
+        hashes: typing.Dict[str, str] = {
+            **self.registry.get_hashes('quandl', self.tickers),
+            **{ticker: get_frame_hash(df) for ticker, df in latest_data.items() if ticker in self.tickers},
+        }
+        unchanged_tickers: typing.List[str] = [
+            ticker for ticker in self.__get_unchanged_tickers(hashes) if ticker not in latest_data
+        ]
+        logger.info(f'Unchanged tickers: {len(unchanged_tickers)}')
+
+        if unchanged_tickers:
+            latest_data = {**self.__load_previous_raw_tickers(unchanged_tickers), **latest_data}
+
+        # Load the other latest tickers which are not in memory from Storage.
+        latest_data = {
+            **self.__load_previous_quandl_latest(
+                tickers=[ticker for ticker in self.tickers if ticker not in latest_data]
+            ),
+            **latest_data,
+        }
+
+        # Gather all the tickers in the config order.
+        all_ticker_list: typing.List[pd.DataFrame] = self.__load_all_tickers(latest_data)
+        # Leave the list as the only reference, so the merge can release the tickers.
+        latest_data.clear()
 
         # Merge all the tickers data.
-        all_tickers_df: pd.DataFrame = self.__merge_all_tickers(all_ticker_list)
+        with self.memory_budget.stage('merge'):
+            all_tickers_df: pd.DataFrame = self.__merge_all_tickers(all_ticker_list)
+
+        report: QualityReport = validate(df=all_tickers_df, schema=QUANDL_RAW_SCHEMA)
+        logger.info(report.summary())
+        report.raise_for_errors()
 
         # Upload to Storge.
-        self.__upload_raw_quandl(all_tickers_df)
+        with self.memory_budget.stage('upload'):
+            self.__upload_raw_quandl(all_tickers_df)
+        self.registry.update('stages', {'quandl_combine_raw': {'items': hashes, 'finished_at': get_now()}})
 
-        self.slack.send('Finished')
+        self.slack.send(f'Finished - {self.storage.get_transfer_report()} - Memory: {self.memory_budget.get_report()}')
 
+        return all_tickers_df
 
-@task
-def run_quandl_combine_raw():
-    handler = QuandlCombineRawTickers()
-    handler.run()
+    def run(self) -> None:
+        self.combine()
@@ -1,19 +1,27 @@
 from __future__ import absolute_import
 
 import os
+import json
 import time
 import typing
 import shutil
 import prefect
 import configparser
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import quandl
 import pandas as pd
-from prefect import task
 
-from utils.storages import GoogleCloudStorage
+from utils.storages import get_storage
+from utils.archives import ContentAddressedArchive
+from utils.delta_log import DeltaLog
+from utils.rate_limiter import RateLimiter, get_rate_limiter
+from utils.exchanges import ExchangeCalendar, get_exchange, read_exchange_calendars
+from utils.registry import Registry, get_frame_hash, get_frame_state, get_now
+from utils.replay import get_current_time, wrap_api
+from utils.sharding import Shard, get_shard
 from utils.slackbot import Slack
+from utils.validation import QUANDL_RAW_SCHEMA, QualityReport, coerce_dtypes, validate
 
 
 logger = prefect.context.get('logger')
@@ -21,7 +29,7 @@ logger = prefect.context.get('logger')
 
 class QuandlPremium:
 
-    def __init__(self):
+    def __init__(self, shard: typing.Optional[Shard] = None):
         # Create slack instace.
         self.slack = Slack(title=f'Quanld Daily')
 
@@ -29,14 +37,39 @@ class QuandlPremium:
         self.config: configparser.ConfigParser = self.__get_config()
         api_key: str = self.config['quandl']['api_key']
         quandl.ApiConfig.api_key = api_key
+        self.quandl: typing.Any = wrap_api('quandl', lambda: quandl)
+        # Shared with the other flows calling QuanDL on this host.
+        self.rate_limiter: RateLimiter = get_rate_limiter('quandl')
+
+        # The tickers of the shard, all of them by default.
+        self.shard: Shard = shard or get_shard()
+        self.tickers: typing.List[str] = self.shard.select(self.config['quandl']['tickers'].split('\n'))
+        # The shards of a run are fetched at the same time, each one tracks its own.
+        self.stage_name: str = f'quandl_daily/{self.shard.name}' if self.shard.is_sharded() else 'quandl_daily'
+
+        self.storage = get_storage(
+            bucket_name=self.config['storage']['bucket_name'],
+            config=self.config['storage'],
+        )
+        self.archive = ContentAddressedArchive(
+            storage=self.storage,
+            root='shared/data/quandl/archives',
+            writer='quandl_daily',
+        )
+        self.delta_log = DeltaLog(
+            storage=self.storage,
+            base_root='shared/data/quandl/latest',
+            delta_root='shared/data/quandl/deltas',
+            key_columns=QUANDL_RAW_SCHEMA.key_columns,
+        )
+        self.registry = Registry(storage=self.storage)
 
-        self.tickers: typing.List[str] = self.config['quandl']['tickers'].split('\n')
-
-        self.storage = GoogleCloudStorage(bucket_name=self.config['storage']['bucket_name'])
+        self.calendars: typing.Dict[str, ExchangeCalendar] = read_exchange_calendars(
+            self.__get_config(config_file='quandlib-flows/tasks/configs/exchanges.cfg')
+        )
 
-    def __get_config(self) -> configparser.ConfigParser:
-        self.run_time: str = os.getenv('RUN_TIME', '')
-        config_file: str = f'quandlib-flows/tasks/configs/quandl_daily_{self.run_time}.cfg'
+    @staticmethod
+    def __get_config(config_file: str = 'quandlib-flows/tasks/configs/quandl_daily.cfg') -> configparser.ConfigParser:
         cwd: str = os.getcwd()
 
         if not os.path.isfile(config_file):
@@ -47,9 +80,10 @@ class QuandlPremium:
 
         return config
 
-    def __pre_start(self) -> None:
+    def prepare(self) -> None:
         '''
-        Setup the data folders and sync from GCS before starting.
+        Setup the data folders before starting, the previous latest data
+        is loaded from the delta log by each batch.
         '''
         self.__remove_previous()
 
@@ -57,43 +91,98 @@ class QuandlPremium:
         self.__create_folder(os.path.join('data', 'latest'))
         self.__create_folder(os.path.join('data', 'tickers'))
         self.__create_folder(os.path.join('data', 'merged'))
+        self.__create_folder(os.path.join('data', 'deltas'))
+
+        # The tickers fetched since then are the ones which did not fail.
+        self.registry.update('stages', {self.stage_name: {'started_at': get_now()}})
+
+    def get_due_tickers(self, now: typing.Optional[datetime] = None) -> typing.List[str]:
+        '''
+        Return the tickers whose exchange published a session after their
+        last date, and which are due for a retry (the settles may come out
+        later than expected), see `__is_retry_due`.
+        '''
+        now = now or get_current_time(timezone.utc)
+        due_tickers: typing.List[str] = []
+        self.__check_holidays(now)
+
+        for ticker in self.tickers:
+            entry: typing.Dict[str, typing.Any] = self.registry.get('quandl', ticker) or {}
+            calendar: typing.Optional[ExchangeCalendar] = self.calendars.get(get_exchange(ticker, self.calendars))
+            session = calendar.get_latest_session(now) if calendar is not None else None
 
-        self.__download_previous_latest()
+            # Without a calendar, the ticker is fetched every time.
+            if entry.get('last_date') is None or session is None:
+                due_tickers.append(ticker)
+            elif entry['last_date'] < session.isoformat() \
+                    and self.__is_retry_due(entry.get('fetched_at'), calendar.get_publish_time(session), now):
+                due_tickers.append(ticker)
+
+        return due_tickers
+
+    def __is_retry_due(self, fetched_at: typing.Optional[str], published_at: datetime, now: datetime) -> bool:
+        '''
+        A ticker behind its session is fetched again `retry_minutes` after
+        the last fetch, or `retry_backoff` times as long as it was behind at
+        the last fetch: a ticker lagging all day is fetched a few times, not
+        every hour.
+        '''
+        if not fetched_at:
+            return True
+
+        retry_minutes: int = self.config.getint('quandl', 'retry_minutes', fallback=60)
+        retry_backoff: float = self.config.getfloat('quandl', 'retry_backoff', fallback=2)
+        # The registry times are local.
+        last_fetch: datetime = datetime.fromisoformat(fetched_at).astimezone(timezone.utc)
+        wait: timedelta = max(timedelta(minutes=retry_minutes), retry_backoff * (last_fetch - published_at))
+
+        return now - last_fetch >= wait
+
+    def __check_holidays(self, now: datetime) -> None:
+        '''
+        Warn when the holidays of an exchange of the tickers are not known
+        anymore, its holidays are taken for sessions until they are added.
+        '''
+        exchanges: typing.List[str] = sorted(set(
+            exchange for exchange in (get_exchange(ticker, self.calendars) for ticker in self.tickers)
+            if exchange in self.calendars and not self.calendars[exchange].has_holidays(now)
+        ))
+        if exchanges:
+            message: str = f'The holidays of {", ".join(exchanges)} are outdated, update exchanges.cfg'
+            logger.warning(message)
+            self.slack.send(message)
+
+    def get_ticker_batches(self, tickers: typing.Optional[typing.List[str]] = None) -> typing.List[typing.List[str]]:
+        batch_size: int = self.config.getint('quandl', 'batch_size', fallback=10)
+        tickers = self.tickers if tickers is None else tickers
+
+        return [
+            tickers[i:i + batch_size]
+            for i in range(0, len(tickers), batch_size)
+        ]
 
     @staticmethod
     def __remove_previous() -> None:
-        if os.path.isdir('data'):
-            shutil.rmtree('data')
+        # Only the folders of this handler, the other stages may be running.
+        for folder in ('latest', 'tickers', 'merged', 'deltas'):
+            if os.path.isdir(os.path.join('data', folder)):
+                shutil.rmtree(os.path.join('data', folder))
 
     @staticmethod
     def __create_folder(folder_path: str) -> None:
         if not os.path.isdir(folder_path):
             os.makedirs(folder_path)
 
-    def __download_previous_latest(self) -> None:
+    def __download_all(self, tickers: typing.List[str]) -> typing.Dict[str, pd.DataFrame]:
         ticker: str
-
-        for ticker in self.tickers:
-            latest_ticker_blob = f'shared/data/quandl/latest/{ticker}.pkl'
-            latest_ticker_local_path = os.path.join(
-                'data',
-                'latest',
-                f'{ticker}.pkl',
-            )
-            if self.storage.is_file_exists(latest_ticker_blob):
-                self.storage.download_a_file(
-                    source_blob_name=latest_ticker_blob,
-                    destination_file_name=latest_ticker_local_path,
-                )
-
-    def __download_all(self) -> typing.Dict[str, pd.DataFrame]:
-        ticker: str
-        tickers: typing.List[str] = self.tickers
         downloaded_data: typing.Dict[str, pd.DataFrame] = {}  # type: ignore
         failed_tickers: typing.List[str] = []
 
         for ticker in tickers:
-            data: typing.Optional[pd.DataFrame] = self.__download_by_ticker(ticker=ticker)
+            data: typing.Optional[pd.DataFrame] = self.__download_by_ticker_with_retries(ticker=ticker)
+
+            if data is not None:
+                data = self.__conform(ticker=ticker, data=data)
 
             if data is not None:
                 self.__save_ticker_data(ticker=ticker, data=data)
@@ -105,6 +194,50 @@ class QuandlPremium:
 
         return downloaded_data
 
+    def __conform(self, ticker: str, data: pd.DataFrame) -> typing.Optional[pd.DataFrame]:
+        '''
+        Cast a download to the dtypes of the raw schema and drop its rows
+        without a settle. Only a broken structure (missing columns, null
+        keys) fails the ticker.
+        '''
+        missing_columns: typing.List[str] = [column for column in QUANDL_RAW_SCHEMA.columns if column not in data]
+        if missing_columns:
+            logger.error(f'{ticker}: missing columns {missing_columns}')
+            return None
+
+        data = coerce_dtypes(df=data, schema=QUANDL_RAW_SCHEMA)
+
+        no_settle: pd.Series = data['settle'].isna()
+        if no_settle.any():
+            logger.warning(f'{ticker}: {int(no_settle.sum())} rows without a settle are dropped')
+            data = data[~no_settle].reset_index(drop=True)
+
+        report: QualityReport = validate(df=data, schema=QUANDL_RAW_SCHEMA)
+        if not report.is_valid:
+            logger.error(report.summary())
+            return None
+
+        return data
+
+    def __download_by_ticker_with_retries(self, ticker: str) -> typing.Optional[pd.DataFrame]:
+        '''
+        Retry a single ticker, so a flaky response doesn't fail the whole batch.
+        '''
+        retries: int = self.config.getint('quandl', 'ticker_retries', fallback=3)
+        retry_delay: int = self.config.getint('quandl', 'ticker_retry_delay', fallback=5)
+        data: typing.Optional[pd.DataFrame] = None
+
+        for attempt in range(retries + 1):
+            data = self.__download_by_ticker(ticker=ticker)
+            if data is not None:
+                break
+
+            if attempt < retries:
+                logger.info(f'Retry ticker: {ticker} - attempt {attempt + 1}')
+                time.sleep(retry_delay * (attempt + 1))
+
+        return data
+
     def __download_by_ticker(self, ticker: str) -> typing.Optional[pd.DataFrame]:
         prefix = self.config['quandl']['table_name']
         slice_method: str = self.config['quandl']['splice_code']
@@ -114,18 +247,16 @@ class QuandlPremium:
 
         try:
             logger.info(f'Getting ticker: {ticker}')
-            data = quandl.get_table(
-                prefix,
-                date={
-                    'gte': start_date,
-                    'lte': end_date
-                },
-                quandl_code=f'{ticker}_{slice_method}',
-            )
+            with self.rate_limiter.limit():
+                data = self.quandl.get_table(
+                    prefix,
+                    date={
+                        'gte': start_date,
+                        'lte': end_date
+                    },
+                    quandl_code=f'{ticker}_{slice_method}',
+                )
             logger.info(f'Done: {ticker} - {data.shape}')
-
-            # Delay the call by a second.
-            time.sleep(1)
         except Exception as ex:
             logger.info(ex)
             data = None
@@ -139,29 +270,52 @@ class QuandlPremium:
 
         data.to_pickle(file_path)
 
-    def __merge_with_the_latest(self, downloaded_data: typing.Dict[str, pd.DataFrame]):
+    def __merge_with_the_latest(
+        self,
+        downloaded_data: typing.Dict[str, pd.DataFrame]
+    ) -> typing.Dict[str, pd.DataFrame]:
         ticker: str
         data: pd.DataFrame
+        merged: typing.Dict[str, pd.DataFrame] = {}
+        unchanged: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
 
         for ticker, data in downloaded_data.items():
-            # Load latest.
-            latest_file_path: str = os.path.join(
-                'data',
-                'latest',
-                f'{ticker}.pkl',
-            )
-
-            if os.path.isfile(latest_file_path):
-                latest_data: pd.DataFrame = pd.read_pickle(latest_file_path)
-                merged_data: pd.DataFrame = pd.concat([data, latest_data]) \
-                    .drop_duplicates() \
-                    .reset_index(drop=True)
-
-                merged_data.to_pickle(latest_file_path)
-                logger.info(f'Merged latest for ticker: {ticker} - {merged_data.shape}')
-            else:
-                # Upload the current file to latest.
+            # Same download as the last one: the latest data is up to date already.
+            source_hash: str = get_frame_hash(data)
+            if self.registry.is_unchanged('quandl', ticker, field='source_hash', value=source_hash):
+                logger.info(f'Unchanged ticker: {ticker}')
+                unchanged[ticker] = {'fetched_at': get_now()}
+                continue
+
+            # Load latest: the snapshot merged with its delta segments.
+            latest_data: typing.Optional[pd.DataFrame] = self.delta_log.load(ticker)
+
+            if latest_data is None:
+                # The first data of the ticker becomes its snapshot.
                 self.__write_to_latest(ticker=ticker, data=data)
+                self.__write_state(ticker=ticker, data=data, source_hash=source_hash)
+                merged[ticker] = data
+                continue
+
+            new_rows: pd.DataFrame = DeltaLog.get_new_rows(data=data, previous=latest_data)
+
+            if new_rows.empty:
+                logger.info(f'No new rows for ticker: {ticker}')
+                self.__write_state(ticker=ticker, data=latest_data, source_hash=source_hash)
+                merged[ticker] = latest_data
+                continue
+
+            # Only the new or revised rows are written, as a delta segment.
+            self.__write_to_deltas(ticker=ticker, data=new_rows)
+            merged_data: pd.DataFrame = self.delta_log.merge([new_rows, latest_data])
+            logger.info(f'Merged latest for ticker: {ticker} - {merged_data.shape} - new rows: {len(new_rows)}')
+            self.__write_state(ticker=ticker, data=merged_data, source_hash=source_hash)
+            merged[ticker] = merged_data
+
+        # Nothing to upload for them, only the time they were checked.
+        self.registry.update('quandl', unchanged)
+
+        return merged
 
     def __write_to_latest(self, ticker: str, data: pd.DataFrame) -> None:
         latest_file_path: str = os.path.join(
@@ -171,6 +325,40 @@ class QuandlPremium:
         )
         data.to_pickle(latest_file_path)
 
+    @staticmethod
+    def __write_state(ticker: str, data: pd.DataFrame, source_hash: str) -> None:
+        '''
+        The registry entry of the merged ticker, registered once it is uploaded.
+        '''
+        state_file_path: str = os.path.join(
+            'data',
+            'merged',
+            f'{ticker}.json',
+        )
+        with open(state_file_path, 'w') as f:
+            json.dump({**get_frame_state(data), 'source_hash': source_hash}, f)
+
+    def __register_latest_tickers(
+        self,
+        downloaded_data: typing.Dict[str, pd.DataFrame]
+    ) -> None:
+        states: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+        for ticker, _ in downloaded_data.items():
+            state_file_path: str = os.path.join('data', 'merged', f'{ticker}.json')
+            with open(state_file_path) as f:
+                states[ticker] = {**json.load(f), 'fetched_at': get_now()}
+
+        self.registry.update('quandl', states)
+
+    def __write_to_deltas(self, ticker: str, data: pd.DataFrame) -> None:
+        delta_file_path: str = os.path.join(
+            'data',
+            'deltas',
+            f'{ticker}.pkl',
+        )
+        data.to_pickle(delta_file_path)
+
     def __upload_latest_tickers(
         self,
         downloaded_data: typing.Dict[str, pd.DataFrame]
@@ -179,15 +367,23 @@ class QuandlPremium:
             self.__upload_latest_ticker(ticker=ticker)
 
     def __upload_latest_ticker(self, ticker: str) -> None:
-        local_file: str = os.path.join(
+        delta_file: str = os.path.join(
+            'data',
+            'deltas',
+            f'{ticker}.pkl',
+        )
+        latest_file: str = os.path.join(
             'data',
             'latest',
             f'{ticker}.pkl',
         )
-        blob_file: str = f'shared/data/quandl/latest/{ticker}.pkl'
 
-        self.storage.upload_a_file(source_file=local_file, destination_blob=blob_file)
-        logger.info(f'Uploaded: {blob_file}')
+        if os.path.isfile(delta_file):
+            segment_blob: str = self.delta_log.append(key=ticker, local_file=delta_file)
+            logger.info(f'Uploaded: {segment_blob}')
+        elif os.path.isfile(latest_file):
+            self.delta_log.write_base(key=ticker, local_file=latest_file)
+            logger.info(f'Uploaded: {self.delta_log.get_base_blob(ticker)}')
 
     def __upload_downloaded_tickers(
         self,
@@ -196,6 +392,8 @@ class QuandlPremium:
         for ticker, _ in downloaded_data.items():
             self.__upload_downloaded_ticker(ticker=ticker)
 
+        # One manifest per batch, the batches run in parallel.
+        self.archive.commit(day=self.__get_today())
 
     def __upload_downloaded_ticker(self, ticker: str) -> None:
         local_file: str = os.path.join(
@@ -203,11 +401,8 @@ class QuandlPremium:
             'tickers',
             f'{ticker}.pkl',
         )
-        today: str = self.__get_today()
-        blob_file: str = f'shared/data/quandl/archives/{today}/{ticker}.pkl'
-
-        self.storage.upload_a_file(source_file=local_file, destination_blob=blob_file)
-        logger.info(f'Uploaded: {blob_file}')
+        content_hash: str = self.archive.add(local_file=local_file, name=f'{ticker}.pkl')
+        logger.info(f'Archived: {ticker}.pkl - {content_hash}')
 
 
     @staticmethod
@@ -219,7 +414,7 @@ class QuandlPremium:
         Return today as format: YYYY-MM-DD.
         '''
         if 'end_date' not in self.config['default']:
-            return datetime.now().strftime('%Y-%m-%d')
+            return get_current_time().strftime('%Y-%m-%d')
         return self.config['default']['end_date']
 
     def __get_today(self, output_format: typing.Optional[str] = None) -> str:
@@ -227,32 +422,80 @@ class QuandlPremium:
             output_format = '%Y-%m-%d'
 
         if 'end_date' not in self.config['default']:
-            return datetime.now().strftime(output_format)
+            return get_current_time().strftime(output_format)
         return self.config['default']['end_date']
 
-    def run(self):
-        self.slack.send(f'Start Quandl daily - run time: {self.run_time}')
+    def fetch_batch(self, tickers: typing.List[str]) -> typing.Dict[str, pd.DataFrame]:
+        '''
+        Download the newest data of a batch of tickers.
+        '''
+        return self.__download_all(tickers=tickers)
 
-        # Prepare folders and data.
-        self.__pre_start()
+    def merge_batch(self, downloaded_data: typing.Dict[str, pd.DataFrame]) -> typing.Dict[str, pd.DataFrame]:
+        '''
+        Merge the downloaded tickers with their previous latest data. The
+        tickers downloaded the same as the last time are left out.
+        '''
+        return self.__merge_with_the_latest(downloaded_data)
 
-        # Download newest data.
-        downloaded_data = self.__download_all()
+    def upload_batch(self, merged_data: typing.Dict[str, pd.DataFrame]) -> typing.Dict[str, typing.Any]:
+        '''
+        Upload the downloaded and the latest files of a batch,
+        return the uploaded tickers and the transferred bytes.
+        '''
+        self.__upload_downloaded_tickers(merged_data)
+        self.__upload_latest_tickers(merged_data)
+        self.__register_latest_tickers(merged_data)
+        logger.info(self.storage.get_transfer_report())
+
+        return {
+            'tickers': list(merged_data),
+            'bytes_uploaded': self.storage.bytes_uploaded,
+            'bytes_skipped': self.storage.bytes_skipped,
+        }
+
+    def get_fetched_tickers(self) -> typing.List[str]:
+        '''
+        Return the tickers fetched since `prepare`, uploaded or unchanged.
+        '''
+        entries: typing.Dict[str, typing.Dict[str, typing.Any]] = self.registry.load(reload=True)
+        started_at: str = entries.get('stages', {}).get(self.stage_name, {}).get('started_at', '')
 
-        # Upload downloaded files.
-        self.__upload_downloaded_tickers(downloaded_data)
+        return [
+            ticker for ticker in self.tickers
+            if entries.get('quandl', {}).get(ticker, {}).get('fetched_at', '') >= started_at
+        ]
 
-        # Merge with old data.
-        self.__merge_with_the_latest(downloaded_data)
+    def compact_batch(self, tickers: typing.List[str]) -> typing.List[str]:
+        '''
+        Fold the delta segments of the tickers into their snapshot, once
+        they have `compaction_threshold` segments. Return the compacted ones.
+        '''
+        threshold: int = self.config.getint('quandl', 'compaction_threshold', fallback=20)
+        compacted: typing.List[str] = [
+            ticker for ticker in tickers
+            if self.delta_log.compact(key=ticker, threshold=threshold)
+        ]
 
-        # Upload latest tickers.
-        self.__upload_latest_tickers(downloaded_data)
+        logger.info(f'Compacted tickers: {compacted}')
 
-        logger.info('DONE!')
-        self.slack.send(message='Task finished!')
+        return compacted
 
+    def run(self):
+        '''
+        Run all the batches one after the other, the flows map them instead.
+        '''
+        due_tickers: typing.List[str] = self.get_due_tickers()
+        self.slack.send(f'Start Quandl daily - due tickers: {len(due_tickers)}/{len(self.tickers)}')
+
+        # Prepare folders.
+        self.prepare()
 
-@task
-def run_quandl_daily():
-    quandl_daily = QuandlPremium()
-    quandl_daily.run()
+        for tickers in self.get_ticker_batches(due_tickers):
+            downloaded_data = self.fetch_batch(tickers)
+            merged_data = self.merge_batch(downloaded_data)
+            self.upload_batch(merged_data)
+            self.compact_batch(list(merged_data))
+
+        logger.info('DONE!')
+        self.slack.send(message=f'Task finished! {self.storage.get_transfer_report()}')
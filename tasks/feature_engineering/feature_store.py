@@ -0,0 +1,345 @@
+"""
+Rolling-window features of the datasets, updated incrementally.
+
+A run only computes the features of the rows added since the last one: the
+tail of each key (the last rows its longest window needs) is kept as the
+state of the source, so the new rows are computed from the tail and
+themselves, not from the whole history. The features are appended to a
+delta log per source. The full mode recomputes everything from the source,
+and `verify` compares what is stored with a full recompute.
+"""
+from __future__ import absolute_import
+
+import os
+import typing
+import configparser
+
+import prefect
+import numpy as np
+import pandas as pd
+
+from tasks.base import BaseHandler
+from utils.datasets import load_dataset, query_quandl_processed
+from utils.delta_log import DeltaLog
+from utils.frames import get_group_positions
+from utils.storages import get_storage
+from utils.slackbot import Slack
+
+
+logger = prefect.context.get('logger')
+
+
+class FeatureSource(typing.NamedTuple):
+    name: str
+    dataset: str
+    key_column: str
+    date_column: str
+
+
+class RollingFeature(typing.NamedTuple):
+    name: str
+    source: str
+    column: str
+    window: int
+    # A method of pandas `Rolling`: mean, std, sum, min or max.
+    stat: str
+
+
+STATS: typing.Set[str] = {'mean', 'std', 'sum', 'min', 'max'}
+
+
+def read_features(
+    config: configparser.ConfigParser,
+) -> typing.Tuple[typing.Dict[str, FeatureSource], typing.List[RollingFeature]]:
+    """
+    The `[source.{name}]` and `[feature.{name}]` sections of the config.
+    """
+    sources: typing.Dict[str, FeatureSource] = {}
+    features: typing.List[RollingFeature] = []
+
+    for section in config.sections():
+        if section.startswith('source.'):
+            name: str = section[len('source.'):]
+            sources[name] = FeatureSource(
+                name=name,
+                dataset=config.get(section, 'dataset'),
+                key_column=config.get(section, 'key_column'),
+                date_column=config.get(section, 'date_column', fallback='date'),
+            )
+        elif section.startswith('feature.'):
+            features.append(RollingFeature(
+                name=section[len('feature.'):],
+                source=config.get(section, 'source'),
+                column=config.get(section, 'column'),
+                window=config.getint(section, 'window'),
+                stat=config.get(section, 'stat'),
+            ))
+
+    for feature in features:
+        if feature.source not in sources:
+            raise Exception(f'Unknown source of feature {feature.name}: {feature.source}')
+        if feature.stat not in STATS:
+            raise Exception(f'Unknown stat of feature {feature.name}: {feature.stat}')
+
+    return sources, features
+
+
+def compute_features(
+    df: pd.DataFrame,
+    source: FeatureSource,
+    features: typing.List[RollingFeature],
+) -> pd.DataFrame:
+    """
+    The features of every row of `df`, sorted by key and date, for all the
+    keys at once: one rolling pass per feature over the whole column, masked
+    where the window spans two keys.
+    """
+    positions: np.ndarray = get_group_positions(df[source.key_column].to_numpy())
+    output: typing.Dict[str, typing.Any] = {
+        source.key_column: df[source.key_column],
+        source.date_column: df[source.date_column],
+    }
+
+    for feature in features:
+        rolling = df[feature.column].rolling(feature.window, min_periods=feature.window)
+        output[feature.name] = getattr(rolling, feature.stat)().mask(positions < feature.window - 1)
+
+    return pd.DataFrame(output)
+
+
+class RollingFeatureStore(BaseHandler):
+
+    config_file: str = 'quandlib-flows/tasks/configs/feature_store.cfg'
+
+    def __init__(self) -> None:
+        self.config: configparser.ConfigParser = self.get_config()
+        self.sources, self.features = read_features(self.config)
+        # The segments of a source are folded into its snapshot once there are that many.
+        self.compact_segments: int = self.config.getint('store', 'compact_segments', fallback=30)
+
+        # Create storage.
+        self.storage = get_storage(
+            bucket_name=os.getenv('BUCKET_NAME'),
+            config=self.get_config_key(self.config, 'storage', None),
+        )
+        self.delta_log = DeltaLog(
+            storage=self.storage,
+            base_root='shared/data/features/base',
+            delta_root='shared/data/features/deltas',
+        )
+
+        # Create Slack instace to send messages.
+        self.slack = Slack(title='Feature store')
+
+        self.create_folder(os.path.join('data', 'features'))
+
+    def __get_features(self, source: FeatureSource) -> typing.List[RollingFeature]:
+        return [feature for feature in self.features if feature.source == source.name]
+
+    def __get_tail_length(self, source: FeatureSource) -> int:
+        """
+        The rows kept by key: the longest window needs the ones before a new
+        row, at least the last one is kept for its date.
+        """
+        return max([feature.window - 1 for feature in self.__get_features(source)] + [1])
+
+    @staticmethod
+    def __get_state_blob(source: FeatureSource) -> str:
+        return f'shared/data/features/state/{source.name}.pickle'
+
+    def __load_source(
+        self,
+        source: FeatureSource,
+        start_date: typing.Optional[str] = None,
+        keys: typing.Optional[typing.List[str]] = None,
+        columns: typing.Optional[typing.List[str]] = None,
+    ) -> pd.DataFrame:
+        columns = columns or [source.key_column, source.date_column] + sorted(set(
+            feature.column for feature in self.__get_features(source)
+        ))
+
+        if source.dataset == 'quandl_processed':
+            # Only the partitions and row groups from the start date are read.
+            df: pd.DataFrame = query_quandl_processed(
+                tickers=keys,
+                start_date=start_date,
+                columns=columns,
+                storage=self.storage,
+            )
+        else:
+            df = load_dataset(name=source.dataset, tickers=keys, columns=columns, storage=self.storage)
+            if start_date is not None:
+                df = df[df[source.date_column] >= pd.Timestamp(start_date)]
+
+        return df.sort_values([source.key_column, source.date_column], kind='stable').reset_index(drop=True)
+
+    def __load_state(self, source: FeatureSource) -> typing.Optional[pd.DataFrame]:
+        blob: str = self.__get_state_blob(source)
+        if not self.storage.is_file_exists(blob):
+            return None
+
+        local_file: str = os.path.join('data', 'features', f'{source.name}.state.pickle')
+        self.storage.download_a_file(source_blob_name=blob, destination_file_name=local_file)
+
+        return pd.read_pickle(local_file)
+
+    def __save_state(self, source: FeatureSource, df: pd.DataFrame) -> None:
+        """
+        Keep the tail of each key of `df`, sorted by key and date.
+        """
+        state: pd.DataFrame = df.groupby(source.key_column, sort=False).tail(self.__get_tail_length(source))
+
+        local_file: str = os.path.join('data', 'features', f'{source.name}.state.pickle')
+        state.reset_index(drop=True).to_pickle(local_file)
+        self.storage.upload_a_file(source_file=local_file, destination_blob=self.__get_state_blob(source))
+
+    def __get_new_rows(self, source: FeatureSource, state: pd.DataFrame) -> pd.DataFrame:
+        """
+        The rows of the source after the last date of their key in the state,
+        each key read from its own last date. The keys without a state, e.g.
+        added to the source since, are read whole.
+        """
+        last_dates: pd.Series = state.groupby(source.key_column)[source.date_column].max()
+        source_dates: pd.Series = self.__load_source(source, columns=[source.key_column, source.date_column]) \
+            .groupby(source.key_column)[source.date_column].max()
+
+        cutoffs: pd.Series = pd.to_datetime(last_dates.reindex(source_dates.index))
+        updated: pd.Series = cutoffs[cutoffs.isna() | (source_dates > cutoffs)]
+        new_keys: typing.List[str] = list(updated.index[updated.isna()])
+        behind: pd.Series = updated.dropna()
+
+        frames: typing.List[pd.DataFrame] = []
+        for last_date, dates in behind.groupby(behind):
+            frames.append(self.__load_source(
+                source,
+                start_date=pd.Timestamp(last_date).strftime('%Y-%m-%d'),
+                keys=list(dates.index),
+            ))
+
+        if new_keys:
+            frames.append(self.__load_source(source, keys=new_keys))
+
+        if not frames:
+            return state.iloc[:0]
+
+        recent: pd.DataFrame = pd.concat(frames)
+        previous_dates: pd.Series = recent[source.key_column].map(last_dates)
+
+        return recent[previous_dates.isna() | (recent[source.date_column] > previous_dates)]
+
+    def __update(self, source: FeatureSource) -> int:
+        """
+        Compute and append the features of the new rows, return their count.
+        """
+        state: typing.Optional[pd.DataFrame] = self.__load_state(source)
+        if state is None:
+            logger.info(f'No state for {source.name}, full recompute.')
+            return self.__recompute(source)
+
+        new_rows: pd.DataFrame = self.__get_new_rows(source, state)
+        if new_rows.empty:
+            logger.info(f'No new rows for {source.name}.')
+            return 0
+
+        updated_keys: pd.Series = state[source.key_column].isin(new_rows[source.key_column].unique())
+        rows: pd.DataFrame = pd.concat([
+            state[updated_keys].assign(is_new=False),
+            new_rows.assign(is_new=True),
+        ]).sort_values([source.key_column, source.date_column], kind='stable').reset_index(drop=True)
+
+        features_df: pd.DataFrame = compute_features(rows, source=source, features=self.__get_features(source))
+        features_df = features_df[rows['is_new'].to_numpy()]
+        logger.info(f'{source.name}: {len(features_df)} new rows of {rows[source.key_column].nunique()} keys')
+
+        # The features first: after a failure the rows are computed again,
+        # the same, and the log drops the duplicates.
+        local_file: str = os.path.join('data', 'features', f'{source.name}.segment.pickle')
+        features_df.reset_index(drop=True).to_pickle(local_file)
+        self.delta_log.append(source.name, local_file=local_file)
+        self.delta_log.compact(source.name, threshold=self.compact_segments)
+
+        self.__save_state(source, pd.concat([state[~updated_keys], rows.drop(columns='is_new')]))
+
+        return len(features_df)
+
+    def __recompute(self, source: FeatureSource) -> int:
+        """
+        Compute the features of the whole source, replacing the stored ones.
+        """
+        df: pd.DataFrame = self.__load_source(source)
+        features_df: pd.DataFrame = compute_features(df, source=source, features=self.__get_features(source))
+
+        local_file: str = os.path.join('data', 'features', f'{source.name}.pickle')
+        features_df.to_pickle(local_file)
+        self.delta_log.write_base(source.name, local_file=local_file)
+        for segment in self.delta_log.list_segments(source.name):
+            self.storage.delete_a_file(segment)
+
+        self.__save_state(source, df)
+
+        return len(features_df)
+
+    def load_features(self, source_name: str) -> typing.Optional[pd.DataFrame]:
+        """
+        The stored features of a source, sorted by key and date.
+        """
+        source: FeatureSource = self.sources[source_name]
+        features_df: typing.Optional[pd.DataFrame] = self.delta_log.load(source.name)
+        if features_df is None:
+            return None
+
+        return features_df \
+            .sort_values([source.key_column, source.date_column], kind='stable') \
+            .reset_index(drop=True)
+
+    def verify(self, source_name: str, rtol: float = 1e-6) -> typing.List[str]:
+        """
+        Compare the stored features with a full recompute, return the
+        features which differ. The rolling variance of pandas is updated
+        online, its rounding depends on the rows before the window (about
+        1e-8 apart over 20 years), hence the tolerance.
+        """
+        source: FeatureSource = self.sources[source_name]
+        features: typing.List[RollingFeature] = self.__get_features(source)
+        expected: pd.DataFrame = compute_features(self.__load_source(source), source=source, features=features)
+        stored: typing.Optional[pd.DataFrame] = self.load_features(source_name)
+
+        keys: typing.List[str] = [source.key_column, source.date_column]
+        if stored is None or len(stored) != len(expected) \
+                or not stored[keys].equals(expected[keys].reset_index(drop=True)):
+            return [feature.name for feature in features]
+
+        return [
+            feature.name for feature in features
+            if not np.allclose(
+                stored[feature.name].to_numpy(dtype=np.float64),
+                expected[feature.name].to_numpy(dtype=np.float64),
+                rtol=rtol,
+                atol=1e-12,
+                equal_nan=True,
+            )
+        ]
+
+    def run(self, full: bool = False, verify: bool = False) -> typing.Dict[str, int]:
+        """
+        Update the features of every source, return the rows computed by source.
+        """
+        self.slack.send(f'Start - Full: {full}')
+        rows: typing.Dict[str, int] = {}
+
+        for source in self.sources.values():
+            rows[source.name] = self.__recompute(source) if full else self.__update(source)
+
+        self.slack.send(f'Rows: {rows} - {self.storage.get_transfer_report()}')
+
+        if verify:
+            mismatches: typing.Dict[str, typing.List[str]] = {
+                source.name: self.verify(source.name) for source in self.sources.values()
+            }
+            mismatches = {name: features for name, features in mismatches.items() if features}
+            if mismatches:
+                self.slack.send(f'Verification failed: {mismatches}')
+                raise Exception(f'Incremental features differ from a full recompute: {mismatches}')
+            self.slack.send('Verified against a full recompute.')
+
+        return rows
@@ -0,0 +1,206 @@
+"""
+The Prefect tasks used by the flows.
+
+The handlers, and with them pandas, numpy, quandl, fredapi and
+google-cloud-storage, are only imported when a task runs. Registering or
+loading a flow definition only needs prefect.
+"""
+from __future__ import annotations
+
+import typing
+from datetime import timedelta
+
+import prefect
+from prefect import task
+from prefect.triggers import all_finished
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
+
+# QuanDL daily.
+
+@task(checkpoint=False)
+def prepare_quandl_daily(
+    tickers: typing.Optional[typing.List[str]] = None,
+    force: bool = False,
+    shard_index: typing.Optional[int] = None,
+    shard_count: typing.Optional[int] = None,
+) -> typing.List[typing.List[str]]:
+    '''
+    Batch the tickers with a new session to fetch, all the given `tickers`
+    (or all the tickers of the config) when forced, only the ones of the
+    shard.
+    '''
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+    from utils.sharding import get_shard
+
+    quandl_daily = QuandlPremium(shard=get_shard(index=shard_index, count=shard_count))
+    if tickers:
+        quandl_daily.tickers = [ticker for ticker in quandl_daily.tickers if ticker in tickers]
+
+    due_tickers: typing.List[str] = quandl_daily.tickers if force else quandl_daily.get_due_tickers()
+    quandl_daily.slack.send(f'Start Quandl daily - due tickers: {len(due_tickers)}/{len(quandl_daily.tickers)}')
+    quandl_daily.prepare()
+
+    return quandl_daily.get_ticker_batches(due_tickers)
+
+
+@task(max_retries=2, retry_delay=timedelta(minutes=1), checkpoint=False)
+def fetch_quandl_batch(tickers: typing.List[str]) -> typing.Dict[str, pd.DataFrame]:
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+
+    quandl_daily = QuandlPremium()
+    return quandl_daily.fetch_batch(tickers)
+
+
+@task(max_retries=2, retry_delay=timedelta(seconds=30), checkpoint=False)
+def merge_quandl_batch(downloaded_data: typing.Dict[str, pd.DataFrame]) -> typing.Dict[str, pd.DataFrame]:
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+
+    quandl_daily = QuandlPremium()
+    return quandl_daily.merge_batch(downloaded_data)
+
+
+@task(max_retries=2, retry_delay=timedelta(seconds=30), checkpoint=False)
+def upload_quandl_batch(merged_data: typing.Dict[str, pd.DataFrame]) -> typing.Dict[str, typing.Any]:
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+
+    quandl_daily = QuandlPremium()
+    return quandl_daily.upload_batch(merged_data)
+
+
+@task(max_retries=2, retry_delay=timedelta(seconds=30), checkpoint=False)
+def compact_quandl_batch(report: typing.Dict[str, typing.Any]) -> typing.List[str]:
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+
+    quandl_daily = QuandlPremium()
+    return quandl_daily.compact_batch(report['tickers'])
+
+
+@task(trigger=all_finished)
+def finish_quandl_daily(
+    batches: typing.List[typing.List[str]],
+    uploaded: typing.List[typing.Any],
+    shard_index: typing.Optional[int] = None,
+    shard_count: typing.Optional[int] = None,
+) -> None:
+    from tasks.data_fetching.quandl_daily import QuandlPremium
+    from utils.sharding import get_shard
+
+    logger = prefect.context.get('logger')
+    quandl_daily = QuandlPremium(shard=get_shard(index=shard_index, count=shard_count))
+    tickers: typing.List[str] = [ticker for batch in batches for ticker in batch]
+
+    # Failed batches come through as exceptions instead of upload reports.
+    reports: typing.List[typing.Dict[str, typing.Any]] = [report for report in uploaded if isinstance(report, dict)]
+    uploaded_tickers: typing.Set[str] = set(ticker for report in reports for ticker in report['tickers'])
+    # The unchanged tickers are only in the registry.
+    fetched_tickers: typing.Set[str] = set(quandl_daily.get_fetched_tickers())
+    unchanged_tickers: typing.Set[str] = fetched_tickers - uploaded_tickers
+    failed_tickers: typing.List[str] = [
+        ticker for ticker in tickers
+        if ticker not in uploaded_tickers and ticker not in unchanged_tickers
+    ]
+    bytes_uploaded: int = sum(report['bytes_uploaded'] for report in reports)
+    bytes_skipped: int = sum(report['bytes_skipped'] for report in reports)
+
+    logger.info(f'Failed Tickers: {failed_tickers}')
+    quandl_daily.slack.send(
+        message=f'Task finished! Updated: {len(uploaded_tickers)} - Unchanged: {len(unchanged_tickers)} - '
+                f'Failed: {failed_tickers} - '
+                f'Uploaded {bytes_uploaded / 2 ** 20:.1f} MiB, {bytes_skipped / 2 ** 20:.1f} MiB unchanged'
+    )
+
+
+# QuanDL combine raw.
+
+@task
+def run_quandl_combine_raw() -> None:
+    from tasks.data_fetching.quandl_combine_raw import QuandlCombineRawTickers
+
+    handler = QuandlCombineRawTickers()
+    handler.run()
+
+
+@task(trigger=all_finished, checkpoint=False)
+def combine_quandl_raw(merged_batches: typing.List[typing.Any]) -> pd.DataFrame:
+    '''
+    Combine the merged batches of the QuanDL daily tasks, the failed batches
+    come through as exceptions and their tickers are read from Storage.
+    '''
+    from tasks.data_fetching.quandl_combine_raw import QuandlCombineRawTickers
+
+    latest_data: typing.Dict[str, pd.DataFrame] = {}
+    for merged_data in merged_batches or []:
+        if isinstance(merged_data, dict):
+            latest_data.update(merged_data)
+
+    handler = QuandlCombineRawTickers()
+    return handler.combine(latest_data=latest_data)
+
+
+# QuanDL preprocessing.
+
+@task
+def run_quandl_preprocessing() -> None:
+    from tasks.preprocessing.quandl_preprocessing import QuandlPreprocessing
+
+    handler = QuandlPreprocessing()
+    handler.run()
+
+
+@task(checkpoint=False)
+def preprocess_quandl_raw(quandl_raw: pd.DataFrame) -> typing.Optional[pd.DataFrame]:
+    from tasks.preprocessing.quandl_preprocessing import QuandlPreprocessing
+
+    handler = QuandlPreprocessing()
+    return handler.process(quandl_raw=quandl_raw)
+
+
+# FRED download.
+
+# A retry of the same flow run resumes from the checkpoints of the codes done so far.
+@task(max_retries=2, retry_delay=timedelta(minutes=5))
+def run_download_fred(shard_index: typing.Optional[int] = None, shard_count: typing.Optional[int] = None) -> None:
+    from tasks.data_fetching.fred_download import DownloadFredData
+    from utils.sharding import get_shard
+
+    fred = DownloadFredData(shard=get_shard(index=shard_index, count=shard_count))
+    fred.run()
+
+
+@task(max_retries=2, retry_delay=timedelta(minutes=5), checkpoint=False)
+def download_fred() -> pd.DataFrame:
+    from tasks.data_fetching.fred_download import DownloadFredData
+
+    fred = DownloadFredData()
+    return fred.run()
+
+
+# FRED preprocessing.
+
+@task
+def run_preprocess_fred() -> None:
+    from tasks.preprocessing.fred_preprocessing import PreprocessingFredData
+
+    p = PreprocessingFredData()
+    p.run()
+
+
+@task(checkpoint=False)
+def preprocess_fred(fred_raw_df: pd.DataFrame) -> pd.DataFrame:
+    from tasks.preprocessing.fred_preprocessing import PreprocessingFredData
+
+    p = PreprocessingFredData()
+    return p.run(fred_raw_df=fred_raw_df)
+
+
+# Feature store.
+
+@task
+def update_features(full: bool = False, verify: bool = False) -> typing.Dict[str, int]:
+    from tasks.feature_engineering.feature_store import RollingFeatureStore
+
+    store = RollingFeatureStore()
+    return store.run(full=full, verify=verify)
@@ -5,15 +5,18 @@ from __future__ import absolute_import
 
 import os
 import typing
+import multiprocessing
 import configparser
+from concurrent.futures import ProcessPoolExecutor
 
 import prefect
 import pandas as pd
-from prefect import task
 
 from tasks.base import BaseHandler
-from utils.storages import GoogleCloudStorage
+from utils.storages import get_storage
+from utils.arrow_io import read_ipc, write_ipc
 from utils.slackbot import Slack
+from utils.validation import FRED_RAW_SCHEMA, QualityReport, validate
 
 
 logger = prefect.context.get('logger')
@@ -28,6 +31,7 @@ class PreprocessingFredDataConfig:
     proxy_min_factor: float
     proxy_min_days: int
     update_realtime_proxy: bool
+    processes: int
 
     def __init__(self):
         self.fields: typing.Dict[str, typing.Any] = {
@@ -37,6 +41,7 @@ class PreprocessingFredDataConfig:
             'filter_before_date': str,
             'proxy_min_factor': float,
             'proxy_min_days': int,
+            'processes': int,
         }
         self.__read_from_config_file()
 
@@ -80,7 +85,7 @@ class PreprocessingFredData(BaseHandler):
         self.config = PreprocessingFredDataConfig()
 
         # Create storage.
-        self.storage = GoogleCloudStorage(bucket_name=os.getenv('BUCKET_NAME'))
+        self.storage = get_storage(bucket_name=os.getenv('BUCKET_NAME'))
 
         # Create Slack instace to send messages.
         self.slack = Slack(title='Fred Preprocessing')
@@ -107,6 +112,79 @@ class PreprocessingFredData(BaseHandler):
         fred_raw_df: pd.DataFrame
     ) -> pd.DataFrame:
         """
+        Process the codes, in shards over a pool of processes when
+        `processes` is more than 1 (0 for one by core), then pivot them
+        together.
+        """
+        processes: int = self.config.processes or os.cpu_count() or 1
+
+        if processes > 1 and fred_raw_df['code'].nunique() > 1:
+            fred_processed_df: pd.DataFrame = self.__process_shards(fred_raw_df, processes=processes)
+        else:
+            fred_processed_df = self.process_codes(fred_raw_df, config=self.config)
+
+        # For each fred_processed_dfing date create a dataframe with 'up to date' data
+        #  based on realtime_start proxy and last_time_index
+        fred_processed_df = fred_processed_df.pivot_table(
+            index='realtime_start_est',
+            columns='code',
+            values=['diffed_value', 'value']
+        )
+
+        return fred_processed_df
+
+    def __process_shards(self, fred_raw_df: pd.DataFrame, processes: int) -> pd.DataFrame:
+        """
+        Split the codes in shards of about the same rows, the shards are
+        handed to the processes as Arrow IPC files, which they memory-map.
+        """
+        shards_path: str = os.path.join('data', 'fred', 'preprocess_shards')
+        self.remove_previous(shards_path)
+        self.create_folder(shards_path)
+
+        # The largest codes first, each to the smallest shard so far.
+        code_rows: pd.Series = fred_raw_df['code'].value_counts()
+        shard_rows: typing.List[int] = [0] * min(processes, len(code_rows))
+        shard_codes: typing.List[typing.List[str]] = [[] for _ in shard_rows]
+        for code, rows in code_rows.items():
+            shard: int = shard_rows.index(min(shard_rows))
+            shard_codes[shard].append(code)
+            shard_rows[shard] += rows
+
+        shard_files: typing.List[typing.Tuple[str, str]] = []
+        for shard, codes in enumerate(shard_codes):
+            source_file: str = os.path.join(shards_path, f'{shard}.arrow')
+            shard_df: pd.DataFrame = fred_raw_df[fred_raw_df['code'].isin(codes)].reset_index(drop=True)
+            # The values are made numbers in step 4 anyway, an Arrow column has one type.
+            shard_df['value'] = pd.to_numeric(shard_df['value'], errors='coerce')
+            write_ipc(shard_df, source_file)
+            shard_files.append((source_file, os.path.join(shards_path, f'{shard}.processed.arrow')))
+
+        logger.info(f'Processing {len(code_rows)} codes in {len(shard_files)} shards')
+
+        # Spawned, a fork of the threads of the flow could deadlock.
+        with ProcessPoolExecutor(
+            max_workers=len(shard_files),
+            mp_context=multiprocessing.get_context('spawn'),
+        ) as executor:
+            list(executor.map(_process_shard, *zip(*shard_files)))
+
+        fred_processed_df: pd.DataFrame = pd.concat(
+            [read_ipc(destination_file) for _, destination_file in shard_files],
+            ignore_index=True,
+        )
+        self.remove_previous(shards_path)
+
+        return fred_processed_df
+
+    @staticmethod
+    def process_codes(
+        fred_raw_df: pd.DataFrame,
+        config: PreprocessingFredDataConfig,
+    ) -> pd.DataFrame:
+        """
+        Every step is by code, the codes can be processed apart.
+
         1. Filter out certain data:
             A. data with date before 1990
             B. data that was discontinued
@@ -114,6 +192,7 @@ class PreprocessingFredData(BaseHandler):
         Also create last_time_proxy when another datapoint takes precedence
         3. Filter out anything except first report
         4. diff everything by code
+        Return the long data, before the pivot.
         """
         logger.info('Start filter by date')
         logger.info(f'fred_raw_df: {fred_raw_df.shape}')
@@ -125,27 +204,27 @@ class PreprocessingFredData(BaseHandler):
 
         # filter out data that doesn't start before cutoff date
         min_dates = fred_raw_df.groupby('code')['date'].min()
-        mask = min_dates < self.config.first_date
+        mask = min_dates < config.first_date
         logger.info(
             f'{mask.sum()} started before '
-            f'{self.config.first_date} {(~mask).sum()} started after'
+            f'{config.first_date} {(~mask).sum()} started after'
         )
         min_date_codes = min_dates[mask].index
         fred_processed_df: pd.DataFrame = fred_raw_df[fred_raw_df.code.isin(min_date_codes)]
 
         # filter out data before cutoff date
-        mask = fred_processed_df['date'] >= self.config.filter_before_date
+        mask = fred_processed_df['date'] >= config.filter_before_date
         logger.info(
             f'filtering out {(~mask).sum()} '
             'records before filter_before_date, keeping '
             f'{mask.sum()} after'
         )
-        fred_processed_df = fred_processed_df[fred_processed_df['date'] >= self.config.first_date]
+        fred_processed_df = fred_processed_df[fred_processed_df['date'] >= config.first_date]
         logger.info(f'fred_processed_df data shape: {fred_processed_df.shape}')
 
         # 1.B filter discontinued data
         max_dates = fred_raw_df.groupby('code')['realtime_start'].max()
-        mask = max_dates > self.config.recent_date
+        mask = max_dates > config.recent_date
         logger.info(
             f'{mask.sum()} had realtime_start after'
             f'recent_date {(~mask).sum()} ended before'
@@ -170,12 +249,15 @@ class PreprocessingFredData(BaseHandler):
 
         # 3. filter out all except first reported
         fred_processed_df = fred_processed_df[fred_processed_df['first_reported']]
-        days_to_report_proxies: pd.DataFrame = self.__get_days_to_report_proxies(fred_processed_df=fred_processed_df)
+        days_to_report_proxies: pd.DataFrame = PreprocessingFredData.get_days_to_report_proxies(
+            fred_processed_df=fred_processed_df,
+            config=config,
+        )
 
         # Map report proxy by code.
         fred_processed_df['days_to_report_proxy'] = fred_processed_df.code.map(days_to_report_proxies)
-        min_factor = self.config.proxy_min_factor
-        min_days = self.config.proxy_min_days
+        min_factor = config.proxy_min_factor
+        min_days = config.proxy_min_days
         mask = (
             fred_processed_df['days_to_report'] >
             (fred_processed_df['days_to_report_proxy'] * min_factor + min_days)
@@ -199,18 +281,14 @@ class PreprocessingFredData(BaseHandler):
         # ceiling the realtime_start_est
         fred_processed_df['realtime_start_est'] = fred_processed_df['realtime_start_est'].dt.ceil('D')
 
-        # For each fred_processed_dfing date create a dataframe with 'up to date' data
-        #  based on realtime_start proxy and last_time_index
-        fred_processed_df = fred_processed_df.pivot_table(
-            index='realtime_start_est',
-            columns='code',
-            values=['diffed_value', 'value']
-        )
-
         return fred_processed_df
 
-    def __get_days_to_report_proxies(self, fred_processed_df: pd.DataFrame) -> pd.DataFrame:
-        mask = (fred_processed_df['date'] > self.config.recent_date)
+    @staticmethod
+    def get_days_to_report_proxies(
+        fred_processed_df: pd.DataFrame,
+        config: PreprocessingFredDataConfig,
+    ) -> pd.DataFrame:
+        mask = (fred_processed_df['date'] > config.recent_date)
         days_to_report_proxies: pd.DataFrame = fred_processed_df[mask] \
             .groupby('code')['days_to_report'].quantile(.75)
 
@@ -230,18 +308,35 @@ class PreprocessingFredData(BaseHandler):
             destination_blob=blob_file,
         )
 
-    def run(self) -> None:
+    def run(self, fred_raw_df: typing.Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """
+        Preprocess the FRED data, it is downloaded from Storage when not given.
+        """
         logger.info('Start FRED preprocessing')
-        fred_raw_df: pd.DataFrame = self.__load_fred_raw()
+        if fred_raw_df is None:
+            fred_raw_df = self.__load_fred_raw()
+
+        report: QualityReport = validate(df=fred_raw_df, schema=FRED_RAW_SCHEMA)
+        logger.info(report.summary())
+        report.raise_for_errors()
+
         fred_processed_df: pd.DataFrame = self.__process(fred_raw_df)
 
         logger.info('Finished processing')
         logger.info(f'fred_processed_df: {fred_processed_df.shape}')
 
         self.__upload_processed_data(fred_processed_df)
+        logger.info(self.storage.get_transfer_report())
+
+        return fred_processed_df
 
 
-@task
-def run_preprocess_fred():
-    p = PreprocessingFredData()
-    p.run()
+def _process_shard(source_file: str, destination_file: str) -> None:
+    """
+    Process a shard of codes in a worker process.
+    """
+    fred_processed_df: pd.DataFrame = PreprocessingFredData.process_codes(
+        read_ipc(source_file),
+        config=PreprocessingFredDataConfig(),
+    )
+    write_ipc(fred_processed_df, destination_file)
@@ -8,13 +8,19 @@ import typing
 import configparser
 
 import prefect
-from prefect import task
 import pandas as pd
 
 
 from tasks.base import BaseHandler
-from utils.storages import GoogleCloudStorage
+from utils.storages import get_storage
+from utils.archives import ContentAddressedArchive
+from utils.arrow_io import get_intermediate_format, download_ipc, write_ipc
+from utils.aggregates import Aggregate, compute_aggregate, read_aggregates
+from utils.datasets import AGGREGATES_PREFIX, archive_partitions, publish_quandl_processed
+from utils.pipeline import Pipeline, read_pipeline
+from utils.registry import Registry, get_config_hash, get_now
 from utils.slackbot import Slack
+from utils.validation import QualityReport
 
 
 logger = prefect.context.get('logger')
@@ -32,9 +38,25 @@ class QuandlPreprocessing(BaseHandler):
         self.config: configparser.ConfigParser = self.get_config()
 
         self.tickers: typing.List[str] = self.config['quandl']['tickers'].split('\n')
+        # The steps from the raw to the processed data, see `utils.pipeline`.
+        self.pipeline: Pipeline = read_pipeline(self.config)
+        self.aggregates: typing.List[Aggregate] = read_aggregates(self.config)
+        # A change of the steps redoes the processing of unchanged raw data.
+        self.config_hash: str = get_config_hash(self.config, prefixes=['pipeline', 'aggregate.'])
 
         # Create storage.
-        self.storage = GoogleCloudStorage(bucket_name=os.getenv('BUCKET_NAME'))
+        self.storage = get_storage(
+            bucket_name=os.getenv('BUCKET_NAME'),
+            config=self.get_config_key(self.config, 'storage', None),
+        )
+        self.archive = ContentAddressedArchive(
+            storage=self.storage,
+            root='shared/data/quandl/archives',
+            writer='quandl_preprocessing',
+        )
+        self.registry = Registry(storage=self.storage)
+
+        self.intermediate_format: str = get_intermediate_format(self.get_config_key(self.config, 'storage', None))
 
         # Create Slack instace to send messages.
         self.slack = Slack(title='Quandl Preprocessing')
@@ -42,13 +64,9 @@ class QuandlPreprocessing(BaseHandler):
         self.__pre_start()
 
     def __pre_start(self) -> None:
-        self.remove_previous()
-
         self.create_folder(os.path.join('data'))
         self.create_folder(os.path.join('data', 'quandl'))
 
-        self.__download_previous_quandl_latest()
-
     def __download_previous_quandl_latest(self) -> str:
         quandl_latest_blob: str = 'shared/data/quandl/raw.pickle'
         quandl_raw_path: str = os.path.join(
@@ -60,115 +78,144 @@ class QuandlPreprocessing(BaseHandler):
 
         return quandl_raw_path
 
-    def __load_quandl_raw(self, quandl_raw_path: str) -> typing.Optional[pd.DataFrame]:
-        quandl_raw: pd.DataFrame
+    def __load_quandl_raw(self) -> typing.Optional[pd.DataFrame]:
+        quandl_raw: typing.Optional[pd.DataFrame] = None
 
         try:
-            quandl_raw = pd.read_pickle(quandl_raw_path)
+            if self.intermediate_format == 'arrow':
+                # Memory-mapped from the local cache, nothing to unpickle.
+                quandl_raw = download_ipc(
+                    storage=self.storage,
+                    blob_name='shared/data/quandl/raw.arrow',
+                    columns=self.pipeline.get_load_columns(),
+                )
+            else:
+                quandl_raw = pd.read_pickle(self.__download_previous_quandl_latest())
         except Exception as ex:
             logger.error('Unable to load QuanDL raw.')
             logger.error(ex)
 
         return quandl_raw
 
-    @staticmethod
-    def __create_new_columns(quandl_df: pd.DataFrame) -> pd.DataFrame:
-        logger.info('Adding new columns')
+    def __get_raw_items(self) -> typing.Dict[str, str]:
+        '''
+        The hashes of the tickers in the last raw data, from the registry.
+        '''
+        combined: typing.Dict[str, typing.Any] = self.registry.get('stages', 'quandl_combine_raw') or {}
 
-        # Create year column.
-        quandl_df['year'] = quandl_df['date'].dt.year
+        return combined.get('items', {})
 
-        # Create ticker column.
-        quandl_df['ticker'] = quandl_df['exchange'] \
-            + '_' \
-            + quandl_df['symbol'] \
-            + quandl_df['depth'].astype(str) \
-            + '_' \
-            + quandl_df['method']
+    def __is_raw_unchanged(self, raw_items: typing.Dict[str, str]) -> bool:
+        processed: typing.Dict[str, typing.Any] = self.registry.get('stages', 'quandl_preprocessing') or {}
 
-        return quandl_df
+        return bool(raw_items) and processed.get('items') == raw_items \
+            and processed.get('config') == self.config_hash
 
-    @staticmethod
-    def __verify_data(quandl_df: pd.DataFrame):
+    def __validate(self, quandl_df: pd.DataFrame) -> typing.Optional[QualityReport]:
         logger.info('Verify QuanDL premium data.')
-        columns = [
-            'exchange',
-            'symbol',
-            'depth',
-            'method',
-            'date',
-            'open',
-            'high',
-            'low',
-            'settle',
-            'volume',
-            'prev_day_open_interest',
-            'year',
-            'ticker',
-        ]
-        if set(quandl_df.columns) != set(columns):
-            logger.error(quandl_df.columns)
-            raise Exception('Missing some columns.')
-
-    @staticmethod
-    def __check_missing_data(data: pd.DataFrame):
-        """
-        We expected there is no NaN values on premium data.
-        """
-        logger.debug('Check missing data of QuanDL premium.')
-        if data.isna().any().any():
-            raise Exception('There is NaN value in data.')
-
-    def __remove_unused_comlumns(self, quandl_df: pd.DataFrame) -> pd.DataFrame:
-        unused_columns: typing.List[str] = self.config['quandl']['unused_columns'].split('\n')
-        logger.info(f'Remove unused columns: {unused_columns}')
+        report: typing.Optional[QualityReport] = self.pipeline.check(quandl_df)
+        if report is not None:
+            logger.info(report.summary())
+            report.raise_for_errors()
 
-        quandl_df = quandl_df.drop(unused_columns, axis=1)
-
-        return quandl_df
+        return report
 
     def __upload_quandl_processed(self, quandl_df: pd.DataFrame):
         logger.info(f'Upload Quandl processed - shape: {quandl_df.shape}')
 
-        today: str = self.get_today()
         local_path: str = os.path.join(
             'data',
             'quandl',
             'processed.pickle',
         )
         latest_blob: str = 'shared/data/quandl/processed.pickle'
-        historical_blob: str = f'shared/data/quandl/archives/{today}/processed.pickle'
 
         # Save file to disk.
         quandl_df.to_pickle(local_path)
 
         # Upload to Storage.
         self.storage.upload_a_file(local_path, latest_blob)
-        self.storage.upload_a_file(local_path, historical_blob)
+        if self.intermediate_format == 'arrow':
+            arrow_path: str = os.path.join('data', 'quandl', 'processed.arrow')
+            write_ipc(quandl_df, arrow_path)
+            self.storage.upload_a_file(arrow_path, 'shared/data/quandl/processed.arrow')
+        self.archive.add(local_file=local_path, name='processed.pickle')
+        # By ticker too, for the readers which only need a few of them.
+        partitions_folder: str = os.path.join('data', 'quandl', 'partitions')
+        archive_partitions(
+            archive=self.archive,
+            dataset_name='quandl_processed',
+            df=quandl_df,
+            local_folder=partitions_folder,
+        )
+        publish_quandl_processed(storage=self.storage, df=quandl_df, local_folder=partitions_folder)
 
-    def run(self) -> None:
+    def __upload_quandl_aggregates(self, quandl_df: pd.DataFrame) -> None:
+        """
+        Compute the aggregates of the config and store them next to the
+        processed data, in `aggregates/{name}.pickle`, archived the same way.
+        """
+        aggregates_folder: str = os.path.join('data', 'quandl', 'aggregates')
+        self.create_folder(aggregates_folder)
+
+        for aggregate in self.aggregates:
+            aggregate_df: pd.DataFrame = compute_aggregate(df=quandl_df, aggregate=aggregate)
+            logger.info(f'Upload Quandl aggregate {aggregate.name} - shape: {aggregate_df.shape}')
+
+            local_path: str = os.path.join(aggregates_folder, f'{aggregate.name}.pickle')
+            aggregate_df.to_pickle(local_path)
+
+            self.storage.upload_a_file(local_path, f'shared/data/quandl/aggregates/{aggregate.name}.pickle')
+            if self.intermediate_format == 'arrow':
+                arrow_path: str = os.path.join(aggregates_folder, f'{aggregate.name}.arrow')
+                write_ipc(aggregate_df, arrow_path)
+                self.storage.upload_a_file(arrow_path, f'shared/data/quandl/aggregates/{aggregate.name}.arrow')
+            self.archive.add(local_file=local_path, name=f'aggregates/{aggregate.name}.pickle')
+            archive_partitions(
+                archive=self.archive,
+                dataset_name=f'{AGGREGATES_PREFIX}{aggregate.name}',
+                df=aggregate_df,
+                local_folder=os.path.join(aggregates_folder, aggregate.name),
+            )
+
+    def process(self, quandl_raw: typing.Optional[pd.DataFrame] = None) -> typing.Optional[pd.DataFrame]:
+        '''
+        Preprocess the raw QuanDL data, it is downloaded from Storage when not given.
+        Nothing is done when the raw data didn't change since the last run.
+        '''
         self.slack.send('Start')
 
-        quandl_df: pd.DataFrame
+        quandl_df: typing.Optional[pd.DataFrame] = None
         is_success: bool = True
 
-        quandl_raw_path = self.__download_previous_quandl_latest()
-        quandl_raw: typing.Optional[pd.DataFrame] = self.__load_quandl_raw(quandl_raw_path)
+        raw_items: typing.Dict[str, str] = self.__get_raw_items()
+        if self.__is_raw_unchanged(raw_items):
+            logger.info('Unchanged QuanDL raw, the processed data is up to date.')
+            self.slack.send('Finished - Unchanged')
+            return None
+
+        if quandl_raw is None:
+            quandl_raw = self.__load_quandl_raw()
 
         if quandl_raw is not None:
             logger.info(f'Quandl raw - shape: {quandl_raw.shape}')
-            quandl_df = self.__remove_unused_comlumns(quandl_raw)
-            quandl_df = self.__create_new_columns(quandl_df)
-            self.__verify_data(quandl_df)
-            self.__check_missing_data(quandl_df)
+            quandl_df = self.pipeline.run(quandl_raw)
+            self.__validate(quandl_df)
             self.__upload_quandl_processed(quandl_df)
+            self.__upload_quandl_aggregates(quandl_df)
+            # One version of the processed data and of its aggregates.
+            self.archive.commit(day=self.get_today())
+            self.registry.update('stages', {'quandl_preprocessing': {
+                'items': raw_items,
+                'config': self.config_hash,
+                'finished_at': get_now(),
+            }})
         else:
             is_success = False
 
-        self.slack.send(f'Finished - Success: {str(is_success)}')
+        self.slack.send(f'Finished - Success: {str(is_success)} - {self.storage.get_transfer_report()}')
 
+        return quandl_df
 
-@task
-def run_quandl_preprocessing() -> None:
-    handler = QuandlPreprocessing()
-    handler.run()
+    def run(self) -> None:
+        self.process()
@@ -0,0 +1,31 @@
+import os
+import uuid
+
+from utils.archives import ContentAddressedArchive
+from utils.storages import InMemoryStorage
+
+
+def archive_text(archive: ContentAddressedArchive, folder: str, name: str, text: str, day: str) -> str:
+    local_file: str = os.path.join(folder, f'{uuid.uuid4().hex}.txt')
+    with open(local_file, 'w') as f:
+        f.write(text)
+
+    content_hash: str = archive.add(local_file=local_file, name=name)
+    archive.commit(day=day)
+
+    return content_hash
+
+
+def test_resolve_as_of(tmp_path):
+    archive = ContentAddressedArchive(storage=InMemoryStorage(bucket_name=uuid.uuid4().hex), root='archives')
+    first = archive_text(archive, str(tmp_path), 'raw.pickle', 'first', day='2024-01-02')
+    second = archive_text(archive, str(tmp_path), 'raw.pickle', 'second', day='2024-01-04')
+    archive_text(archive, str(tmp_path), 'other.pickle', 'other', day='2024-01-05')
+
+    assert archive.resolve('raw.pickle', as_of='2024-01-01') is None
+    assert archive.resolve('raw.pickle', as_of='2024-01-02') == ('2024-01-02', {'hash': first, 'size': 5})
+    assert archive.resolve('raw.pickle', as_of='2024-01-03')[0] == '2024-01-02'
+    assert archive.resolve('raw.pickle', as_of='2024-01-04')[1]['hash'] == second
+    assert archive.resolve('raw.pickle') == ('2024-01-04', {'hash': second, 'size': 6})
+    assert archive.resolve('missing.pickle') is None
+
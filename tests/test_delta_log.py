@@ -0,0 +1,76 @@
+import os
+import uuid
+
+import pandas as pd
+
+from utils.delta_log import DeltaLog
+from utils.storages import InMemoryStorage
+
+
+def get_delta_log() -> DeltaLog:
+    return DeltaLog(
+        storage=InMemoryStorage(bucket_name=uuid.uuid4().hex),
+        base_root='latest',
+        delta_root='deltas',
+        key_columns=['quandl_code', 'date'],
+    )
+
+
+def write(delta_log: DeltaLog, df: pd.DataFrame, folder: str, base: bool = False) -> None:
+    local_file: str = os.path.join(folder, f'{uuid.uuid4().hex}.pkl')
+    df.to_pickle(local_file)
+
+    if base:
+        delta_log.write_base('CME_CL1', local_file=local_file)
+    else:
+        delta_log.append('CME_CL1', local_file=local_file)
+
+
+def get_rows(dates: str, settles: list) -> pd.DataFrame:
+    return pd.DataFrame({
+        'quandl_code': 'CL1_EN',
+        'date': pd.to_datetime(dates.split()),
+        'settle': settles,
+    })
+
+
+def test_revised_row_newest_wins(tmp_path):
+    delta_log = get_delta_log()
+    write(delta_log, get_rows('2024-01-02 2024-01-03', [70.0, 71.0]), str(tmp_path), base=True)
+    write(delta_log, get_rows('2024-01-03 2024-01-04', [71.5, 72.0]), str(tmp_path))
+    write(delta_log, get_rows('2024-01-04', [72.5]), str(tmp_path))
+
+    df = delta_log.load('CME_CL1').sort_values('date').reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(df, get_rows('2024-01-02 2024-01-03 2024-01-04', [70.0, 71.5, 72.5]))
+
+
+def test_compact_keeps_the_revision(tmp_path):
+    delta_log = get_delta_log()
+    write(delta_log, get_rows('2024-01-02 2024-01-03', [70.0, 71.0]), str(tmp_path), base=True)
+    write(delta_log, get_rows('2024-01-03', [71.5]), str(tmp_path))
+
+    assert delta_log.compact('CME_CL1')
+    assert delta_log.list_segments('CME_CL1') == []
+
+    df = delta_log.load('CME_CL1').sort_values('date').reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(df, get_rows('2024-01-02 2024-01-03', [70.0, 71.5]))
+
+
+def test_without_key_columns_only_copies_are_dropped(tmp_path):
+    delta_log = get_delta_log()
+    delta_log.key_columns = None
+    write(delta_log, get_rows('2024-01-02 2024-01-03', [70.0, 71.0]), str(tmp_path), base=True)
+    write(delta_log, get_rows('2024-01-03', [71.0]), str(tmp_path))
+
+    assert len(delta_log.load('CME_CL1')) == 2
+
+
+def test_new_rows_ignore_a_dtype_change():
+    previous = get_rows('2024-01-02 2024-01-03', [70, 71])
+    data = get_rows('2024-01-02 2024-01-03 2024-01-04', [70.0, 71.0, 72.0])
+
+    new_rows = DeltaLog.get_new_rows(data=data, previous=previous).reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(new_rows, get_rows('2024-01-04', [72]))
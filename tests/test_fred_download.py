@@ -0,0 +1,85 @@
+import uuid
+import configparser
+
+import pandas as pd
+
+from tasks.data_fetching.fred_download import DownloadFredData
+from utils.archives import ContentAddressedArchive
+from utils.datasets import load_dataset
+from utils.memory import MemoryBudget
+from utils.rate_limiter import UnlimitedRateLimiter
+from utils.registry import Registry
+from utils.sharding import Shard, ShardReports
+from utils.storages import BaseStorage, InMemoryStorage
+from utils.validation import FRED_INFO_COLUMNS
+
+
+CODES = ['GDP', 'UNRATE', 'CPIAUCSL', 'FEDFUNDS', 'DGS10']
+
+
+class OfflineSlack:
+    def send(self, message: str) -> None:
+        pass
+
+
+class OfflineFred:
+    def get_series_info(self, code: str) -> pd.Series:
+        return pd.Series({column: code if column == 'id' else 'x' for column in FRED_INFO_COLUMNS}, name=code)
+
+    def get_series_all_releases(self, code: str, realtime_start=None, realtime_end=None) -> pd.DataFrame:
+        return get_releases(code)
+
+
+def get_releases(code: str) -> pd.DataFrame:
+    dates = pd.to_datetime(['2024-01-01', '2024-02-01'])
+
+    return pd.DataFrame({
+        'realtime_start': dates + pd.Timedelta(days=30),
+        'date': dates,
+        'value': [float(len(code)), float(len(code)) + 0.5],
+    })
+
+
+def get_handler(storage: BaseStorage, shard: Shard) -> DownloadFredData:
+    # Without `__init__`, which reads the config and connects to FRED and Slack.
+    handler = object.__new__(DownloadFredData)
+    handler.config = configparser.ConfigParser()
+    handler.config.read_dict({'default': {'end_date': '2024-03-01'}})
+    handler.fred = OfflineFred()
+    handler.rate_limiter = UnlimitedRateLimiter('fred')
+    handler.storage = storage
+    handler.archive = ContentAddressedArchive(
+        storage=storage,
+        root='shared/data/fred/archives',
+        writer='fred_download',
+    )
+    handler.registry = Registry(storage=storage)
+    handler.memory_budget = MemoryBudget(budget=2 ** 40)
+    handler.slack = OfflineSlack()
+    handler.all_fred_codes = CODES
+    handler.shard = shard
+    handler.fred_codes = shard.select(CODES)
+    handler.refresh = '2024-03-01'
+    handler.shard_reports = ShardReports(registry=handler.registry, job='fred_download', refresh=handler.refresh)
+    handler.run_id = f'test-{shard.name}'
+    handler.resume = False
+    handler.checkpoint_path = f'data/fred/checkpoints/{handler.run_id}'
+    handler.checkpoint_blob_prefix = f'shared/data/fred/checkpoints/{handler.run_id}/'
+
+    return handler
+
+
+def test_sharded_runs_archive_the_partitions_of_all_codes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage = InMemoryStorage(bucket_name=uuid.uuid4().hex)
+
+    for index in range(2):
+        get_handler(storage, Shard(index=index, count=2)).run()
+
+    expected = pd.concat([get_releases(code).assign(code=code) for code in CODES], ignore_index=True)
+    fred_df = load_dataset(name='fred', storage=storage).sort_values(['code', 'date']).reset_index(drop=True)
+    expected = expected.sort_values(['code', 'date']).reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(fred_df.astype({'value': float}), expected)
+    assert sorted(load_dataset(name='fred', tickers=['GDP', 'DGS10'], storage=storage)['code'].unique()) \
+        == ['DGS10', 'GDP']
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+
+from utils.pipeline import Expression
+
+
+@pytest.mark.parametrize('text', [
+    '__import__("os").system("ls")',
+    'settle.values',
+    'settle + 1',
+    'notna(settle=settle)',
+    '0 < settle < 1',
+    'lambda: 1',
+    'exit()',
+])
+def test_unsupported_expression_is_rejected(text):
+    with pytest.raises(Exception, match='Unsupported expression'):
+        Expression(text)
+
+
+def test_expression_of_the_functions():
+    expression = Expression("concat(exchange, '_', str(depth))")
+    columns = {'exchange': pd.Series(['CME', 'ICE']), 'depth': pd.Series([1, 2])}
+
+    assert expression.columns == ['exchange', 'depth']
+    assert expression.evaluate(columns).tolist() == ['CME_1', 'ICE_2']
@@ -0,0 +1,35 @@
+import pytest
+
+from utils.sharding import Shard, get_key_shard, get_shard
+
+
+KEYS = [f'CODE{i}' for i in range(200)]
+
+
+def test_assignment_is_stable():
+    # The same in every process: the shards of a refresh run on several agents.
+    assert [get_key_shard(key, count=4) for key in KEYS[:8]] == [2, 2, 3, 1, 3, 3, 1, 2]
+
+
+def test_shards_split_the_keys():
+    shards = [Shard(index=index, count=3).select(KEYS) for index in range(3)]
+
+    assert sorted(key for keys in shards for key in keys) == sorted(KEYS)
+    assert all(keys for keys in shards)
+
+
+def test_a_new_shard_only_takes_keys():
+    for key in KEYS:
+        shard = get_key_shard(key, count=4)
+        assert shard == get_key_shard(key, count=3) or shard == 3
+
+
+def test_shard_of_the_environment(monkeypatch):
+    monkeypatch.setenv('SHARD_INDEX', '1')
+    monkeypatch.setenv('SHARD_COUNT', '2')
+
+    assert get_shard() == Shard(index=1, count=2)
+    assert get_shard(index=0, count=1) == Shard()
+
+    with pytest.raises(Exception, match='Invalid shard'):
+        get_shard(index=2, count=2)
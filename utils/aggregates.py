@@ -0,0 +1,89 @@
+"""
+Aggregates of the processed QuanDL data, computed once by the preprocessing
+for the consumers which used to resample it on their own.
+
+Each `[aggregate.{name}]` section of the config is one dataset, by ticker:
+the bars of the `frequency` (`D` keeps the daily rows, otherwise a pandas
+period, e.g. `W-FRI` or `M`, labelled by the end of the period), the log
+returns of the settle and their rolling mean and standard deviation over
+each of the `windows`, in bars.
+"""
+import typing
+import configparser
+
+import numpy as np
+import pandas as pd
+
+from utils.frames import get_group_positions
+
+
+# How each column of the bars is aggregated, like `resample().ohlc()`.
+BAR_COLUMNS: typing.Dict[str, str] = {
+    'open': 'first',
+    'high': 'max',
+    'low': 'min',
+    'settle': 'last',
+    'volume': 'sum',
+    'prev_day_open_interest': 'last',
+}
+
+
+class Aggregate(typing.NamedTuple):
+    name: str
+    frequency: str
+    windows: typing.List[int]
+    price_column: str = 'settle'
+
+
+def read_aggregates(config: configparser.ConfigParser) -> typing.List[Aggregate]:
+    aggregates: typing.List[Aggregate] = []
+
+    for section in config.sections():
+        if not section.startswith('aggregate.'):
+            continue
+
+        windows: str = config.get(section, 'windows', fallback='')
+        aggregates.append(Aggregate(
+            name=section[len('aggregate.'):],
+            frequency=config.get(section, 'frequency'),
+            windows=[int(window) for window in windows.split('\n') if window.strip()],
+            price_column=config.get(section, 'price_column', fallback='settle'),
+        ))
+
+    return aggregates
+
+
+def compute_aggregate(df: pd.DataFrame, aggregate: Aggregate) -> pd.DataFrame:
+    """
+    Compute the aggregate of all the tickers at once, sorted by ticker and date.
+    """
+    bar_columns: typing.Dict[str, str] = {
+        column: how for column, how in BAR_COLUMNS.items() if column in df.columns
+    }
+    bars: pd.DataFrame = df[['ticker', 'date', *bar_columns]].sort_values(['ticker', 'date'], kind='stable')
+
+    if aggregate.frequency != 'D':
+        periods: pd.Series = bars['date'].dt.to_period(aggregate.frequency)
+        bars = bars.groupby([bars['ticker'], periods.rename('period')], sort=True).agg(bar_columns).reset_index()
+        bars.insert(1, 'date', bars.pop('period').dt.end_time.dt.normalize())
+
+    bars = bars.reset_index(drop=True)
+    positions: np.ndarray = get_group_positions(bars['ticker'].to_numpy())
+
+    prices: np.ndarray = bars[aggregate.price_column].to_numpy(dtype=np.float64)
+    log_prices: np.ndarray = np.full(len(prices), np.nan)
+    # No log return around negative or null prices (e.g. CL in April 2020).
+    np.log(prices, out=log_prices, where=prices > 0)
+
+    log_returns: np.ndarray = np.diff(log_prices, prepend=np.nan)
+    log_returns[positions == 0] = np.nan
+    bars['log_return'] = log_returns
+
+    returns: pd.Series = bars['log_return']
+    for window in aggregate.windows:
+        rolling = returns.rolling(window, min_periods=window)
+        spans_tickers: np.ndarray = positions < window - 1
+        bars[f'return_mean_{window}'] = rolling.mean().mask(spans_tickers)
+        bars[f'return_std_{window}'] = rolling.std().mask(spans_tickers)
+
+    return bars
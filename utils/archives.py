@@ -0,0 +1,174 @@
+import os
+import json
+import uuid
+import base64
+import typing
+import tempfile
+from datetime import datetime
+
+from utils.storages import BaseStorage, get_file_md5
+
+
+class ContentAddressedArchive:
+    """
+    A daily archive where every content is stored once, under its hash:
+
+        {root}/objects/{hash[:2]}/{hash}
+        {root}/manifests/{day}/{time}-{writer}-{id}.json
+
+    A manifest maps the logical names archived by one writer (e.g.
+    `raw.pickle` or `CME_CL1.pkl`) to their hash. Every writer adds its own
+    manifest, so parallel writers never overwrite each other, and the
+    manifests of a day are merged in the order they were written.
+    """
+
+    def __init__(self, storage: BaseStorage, root: str, writer: str = 'archive'):
+        self.storage: BaseStorage = storage
+        self.root: str = root.rstrip('/')
+        self.writer: str = writer
+        self.entries: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+        # The manifests read, by day, kept until the next commit.
+        self.manifests: typing.Dict[str, typing.Dict[str, typing.Dict[str, typing.Any]]] = {}
+        self.days: typing.Optional[typing.List[str]] = None
+
+    def get_object_blob(self, content_hash: str) -> str:
+        return f'{self.root}/objects/{content_hash[:2]}/{content_hash}'
+
+    def add(self, local_file: str, name: str) -> str:
+        """
+        Store the file content once and stage its name for the manifest.
+        """
+        content_hash: str = base64.b64decode(get_file_md5(local_file)).hex()
+        object_blob: str = self.get_object_blob(content_hash)
+        size: int = os.path.getsize(local_file)
+
+        if self.storage.is_file_exists(object_blob):
+            self.storage.bytes_skipped += size
+            self.storage.files_skipped += 1
+        else:
+            self.storage.upload_a_file(source_file=local_file, destination_blob=object_blob, skip_unchanged=False)
+
+        self.entries[name] = {'hash': content_hash, 'size': size}
+
+        return content_hash
+
+    def commit(self, day: str) -> typing.Optional[str]:
+        """
+        Write the manifest of the staged names for the day.
+        """
+        if not self.entries:
+            return None
+
+        time: str = datetime.now().strftime('%H%M%S')
+        manifest_blob: str = f'{self.root}/manifests/{day}/{time}-{self.writer}-{uuid.uuid4().hex[:8]}.json'
+
+        file_descriptor, local_file = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump(self.entries, f)
+            self.storage.upload_a_file(source_file=local_file, destination_blob=manifest_blob, skip_unchanged=False)
+        finally:
+            os.remove(local_file)
+
+        self.entries = {}
+        self.manifests.pop(day, None)
+        self.days = None
+
+        return manifest_blob
+
+    def list_days(self) -> typing.List[str]:
+        if self.days is None:
+            prefix: str = f'{self.root}/manifests/'
+            self.days = sorted(set(blob[len(prefix):].split('/', 1)[0] for blob in self.storage.list_files(prefix)))
+
+        return self.days
+
+    def load_manifest(self, day: str) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Return the names archived on the day, merged across its manifests.
+        """
+        if day in self.manifests:
+            return self.manifests[day]
+
+        manifest: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+        for manifest_blob in self.storage.list_files(f'{self.root}/manifests/{day}/'):
+            file_descriptor, local_file = tempfile.mkstemp(suffix='.json')
+            os.close(file_descriptor)
+            try:
+                self.storage.download_a_file(source_blob_name=manifest_blob, destination_file_name=local_file)
+                with open(local_file) as f:
+                    manifest.update(json.load(f))
+            finally:
+                os.remove(local_file)
+
+        self.manifests[day] = manifest
+
+        return manifest
+
+    def resolve(
+        self,
+        name: str,
+        as_of: typing.Optional[str] = None,
+    ) -> typing.Optional[typing.Tuple[str, typing.Dict[str, typing.Any]]]:
+        """
+        Return the day and the manifest entry of `name` as of a day
+        (YYYY-MM-DD, the latest when not given): its latest version
+        archived on that day or before.
+        """
+        return self.resolve_many(names=[name], as_of=as_of).get(name)
+
+    def resolve_many(
+        self,
+        names: typing.List[str],
+        as_of: typing.Optional[str] = None,
+    ) -> typing.Dict[str, typing.Tuple[str, typing.Dict[str, typing.Any]]]:
+        """
+        Resolve several names at once, the names not archived are left out.
+        """
+        missing: typing.Set[str] = set(names)
+        resolved: typing.Dict[str, typing.Tuple[str, typing.Dict[str, typing.Any]]] = {}
+
+        for day in reversed(self.list_days()):
+            if not missing:
+                break
+            if as_of is not None and day > as_of:
+                continue
+
+            manifest = self.load_manifest(day)
+            for name in missing & set(manifest):
+                resolved[name] = (day, manifest[name])
+            missing -= set(manifest)
+
+        return resolved
+
+    def download(
+        self,
+        name: str,
+        destination_file_name: str,
+        as_of: typing.Optional[str] = None,
+    ) -> str:
+        """
+        Download `name` as of a day, return the day of the version found.
+        Days archived before the manifests existed are read from their
+        `{root}/{day}/{name}` copy.
+        """
+        resolved = self.resolve(name=name, as_of=as_of)
+
+        if resolved is not None:
+            day, entry = resolved
+            self.storage.download_a_file(
+                source_blob_name=self.get_object_blob(entry['hash']),
+                destination_file_name=destination_file_name,
+            )
+            return day
+
+        if as_of is not None and self.storage.is_file_exists(f'{self.root}/{as_of}/{name}'):
+            self.storage.download_a_file(
+                source_blob_name=f'{self.root}/{as_of}/{name}',
+                destination_file_name=destination_file_name,
+            )
+            return as_of
+
+        raise Exception(f'Not archived: {name} as of {as_of}')
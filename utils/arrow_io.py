@@ -0,0 +1,176 @@
+"""
+Uncompressed Arrow IPC (Feather v2) files for the intermediate datasets.
+
+Unlike a pickle, an IPC file is read memory-mapped: the numeric and date
+columns are used in place, paged in from the file as they are touched, and
+the jobs of a host reading the same cached file share its page cache.
+"""
+import os
+import base64
+import typing
+import configparser
+
+import pandas as pd
+
+from utils.cache import download_cached
+from utils.storages import BaseStorage
+
+
+def get_intermediate_format(config: typing.Optional[configparser.SectionProxy] = None) -> str:
+    """
+    `pickle` (default) or `arrow`, from the `INTERMEDIATE_FORMAT` env variable
+    or `intermediate_format` in the `[storage]` section of the config.
+    """
+    intermediate_format: str = os.getenv('INTERMEDIATE_FORMAT', '') \
+        or (config.get('intermediate_format', '') if config else '') \
+        or 'pickle'
+
+    if intermediate_format not in ('pickle', 'arrow'):
+        raise Exception(f'Unknown intermediate format: {intermediate_format}')
+
+    return intermediate_format
+
+
+def write_ipc(df: pd.DataFrame, path: str) -> None:
+    import pyarrow.feather as feather
+
+    # One record batch: a column of several chunks is copied when read.
+    feather.write_feather(df, path, compression='uncompressed', chunksize=max(len(df), 1))
+
+
+def read_ipc(path: str, columns: typing.Optional[typing.List[str]] = None) -> pd.DataFrame:
+    """
+    Read an IPC file memory-mapped. Each column keeps its own block, so the
+    columns without nulls are not copied; strings are still materialized.
+    """
+    import pyarrow as pa
+
+    # The columns keep the file mapped for as long as they are alive.
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+    if columns is not None:
+        table = table.select(columns)
+
+    return table.to_pandas(split_blocks=True)
+
+
+def download_ipc(
+    storage: BaseStorage,
+    blob_name: str,
+    columns: typing.Optional[typing.List[str]] = None,
+) -> pd.DataFrame:
+    """
+    Read an IPC blob through the local cache, keyed by the blob hash.
+    """
+    remote_hash: typing.Optional[str] = storage.get_remote_hash(blob_name)
+    if remote_hash is None:
+        raise Exception(f'Blob not found: {blob_name}')
+
+    local_file: str = download_cached(
+        storage=storage,
+        blob_name=blob_name,
+        content_hash=base64.b64decode(remote_hash).hex(),
+        verify=True,
+    )
+    df: pd.DataFrame = read_ipc(local_file, columns=columns)
+
+    # A blob replaced since its hash was listed is not cached.
+    if os.path.basename(local_file).startswith('.download-'):
+        os.remove(local_file)
+
+    return df
+
+
+class IpcAppendStore:
+    """
+    An append-only IPC file on disk, one record batch per append, so a
+    dataset arriving piece by piece is not held in memory until the end.
+    The batches are keyed (e.g. by code) to be read back in any order.
+    """
+
+    def __init__(self, path: str, schema: typing.Any) -> None:
+        import pyarrow as pa
+
+        self.path: str = path
+        self.schema: pa.Schema = schema
+        self.batch_indexes: typing.Dict[str, typing.List[int]] = {}
+        self.batch_count: int = 0
+        self.writer: typing.Optional[pa.ipc.RecordBatchFileWriter] = pa.ipc.new_file(path, schema)
+
+    def __enter__(self) -> 'IpcAppendStore':
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.batch_indexes
+
+    def append(self, key: str, df: pd.DataFrame) -> None:
+        import pyarrow as pa
+
+        if self.writer is None:
+            raise Exception(f'Store is closed: {self.path}')
+
+        batch = pa.RecordBatch.from_pandas(df[self.schema.names], schema=self.schema, preserve_index=False)
+        self.writer.write_batch(batch)
+
+        self.batch_indexes.setdefault(key, []).append(self.batch_count)
+        self.batch_count += 1
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def read(
+        self,
+        keys: typing.Optional[typing.List[str]] = None,
+        spill_folder: typing.Optional[str] = None,
+        dtypes: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> pd.DataFrame:
+        """
+        Read the batches of the keys in their order (all of them, in the order
+        appended, by default), memory-mapped until converted. With
+        `spill_folder`, they are converted one by one into columns on disk
+        (see `utils.frames.allocate_column`), not all at once in memory.
+        The columns of `dtypes` are converted to these, e.g. `object`, batch
+        by batch too.
+        """
+        import numpy as np
+        import pyarrow as pa
+
+        from utils.frames import allocate_column
+
+        self.close()
+        reader = pa.ipc.open_file(pa.memory_map(self.path, 'r'))
+
+        indexes: typing.List[int] = list(range(self.batch_count)) if keys is None else [
+            index for key in keys for index in self.batch_indexes.get(key, [])
+        ]
+        batches: typing.List[pa.RecordBatch] = [reader.get_batch(index) for index in indexes]
+
+        column_dtypes: pd.Series = self.schema.empty_table().to_pandas().dtypes
+        if spill_folder is None or not all(isinstance(dtype, np.dtype) for dtype in column_dtypes):
+            return pa.Table.from_batches(batches, schema=self.schema).to_pandas().astype(dtypes or {})
+
+        # The integers with nulls are converted to floats.
+        for i, dtype in enumerate(column_dtypes):
+            if dtype.kind in 'iu' and any(batch.column(i).null_count for batch in batches):
+                column_dtypes.iat[i] = np.dtype(np.float64)
+        for name, dtype in (dtypes or {}).items():
+            column_dtypes[name] = np.dtype(dtype)
+
+        rows: int = sum(batch.num_rows for batch in batches)
+        arrays: typing.Dict[str, np.ndarray] = {
+            name: allocate_column(column_dtypes[name], rows, spill_folder=spill_folder) for name in self.schema.names
+        }
+        offset: int = 0
+
+        for batch in batches:
+            frame: pd.DataFrame = batch.to_pandas()
+            for name in self.schema.names:
+                arrays[name][offset:offset + len(frame)] = frame[name].to_numpy()
+            offset += len(frame)
+
+        return pd.DataFrame(arrays, copy=False)
@@ -0,0 +1,53 @@
+"""
+A local cache of downloaded blobs, keyed by their content hash.
+
+The cached files are never modified, so every job of the host can share
+them, e.g. by memory-mapping the same file.
+"""
+import os
+import base64
+import tempfile
+
+from utils.storages import BaseStorage, get_file_md5
+
+
+def get_cache_folder() -> str:
+    return os.getenv('DATASET_CACHE', os.path.join('data', 'cache'))
+
+
+def get_hex_md5(file_path: str) -> str:
+    return base64.b64decode(get_file_md5(file_path)).hex()
+
+
+def download_cached(
+    storage: BaseStorage,
+    blob_name: str,
+    content_hash: str,
+    verify: bool = False,
+) -> str:
+    """
+    Download a blob into the cache under its hash, unless it is there
+    already. With `verify`, a blob replaced since its hash was read is
+    returned without being cached.
+    """
+    local_file: str = os.path.join(get_cache_folder(), content_hash[:2], content_hash)
+
+    if os.path.isfile(local_file):
+        return local_file
+
+    os.makedirs(os.path.dirname(local_file), exist_ok=True)
+
+    file_descriptor, temporary_file = tempfile.mkstemp(dir=os.path.dirname(local_file), prefix='.download-')
+    os.close(file_descriptor)
+    try:
+        storage.download_a_file(source_blob_name=blob_name, destination_file_name=temporary_file)
+    except BaseException:
+        os.remove(temporary_file)
+        raise
+
+    if verify and get_hex_md5(temporary_file) != content_hash:
+        return temporary_file
+
+    os.replace(temporary_file, local_file)
+
+    return local_file
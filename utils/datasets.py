@@ -0,0 +1,328 @@
+"""
+Read the archived datasets as they were on a given day.
+
+The archives keep each dataset whole (e.g. `processed.pickle`) and split
+by ticker or code into partitions (`processed/{ticker}.parquet`), listed
+by a `processed/_partitions.json` file. `load_dataset` resolves these
+through the archive manifests and only downloads the partitions asked for.
+
+The latest processed QuanDL data is published the same way, with the date
+range of each partition in an index, for `query_quandl_processed`.
+Downloads are cached locally by their content hash.
+"""
+import os
+import json
+import shutil
+import typing
+import tempfile
+
+import pandas as pd
+
+from utils.archives import ContentAddressedArchive
+from utils.cache import get_cache_folder, get_hex_md5, download_cached
+from utils.storages import BaseStorage, get_storage
+
+
+class Dataset(typing.NamedTuple):
+    root: str
+    file_name: str
+    partition_column: typing.Optional[str]
+    # `pickle` keeps the object columns of FRED as they are.
+    partition_format: str = 'parquet'
+
+    @property
+    def partition_prefix(self) -> str:
+        return self.file_name.split('.', 1)[0]
+
+
+DATASETS: typing.Dict[str, Dataset] = {
+    'quandl_raw': Dataset(
+        root='shared/data/quandl/archives',
+        file_name='raw.pickle',
+        partition_column=None,
+    ),
+    'quandl_processed': Dataset(
+        root='shared/data/quandl/archives',
+        file_name='processed.pickle',
+        partition_column='ticker',
+    ),
+    'fred': Dataset(
+        root='shared/data/fred/archives',
+        file_name='fred.pkl',
+        partition_column='code',
+        partition_format='pickle',
+    ),
+    'fred_info': Dataset(
+        root='shared/data/fred/archives',
+        file_name='fred_info.pkl',
+        partition_column=None,
+    ),
+}
+
+# The latest processed QuanDL data, one partition per ticker.
+PROCESSED_ROOT: str = 'shared/data/quandl/processed'
+
+# The aggregates of the processed QuanDL data are `quandl_aggregates/{name}`.
+AGGREGATES_PREFIX: str = 'quandl_aggregates/'
+
+
+def get_dataset(name: str) -> Dataset:
+    if name.startswith(AGGREGATES_PREFIX):
+        return Dataset(
+            root='shared/data/quandl/archives',
+            file_name=f'aggregates/{name[len(AGGREGATES_PREFIX):]}.pickle',
+            partition_column='ticker',
+        )
+
+    if name not in DATASETS:
+        raise Exception(f'Unknown dataset: {name}')
+
+    return DATASETS[name]
+
+
+def archive_partitions(
+    archive: ContentAddressedArchive,
+    dataset_name: str,
+    df: pd.DataFrame,
+    local_folder: str,
+) -> typing.List[str]:
+    """
+    Archive the DataFrame split by the partition column of the dataset, the
+    partitions which didn't change are not uploaded again.
+    Return the partition keys.
+    """
+    dataset: Dataset = get_dataset(dataset_name)
+    assert dataset.partition_column is not None
+
+    if os.path.isdir(local_folder):
+        shutil.rmtree(local_folder)
+    os.makedirs(local_folder)
+
+    keys: typing.List[str] = []
+
+    for key, partition in df.groupby(dataset.partition_column, sort=True):
+        local_file: str = os.path.join(local_folder, f'{key}.{dataset.partition_format}')
+        partition = partition.reset_index(drop=True)
+
+        if dataset.partition_format == 'parquet':
+            partition.to_parquet(local_file, index=False)
+        else:
+            partition.to_pickle(local_file)
+
+        archive.add(local_file=local_file, name=f'{dataset.partition_prefix}/{key}.{dataset.partition_format}')
+        keys.append(str(key))
+
+    index_file: str = os.path.join(local_folder, '_partitions.json')
+    with open(index_file, 'w') as f:
+        json.dump(keys, f)
+    archive.add(local_file=index_file, name=f'{dataset.partition_prefix}/_partitions.json')
+
+    return keys
+
+
+def load_dataset(
+    name: str,
+    as_of: typing.Optional[str] = None,
+    tickers: typing.Optional[typing.List[str]] = None,
+    columns: typing.Optional[typing.List[str]] = None,
+    storage: typing.Optional[BaseStorage] = None,
+) -> pd.DataFrame:
+    """
+    Load a dataset as it was archived on `as_of` (YYYY-MM-DD) or the latest
+    day before it, the newest one when not given.
+
+    `tickers` are values of the partition column of the dataset, e.g.
+    `CME_CL1_EN` for `quandl_processed` or `GDP` for `fred`. The aggregates
+    are loaded by name too, e.g. `quandl_aggregates/weekly`.
+    """
+    dataset: Dataset = get_dataset(name)
+    storage = storage or get_storage(bucket_name=os.getenv('BUCKET_NAME'))
+    archive = ContentAddressedArchive(storage=storage, root=dataset.root)
+
+    if dataset.partition_column is not None:
+        df: typing.Optional[pd.DataFrame] = _load_partitions(
+            archive=archive,
+            dataset=dataset,
+            as_of=as_of,
+            tickers=tickers,
+            columns=columns,
+        )
+        if df is not None:
+            return df
+
+    # No partitions for that day, read the whole file.
+    df = pd.read_pickle(_download(archive=archive, name=dataset.file_name, as_of=as_of))
+
+    if tickers is not None and dataset.partition_column is not None:
+        df = df[df[dataset.partition_column].isin(tickers)]
+    if columns is not None:
+        df = df[columns]
+
+    return df.reset_index(drop=True)
+
+
+def _load_partitions(
+    archive: ContentAddressedArchive,
+    dataset: Dataset,
+    as_of: typing.Optional[str],
+    tickers: typing.Optional[typing.List[str]],
+    columns: typing.Optional[typing.List[str]],
+) -> typing.Optional[pd.DataFrame]:
+    index_name: str = f'{dataset.partition_prefix}/_partitions.json'
+    whole_file = archive.resolve(name=dataset.file_name, as_of=as_of)
+    partitions_index = archive.resolve(name=index_name, as_of=as_of)
+
+    # The partitions must be the version of the whole file, not an older one.
+    if partitions_index is None or (whole_file is not None and whole_file[0] != partitions_index[0]):
+        return None
+
+    with open(_download(archive=archive, name=index_name, as_of=as_of)) as f:
+        keys: typing.List[str] = json.load(f)
+
+    if tickers is not None:
+        keys = [key for key in keys if key in tickers]
+
+    names: typing.List[str] = [f'{dataset.partition_prefix}/{key}.{dataset.partition_format}' for key in keys]
+    resolved = archive.resolve_many(names=names, as_of=as_of)
+
+    frames: typing.List[pd.DataFrame] = []
+    for partition_name in names:
+        _, entry = resolved[partition_name]
+        local_file: str = _download_object(archive=archive, content_hash=entry['hash'])
+
+        if dataset.partition_format == 'parquet':
+            frames.append(pd.read_parquet(local_file, columns=columns))
+        else:
+            frame: pd.DataFrame = pd.read_pickle(local_file)
+            frames.append(frame[columns] if columns is not None else frame)
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(frames).reset_index(drop=True)
+
+
+def _download(archive: ContentAddressedArchive, name: str, as_of: typing.Optional[str]) -> str:
+    resolved = archive.resolve(name=name, as_of=as_of)
+
+    if resolved is None:
+        # Archived before the manifests, not cached.
+        local_file: str = os.path.join(get_cache_folder(), 'legacy', as_of or 'latest', name)
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        archive.download(name=name, destination_file_name=local_file, as_of=as_of)
+        return local_file
+
+    _, entry = resolved
+    return _download_object(archive=archive, content_hash=entry['hash'])
+
+
+def _download_object(archive: ContentAddressedArchive, content_hash: str) -> str:
+    return download_cached(
+        storage=archive.storage,
+        blob_name=archive.get_object_blob(content_hash),
+        content_hash=content_hash,
+    )
+
+
+def publish_quandl_processed(
+    storage: BaseStorage,
+    df: pd.DataFrame,
+    local_folder: str,
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """
+    Upload the processed QuanDL partitions written by `archive_partitions`
+    to `{PROCESSED_ROOT}/{ticker}.parquet`, with an `_index.json` of their
+    exchange, date range, rows and hash. Partitions of tickers which are
+    gone are deleted. Return the index.
+    """
+    stats: pd.DataFrame = df.groupby('ticker', sort=True).agg(
+        exchange=('exchange', 'first'),
+        min_date=('date', 'min'),
+        max_date=('date', 'max'),
+        rows=('date', 'size'),
+    )
+    index: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+    for ticker, row in stats.iterrows():
+        local_file: str = os.path.join(local_folder, f'{ticker}.parquet')
+        storage.upload_a_file(source_file=local_file, destination_blob=f'{PROCESSED_ROOT}/{ticker}.parquet')
+
+        index[str(ticker)] = {
+            'exchange': row['exchange'],
+            'min_date': row['min_date'].strftime('%Y-%m-%d'),
+            'max_date': row['max_date'].strftime('%Y-%m-%d'),
+            'rows': int(row['rows']),
+            'hash': get_hex_md5(local_file),
+        }
+
+    index_file: str = os.path.join(local_folder, '_index.json')
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    storage.upload_a_file(source_file=index_file, destination_blob=f'{PROCESSED_ROOT}/_index.json')
+
+    for blob_name in storage.list_files(f'{PROCESSED_ROOT}/'):
+        ticker = blob_name[len(PROCESSED_ROOT) + 1:].rsplit('.', 1)[0]
+        if blob_name.endswith('.parquet') and ticker not in index:
+            storage.delete_a_file(blob_name)
+
+    return index
+
+
+def query_quandl_processed(
+    tickers: typing.Optional[typing.List[str]] = None,
+    exchanges: typing.Optional[typing.List[str]] = None,
+    start_date: typing.Optional[str] = None,
+    end_date: typing.Optional[str] = None,
+    columns: typing.Optional[typing.List[str]] = None,
+    storage: typing.Optional[BaseStorage] = None,
+) -> pd.DataFrame:
+    """
+    Return the rows of the latest processed QuanDL data matching the
+    filters, the dates are inclusive (YYYY-MM-DD). Only the partitions whose
+    ticker, exchange and date range match are downloaded, and only
+    `columns` are read from them.
+    """
+    storage = storage or get_storage(bucket_name=os.getenv('BUCKET_NAME'))
+
+    file_descriptor, index_file = tempfile.mkstemp(suffix='.json')
+    os.close(file_descriptor)
+    try:
+        storage.download_a_file(source_blob_name=f'{PROCESSED_ROOT}/_index.json', destination_file_name=index_file)
+        with open(index_file) as f:
+            index: typing.Dict[str, typing.Dict[str, typing.Any]] = json.load(f)
+    finally:
+        os.remove(index_file)
+
+    # Prune the partitions with their statistics.
+    selected: typing.List[str] = [
+        ticker for ticker, stats in sorted(index.items())
+        if (tickers is None or ticker in tickers)
+        and (exchanges is None or stats['exchange'] in exchanges)
+        and (start_date is None or stats['max_date'] >= start_date)
+        and (end_date is None or stats['min_date'] <= end_date)
+    ]
+
+    filters: typing.List[typing.Tuple[str, str, typing.Any]] = []
+    if start_date is not None:
+        filters.append(('date', '>=', pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(('date', '<=', pd.Timestamp(end_date)))
+
+    frames: typing.List[pd.DataFrame] = []
+    for ticker in selected:
+        local_file: str = download_cached(
+            storage=storage,
+            blob_name=f'{PROCESSED_ROOT}/{ticker}.parquet',
+            content_hash=index[ticker]['hash'],
+            verify=True,
+        )
+        frames.append(pd.read_parquet(local_file, columns=columns, filters=filters or None))
+
+        # A partition replaced since the index was read is not cached.
+        if os.path.basename(local_file).startswith('.download-'):
+            os.remove(local_file)
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(frames).reset_index(drop=True)
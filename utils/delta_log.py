@@ -0,0 +1,154 @@
+import os
+import uuid
+import typing
+import tempfile
+from datetime import datetime
+
+import pandas as pd
+
+from utils.storages import BaseStorage
+
+
+class DeltaLog:
+    """
+    An append-only log of DataFrame rows per key (e.g. a ticker):
+
+        {base_root}/{key}.pkl                    the compacted snapshot
+        {delta_root}/{key}/{time}-{id}.pkl       the rows appended since
+
+    A run only writes its new or revised rows as a small segment. Readers
+    merge the segments, newest first, with the snapshot: of the rows with
+    the same `key_columns` (e.g. the date), the newest one wins, without
+    them only the exact copies are dropped. Compaction folds the segments
+    into the snapshot.
+    """
+
+    def __init__(
+        self,
+        storage: BaseStorage,
+        base_root: str,
+        delta_root: str,
+        key_columns: typing.Optional[typing.List[str]] = None,
+    ):
+        self.storage: BaseStorage = storage
+        self.base_root: str = base_root.rstrip('/')
+        self.delta_root: str = delta_root.rstrip('/')
+        self.key_columns: typing.Optional[typing.List[str]] = key_columns
+
+    def get_base_blob(self, key: str) -> str:
+        return f'{self.base_root}/{key}.pkl'
+
+    def list_segments(self, key: str) -> typing.List[str]:
+        """
+        Return the segment blobs of the key, oldest first.
+        """
+        return self.storage.list_files(f'{self.delta_root}/{key}/')
+
+    def load(
+        self,
+        key: str,
+        segments: typing.Optional[typing.List[str]] = None,
+    ) -> typing.Optional[pd.DataFrame]:
+        """
+        Return the rows of the key, None when nothing was written yet.
+        """
+        if segments is None:
+            segments = self.list_segments(key)
+
+        frames: typing.List[pd.DataFrame] = [self.__read_blob(segment) for segment in reversed(segments)]
+
+        base_blob: str = self.get_base_blob(key)
+        if self.storage.is_file_exists(base_blob):
+            frames.append(self.__read_blob(base_blob))
+
+        if not frames:
+            return None
+
+        if len(frames) == 1:
+            return frames[0]
+
+        return self.merge(frames)
+
+    def merge(self, frames: typing.List[pd.DataFrame]) -> pd.DataFrame:
+        """
+        Merge the rows of the frames, the newest frame first.
+        """
+        return pd.concat(frames) \
+            .drop_duplicates(subset=self.key_columns, keep='first') \
+            .reset_index(drop=True)
+
+    @staticmethod
+    def get_new_rows(data: pd.DataFrame, previous: pd.DataFrame) -> pd.DataFrame:
+        """
+        Return the distinct rows of `data` which are not in `previous`. The
+        columns are cast to the dtypes of `previous` first, an int column
+        coming back as float would make all the rows new.
+        """
+        data = data.drop_duplicates()
+
+        if list(data.columns) != list(previous.columns):
+            return data
+
+        cast_columns: typing.Dict[str, pd.Series] = {}
+        for column in data.columns:
+            if data[column].dtype != previous[column].dtype:
+                try:
+                    cast_columns[column] = data[column].astype(previous[column].dtype)
+                except (TypeError, ValueError):
+                    pass
+        data = data.assign(**cast_columns)
+
+        previous_hashes = pd.util.hash_pandas_object(previous, index=False)
+        is_new = ~pd.util.hash_pandas_object(data, index=False).isin(previous_hashes)
+
+        return data[is_new.values]
+
+    def append(self, key: str, local_file: str) -> str:
+        """
+        Upload a pickled DataFrame of rows as a new segment of the key.
+        """
+        # To the microsecond, the segments of the same second are in order too.
+        time: str = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        segment_blob: str = f'{self.delta_root}/{key}/{time}-{uuid.uuid4().hex[:8]}.pkl'
+
+        self.storage.upload_a_file(source_file=local_file, destination_blob=segment_blob, skip_unchanged=False)
+
+        return segment_blob
+
+    def write_base(self, key: str, local_file: str) -> None:
+        self.storage.upload_a_file(source_file=local_file, destination_blob=self.get_base_blob(key))
+
+    def compact(self, key: str, threshold: int = 1) -> bool:
+        """
+        Fold the segments into the snapshot once there are `threshold` of
+        them, return False when there was nothing to do. Only the segments
+        read are deleted, the ones appended meanwhile are kept.
+        """
+        segments: typing.List[str] = self.list_segments(key)
+        if not segments or len(segments) < threshold:
+            return False
+
+        data: typing.Optional[pd.DataFrame] = self.load(key, segments=segments)
+        assert data is not None
+
+        file_descriptor, local_file = tempfile.mkstemp(suffix='.pkl')
+        os.close(file_descriptor)
+        try:
+            data.to_pickle(local_file)
+            self.write_base(key, local_file=local_file)
+        finally:
+            os.remove(local_file)
+
+        for segment in segments:
+            self.storage.delete_a_file(segment)
+
+        return True
+
+    def __read_blob(self, blob_name: str) -> pd.DataFrame:
+        file_descriptor, local_file = tempfile.mkstemp(suffix='.pkl')
+        os.close(file_descriptor)
+        try:
+            self.storage.download_a_file(source_blob_name=blob_name, destination_file_name=local_file)
+            return pd.read_pickle(local_file)
+        finally:
+            os.remove(local_file)
@@ -0,0 +1,111 @@
+"""
+The trading sessions of the exchanges, to know when their settles are out.
+
+Each exchange has a section in `exchanges.cfg` with its time zone, the
+local time of its settlement, the delay until QuanDL publishes it, the
+weekdays it trades (0 is Monday) and its holidays. The holidays are known
+until `holidays_until`, the end of the year of the last one by default:
+past it, a holiday would be taken for a session. The tickers are prefixed
+by their exchange, e.g. `CME_CL1`, unless their product (the ticker
+without its depth, e.g. `ICE_CC`) is in the `products` of a section: the
+products of an exchange which settle on another calendar, like the ICE US
+and ICE Europe ones.
+"""
+import typing
+import configparser
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+
+class ExchangeCalendar:
+
+    def __init__(
+        self,
+        name: str,
+        time_zone: str,
+        settle_time: time,
+        publish_delay: timedelta,
+        weekdays: typing.Set[int],
+        holidays: typing.Set[date],
+        holidays_until: typing.Optional[date] = None,
+        products: typing.Optional[typing.Set[str]] = None,
+    ) -> None:
+        self.name: str = name
+        self.time_zone: ZoneInfo = ZoneInfo(time_zone)
+        self.settle_time: time = settle_time
+        self.publish_delay: timedelta = publish_delay
+        self.weekdays: typing.Set[int] = weekdays
+        self.holidays: typing.Set[date] = holidays
+        self.holidays_until: typing.Optional[date] = holidays_until \
+            or (date(max(holidays).year, 12, 31) if holidays else None)
+        self.products: typing.Set[str] = products or set()
+
+    def has_holidays(self, now: typing.Optional[datetime] = None) -> bool:
+        """
+        Whether the holidays are known at `now` (UTC by default).
+        """
+        now = now or datetime.now(timezone.utc)
+
+        return self.holidays_until is None or now.astimezone(self.time_zone).date() <= self.holidays_until
+
+    def is_session(self, day: date) -> bool:
+        return day.weekday() in self.weekdays and day not in self.holidays
+
+    def get_publish_time(self, session: date) -> datetime:
+        """
+        When the settles of the session are available, in UTC.
+        """
+        settled_at: datetime = datetime.combine(session, self.settle_time, tzinfo=self.time_zone)
+
+        return (settled_at + self.publish_delay).astimezone(timezone.utc)
+
+    def get_latest_session(self, now: typing.Optional[datetime] = None) -> typing.Optional[date]:
+        """
+        Return the last session published at `now` (UTC by default), None
+        when there is none in the last weeks.
+        """
+        now = now or datetime.now(timezone.utc)
+        day: date = now.astimezone(self.time_zone).date()
+
+        for _ in range(31):
+            if self.is_session(day) and self.get_publish_time(day) <= now:
+                return day
+            day -= timedelta(days=1)
+
+        return None
+
+
+def read_exchange_calendars(config: configparser.ConfigParser) -> typing.Dict[str, ExchangeCalendar]:
+    calendars: typing.Dict[str, ExchangeCalendar] = {}
+
+    for name in config.sections():
+        section: configparser.SectionProxy = config[name]
+        weekdays: str = section.get('weekdays', '0,1,2,3,4')
+        holidays: str = section.get('holidays', '')
+        holidays_until: typing.Optional[str] = section.get('holidays_until')
+        products: str = section.get('products', '')
+
+        calendars[name] = ExchangeCalendar(
+            name=name,
+            time_zone=section['timezone'],
+            settle_time=time.fromisoformat(section['settle_time']),
+            publish_delay=timedelta(minutes=section.getint('publish_delay_minutes', fallback=0)),
+            weekdays=set(int(weekday) for weekday in weekdays.split(',')),
+            holidays=set(date.fromisoformat(holiday.strip()) for holiday in holidays.split('\n') if holiday.strip()),
+            holidays_until=date.fromisoformat(holidays_until) if holidays_until else None,
+            products=set(product.strip() for product in products.split('\n') if product.strip()),
+        )
+
+    return calendars
+
+
+def get_exchange(ticker: str, calendars: typing.Optional[typing.Dict[str, ExchangeCalendar]] = None) -> str:
+    """
+    The calendar of the ticker: the one listing its product, its prefix otherwise.
+    """
+    product: str = ticker.rstrip('0123456789')
+    for name, calendar in (calendars or {}).items():
+        if product in calendar.products:
+            return name
+
+    return ticker.split('_', 1)[0]
@@ -0,0 +1,101 @@
+import os
+import typing
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def allocate_column(dtype: np.dtype, rows: int, spill_folder: typing.Optional[str] = None) -> np.ndarray:
+    """
+    An empty column, in memory or, with `spill_folder`, memory-mapped from
+    a file of the folder. The file is removed once mapped: its pages stay
+    until the column is released and, written back to the disk, they can
+    be evicted under memory pressure. Objects (strings) stay in memory.
+    """
+    if spill_folder is None or dtype.hasobject:
+        return np.empty(rows, dtype=dtype)
+
+    file_descriptor, path = tempfile.mkstemp(dir=spill_folder, suffix='.npy')
+    os.close(file_descriptor)
+    try:
+        # A plain array over the map, a `np.memmap` would be copied to be pickled.
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(rows,)).view(np.ndarray)
+    finally:
+        os.remove(path)
+
+
+def concat_frames(frames: typing.List[pd.DataFrame], spill_folder: typing.Optional[str] = None) -> pd.DataFrame:
+    """
+    `pd.concat` of frames with the same columns, into column arrays which
+    are allocated once for the total row count.
+
+    The frames are removed from the list as they are copied, so the caller
+    should not keep other references to them: the memory of the inputs is
+    released while the output fills up, instead of holding both at once.
+    Frames with different columns or extension dtypes (categories,
+    timezones, nullable integers) are left to `pd.concat`. With
+    `spill_folder`, the columns are built on disk (see `allocate_column`).
+    """
+    if not frames:
+        raise ValueError('No objects to concatenate')
+
+    columns: pd.Index = frames[0].columns
+
+    if any(not frame.columns.equals(columns) for frame in frames) \
+            or not columns.is_unique \
+            or any(not pd.api.types.is_integer_dtype(frame.index.dtype) for frame in frames):
+        return _concat_and_release(frames)
+
+    frame_dtypes: typing.List[pd.Series] = [frame.dtypes for frame in frames]
+    dtypes: typing.Dict[str, np.dtype] = {}
+
+    for i, column in enumerate(columns):
+        column_dtypes: typing.Set[typing.Any] = set(dtypes_of_frame.iat[i] for dtypes_of_frame in frame_dtypes)
+        if not all(isinstance(dtype, np.dtype) for dtype in column_dtypes):
+            return _concat_and_release(frames)
+        # Only numbers are upcast the way `pd.concat` does, e.g. int to float.
+        if len(column_dtypes) > 1 and not all(dtype.kind in 'iuf' for dtype in column_dtypes):
+            return _concat_and_release(frames)
+        dtypes[column] = np.result_type(*column_dtypes)
+
+    total_rows: int = sum(len(frame) for frame in frames)
+    arrays: typing.Dict[str, np.ndarray] = {
+        column: allocate_column(dtypes[column], total_rows, spill_folder=spill_folder) for column in columns
+    }
+    index: np.ndarray = np.empty(total_rows, dtype=np.int64)
+    offset: int = 0
+
+    while frames:
+        frame: pd.DataFrame = frames.pop(0)
+        rows: int = len(frame)
+
+        # The columns are unique and of numpy dtypes, `to_numpy` does not copy them.
+        for column in columns:
+            arrays[column][offset:offset + rows] = frame[column].to_numpy()
+        index[offset:offset + rows] = frame.index.to_numpy()
+
+        offset += rows
+        del frame
+
+    # Without `copy`, the arrays become the columns as they are.
+    return pd.DataFrame(arrays, index=pd.Index(index), columns=columns, copy=False)
+
+
+def _concat_and_release(frames: typing.List[pd.DataFrame]) -> pd.DataFrame:
+    df: pd.DataFrame = pd.concat(frames)
+    frames.clear()
+
+    return df
+
+
+def get_group_positions(keys: np.ndarray) -> np.ndarray:
+    """
+    The position of each row in its run of equal keys (0 for the first row
+    of a ticker in a frame sorted by ticker), to mask the rolling windows
+    which span two groups.
+    """
+    rows: np.ndarray = np.arange(len(keys))
+    starts: np.ndarray = np.r_[True, keys[1:] != keys[:-1]] if len(keys) else np.zeros(0, dtype=bool)
+
+    return rows - np.maximum.accumulate(np.where(starts, rows, 0))
@@ -0,0 +1,212 @@
+"""
+The memory budget of a run, against which the large concats are checked.
+
+The budget is `MEMORY_BUDGET`, or `budget` in the `[memory]` section of
+the config: a size (`512M`, `6G`) or a fraction of the memory of the
+container, or of the host without a limit (`0.8` by default). A stage
+whose result would take the resident memory over it builds the result on
+disk instead, memory-mapped, e.g. `concat_frames(frames, spill_folder=...)`:
+slower, but the agent is not OOM-killed.
+"""
+import os
+import time
+import typing
+import threading
+import contextlib
+import configparser
+
+import prefect
+
+
+logger = prefect.context.get('logger')
+
+SIZE_UNITS: typing.Dict[str, int] = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def get_rss() -> int:
+    """
+    The resident memory of the process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+
+        # The peak, in KiB on Linux: an over-estimate where statm is missing.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_peak_rss() -> int:
+    """
+    The peak resident memory of the process since the last `reset_peak_rss`.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return get_rss()
+
+
+def reset_peak_rss() -> None:
+    """
+    Reset the peak of the whole process, the one of all its threads.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        # The peak stays the one of the process.
+        pass
+
+
+def get_total_memory() -> int:
+    """
+    The memory limit of the cgroup of the process (v2 or v1), the host
+    memory without one.
+    """
+    total: int = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    for limit_file in _get_cgroup_limit_files():
+        try:
+            with open(limit_file) as f:
+                limit: str = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            total = min(total, int(limit))
+
+    return total
+
+
+def _get_cgroup_limit_files() -> typing.List[str]:
+    # `0::/path` for v2, `4:memory:/path` for v1.
+    limit_files: typing.List[str] = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, path = line.strip().split(':', 2)
+                if controllers == '':
+                    limit_files.append(f'/sys/fs/cgroup{path.rstrip("/")}/memory.max')
+                elif 'memory' in controllers.split(','):
+                    limit_files.append(f'/sys/fs/cgroup/memory{path.rstrip("/")}/memory.limit_in_bytes')
+    except (OSError, ValueError):
+        pass
+
+    # In a container, the cgroup of the process is the root of its namespace.
+    return limit_files + ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+
+
+def parse_size(size: str) -> int:
+    """
+    Bytes from `1073741824`, `512M` or `6G`, or a fraction of the total memory from `0.8`.
+    """
+    size = size.strip().upper().rstrip('B')
+
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    if '.' in size:
+        return int(float(size) * get_total_memory())
+
+    return int(size)
+
+
+class StageMemory(typing.NamedTuple):
+    name: str
+    start_rss: int
+    peak_rss: int
+    end_rss: int
+    seconds: float
+    spilled: bool
+
+
+class MemoryBudget:
+    # The stages running in the process, of all the budgets, e.g. in the
+    # threads of a `LocalDaskExecutor`: the peak is not reset under them.
+    running_stages: int = 0
+    running_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, budget: int) -> None:
+        self.budget: int = budget
+        self.stages: typing.List[StageMemory] = []
+        # Whether the stage running spilled.
+        self.spilled: bool = False
+
+    def fits(self, size: int) -> bool:
+        """
+        Whether `size` more bytes keep the process within the budget.
+        """
+        rss: int = get_rss()
+        if rss + size <= self.budget:
+            return True
+
+        logger.warning(
+            f'Memory budget: {rss / 2 ** 20:.0f} MiB resident + {size / 2 ** 20:.0f} MiB '
+            f'exceeds {self.budget / 2 ** 20:.0f} MiB, spilling to disk'
+        )
+        self.spilled = True
+
+        return False
+
+    def get_spill_folder(self, size: int, folder: str) -> typing.Optional[str]:
+        """
+        None when `size` more bytes fit, otherwise `folder`, created.
+        """
+        if self.fits(size):
+            return None
+
+        os.makedirs(folder, exist_ok=True)
+
+        return folder
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator['MemoryBudget']:
+        """
+        Record the resident memory of the stage run in the block. The peak
+        is the one of the process: while other stages run in its threads,
+        it includes theirs, since the first of them started.
+        """
+        started_at: float = time.monotonic()
+        self.spilled = False
+        start_rss: int = get_rss()
+        with MemoryBudget.running_lock:
+            if not MemoryBudget.running_stages:
+                reset_peak_rss()
+            MemoryBudget.running_stages += 1
+
+        try:
+            yield self
+        finally:
+            with MemoryBudget.running_lock:
+                MemoryBudget.running_stages -= 1
+            self.stages.append(StageMemory(
+                name=name,
+                start_rss=start_rss,
+                peak_rss=get_peak_rss(),
+                end_rss=get_rss(),
+                seconds=time.monotonic() - started_at,
+                spilled=self.spilled,
+            ))
+            logger.info(f'Memory of {self.__format(self.stages[-1])}')
+
+    def get_report(self) -> str:
+        return ', '.join(self.__format(stage) for stage in self.stages)
+
+    def __format(self, stage: StageMemory) -> str:
+        return (
+            f'{stage.name}: {stage.start_rss / 2 ** 20:.0f} -> {stage.end_rss / 2 ** 20:.0f} MiB '
+            f'(peak {stage.peak_rss / 2 ** 20:.0f} of {self.budget / 2 ** 20:.0f} MiB'
+            f'{", spilled" if stage.spilled else ""}) in {stage.seconds:.1f}s'
+        )
+
+
+def get_memory_budget(config: typing.Optional[configparser.ConfigParser] = None) -> MemoryBudget:
+    budget: str = os.getenv('MEMORY_BUDGET', '') \
+        or (config.get('memory', 'budget', fallback='') if config is not None else '') \
+        or '0.8'
+
+    return MemoryBudget(budget=parse_size(budget))
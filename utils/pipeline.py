@@ -0,0 +1,244 @@
+"""
+Declarative DataFrame pipelines, defined in the config of a stage.
+
+    [pipeline]
+    source = quandl_raw
+    drop = name
+        quandl_code
+    filter = notna(settle)
+        volume >= 0
+    check = quandl_processed
+
+    [pipeline.derive]
+    year = year(date)
+    ticker = concat(exchange, '_', symbol, str(depth), '_', method)
+
+    [pipeline.cast]
+    volume = float32
+
+`source` and `check` are names of schemas in `utils.validation`: the
+columns of the source not needed by the output are not loaded, the output
+is validated against the check. The derived columns are added in their
+order after the kept ones. The filters (all must hold) and the casts apply
+to the output.
+
+The expressions are made of column names, constants, comparisons and the
+`FUNCTIONS`, nothing else is evaluated. The pipeline runs column by
+column: the filters make one mask, then each output column is taken
+(filtered, cast) once, so a new step doesn't add a copy of the frame.
+"""
+import ast
+import typing
+import inspect
+import operator
+import functools
+import configparser
+
+import numpy as np
+import pandas as pd
+
+from utils.validation import SCHEMAS, QualityReport, Schema, validate
+
+
+# The missing values get a code like the others: `na_sentinel=None` up to
+# pandas 1.4 (the pinned version), `use_na_sentinel=False` from 1.5.
+FACTORIZE_KEEP_NA: typing.Dict[str, typing.Any] = \
+    {'use_na_sentinel': False} if 'use_na_sentinel' in inspect.signature(pd.factorize).parameters \
+    else {'na_sentinel': None}
+
+
+def _apply_unique(values: pd.Series, function: typing.Callable[[pd.Series], pd.Series]) -> pd.Series:
+    """
+    Apply the function once per distinct value, e.g. once per ticker.
+    """
+    codes, uniques = pd.factorize(values, **FACTORIZE_KEEP_NA)
+    results: pd.Series = function(pd.Series(uniques))
+
+    return pd.Series(results.to_numpy()[codes], index=values.index, name=values.name)
+
+
+def _concat(*parts: typing.Any) -> typing.Any:
+    """
+    Concatenate columns and constants, once per distinct combination of
+    the columns instead of once per row.
+    """
+    columns: typing.List[pd.Series] = [part for part in parts if isinstance(part, pd.Series)]
+    if not columns:
+        return functools.reduce(operator.add, parts)
+
+    codes: np.ndarray = np.zeros(len(columns[0]), dtype=np.int64)
+    uniques: typing.Any = []
+    for column in columns:
+        column_codes, column_uniques = pd.factorize(column, **FACTORIZE_KEEP_NA)
+        codes, uniques = pd.factorize(codes * len(column_uniques) + column_codes)
+
+    # A row of each combination, they all give the same string.
+    rows: np.ndarray = np.empty(len(uniques), dtype=np.intp)
+    rows[codes] = np.arange(len(codes))
+
+    values: pd.Series = functools.reduce(operator.add, [
+        part.iloc[rows].reset_index(drop=True) if isinstance(part, pd.Series) else part
+        for part in parts
+    ])
+
+    return pd.Series(values.to_numpy()[codes], index=columns[0].index)
+
+
+FUNCTIONS: typing.Dict[str, typing.Callable[..., typing.Any]] = {
+    'year': lambda values: values.dt.year,
+    'month': lambda values: values.dt.month,
+    'str': lambda values: _apply_unique(values, lambda uniques: uniques.astype(str)),
+    'concat': _concat,
+    'notna': lambda values: values.notna(),
+    'isna': lambda values: values.isna(),
+    'isin': lambda values, *options: values.isin(options),
+}
+
+COMPARISONS: typing.Dict[typing.Type[ast.cmpop], typing.Callable[[typing.Any, typing.Any], typing.Any]] = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+class Expression:
+
+    def __init__(self, text: str) -> None:
+        self.text: str = text
+        self.tree: ast.expr = ast.parse(text.strip(), mode='eval').body
+        self.columns: typing.List[str] = []
+
+        self.__check(self.tree)
+
+    def evaluate(self, columns: typing.Dict[str, pd.Series]) -> typing.Any:
+        return self.__evaluate(self.tree, columns)
+
+    def __check(self, node: ast.expr) -> None:
+        """
+        Reject what is not supported and collect the columns used.
+        """
+        if isinstance(node, ast.Name):
+            self.columns.append(node.id)
+        elif isinstance(node, ast.Constant):
+            pass
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+                and not node.keywords:
+            for arg in node.args:
+                self.__check(arg)
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in COMPARISONS:
+            self.__check(node.left)
+            self.__check(node.comparators[0])
+        else:
+            raise Exception(f'Unsupported expression: {self.text}')
+
+    def __evaluate(self, node: ast.expr, columns: typing.Dict[str, pd.Series]) -> typing.Any:
+        if isinstance(node, ast.Name):
+            if node.id not in columns:
+                raise Exception(f'Unknown column {node.id} in: {self.text}')
+            return columns[node.id]
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Call):
+            return FUNCTIONS[node.func.id](*(self.__evaluate(arg, columns) for arg in node.args))  # type: ignore
+
+        compare: ast.Compare = node  # type: ignore
+        return COMPARISONS[type(compare.ops[0])](
+            self.__evaluate(compare.left, columns),
+            self.__evaluate(compare.comparators[0], columns),
+        )
+
+
+class Pipeline:
+
+    def __init__(
+        self,
+        drop: typing.Optional[typing.List[str]] = None,
+        derive: typing.Optional[typing.Dict[str, str]] = None,
+        cast: typing.Optional[typing.Dict[str, str]] = None,
+        filters: typing.Optional[typing.List[str]] = None,
+        source: typing.Optional[Schema] = None,
+        check: typing.Optional[Schema] = None,
+    ) -> None:
+        self.drop: typing.List[str] = drop or []
+        self.derive: typing.Dict[str, Expression] = {
+            column: Expression(expression) for column, expression in (derive or {}).items()
+        }
+        self.cast: typing.Dict[str, str] = cast or {}
+        self.filters: typing.List[Expression] = [Expression(expression) for expression in filters or []]
+        self.source: typing.Optional[Schema] = source
+        self.schema: typing.Optional[Schema] = check
+
+    def get_load_columns(self) -> typing.Optional[typing.List[str]]:
+        """
+        The columns of the source to load, None for all of them.
+        """
+        if self.source is None:
+            return None
+
+        used_columns: typing.Set[str] = set(
+            column
+            for expression in [*self.derive.values(), *self.filters]
+            for column in expression.columns
+        )
+
+        return [column for column in self.source.columns if column not in self.drop or column in used_columns]
+
+    def run(self, df: pd.DataFrame) -> pd.DataFrame:
+        # The columns are shared with the input until they are filtered or cast.
+        columns: typing.Dict[str, pd.Series] = {column: df[column] for column in df.columns}
+        output_columns: typing.List[str] = [column for column in df.columns if column not in self.drop]
+
+        for column, expression in self.derive.items():
+            columns[column] = expression.evaluate(columns)
+            if column not in output_columns:
+                output_columns.append(column)
+
+        mask: typing.Optional[np.ndarray] = None
+        for expression in self.filters:
+            kept: np.ndarray = np.asarray(expression.evaluate(columns), dtype=bool)
+            mask = kept if mask is None else mask & kept
+
+        # Nothing filtered out, nothing to take.
+        if mask is not None and mask.all():
+            mask = None
+
+        output: typing.Dict[str, pd.Series] = {}
+        for column in output_columns:
+            values: pd.Series = columns[column]
+            if mask is not None:
+                values = values[mask]
+            if column in self.cast and str(values.dtype) != self.cast[column]:
+                values = values.astype(self.cast[column])
+            output[column] = values
+
+        return pd.DataFrame(output, copy=False)
+
+    def check(self, df: pd.DataFrame) -> typing.Optional[QualityReport]:
+        if self.schema is None:
+            return None
+
+        return validate(df=df, schema=self.schema)
+
+
+def read_pipeline(config: configparser.ConfigParser, section: str = 'pipeline') -> Pipeline:
+    def get_lines(key: str) -> typing.List[str]:
+        return [line.strip() for line in config.get(section, key, fallback='').split('\n') if line.strip()]
+
+    def get_schema(key: str) -> typing.Optional[Schema]:
+        name: str = config.get(section, key, fallback='')
+        if name and name not in SCHEMAS:
+            raise Exception(f'Unknown schema: {name}')
+
+        return SCHEMAS[name] if name else None
+
+    return Pipeline(
+        drop=get_lines('drop'),
+        derive=dict(config[f'{section}.derive']) if config.has_section(f'{section}.derive') else None,
+        cast=dict(config[f'{section}.cast']) if config.has_section(f'{section}.cast') else None,
+        filters=get_lines('filter'),
+        source=get_schema('source'),
+        check=get_schema('check'),
+    )
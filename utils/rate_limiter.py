@@ -0,0 +1,184 @@
+"""
+Rate limits of the APIs, shared by every flow running on the host.
+
+The budget of an API is a token bucket kept in a state file, locked while
+it is updated, so the processes using the same API key draw from the same
+bucket. The rate adapts to the responses (AIMD): it grows by `increase`
+requests per second after each fast response, and is cut by `decrease`
+after a throttled (429) or slow one.
+"""
+import os
+import json
+import time
+import fcntl
+import typing
+import tempfile
+import contextlib
+import configparser
+
+from utils.replay import get_replay_mode
+
+
+class RateLimiter:
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        burst: float = 1,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        slow_latency: float = 10,
+        state_folder: typing.Optional[str] = None,
+    ) -> None:
+        self.name: str = name
+        self.rate: float = rate
+        self.min_rate: float = min_rate
+        self.max_rate: float = max_rate
+        self.burst: float = burst
+        self.increase: float = increase
+        self.decrease: float = decrease
+        self.slow_latency: float = slow_latency
+
+        state_folder = state_folder or get_state_folder()
+        os.makedirs(state_folder, exist_ok=True)
+        self.state_file: str = os.path.join(state_folder, f'{name}.json')
+
+    def acquire(self) -> float:
+        """
+        Wait for a token, return the time waited in seconds.
+        """
+        started_at: float = time.monotonic()
+
+        while True:
+            with self.__state() as state:
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return time.monotonic() - started_at
+
+                wait: float = (1 - state['tokens']) / state['rate']
+
+            time.sleep(wait)
+
+    def report(self, latency: float, throttled: bool = False) -> None:
+        with self.__state() as state:
+            if throttled or latency > self.slow_latency:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                # Back off for a moment, the other processes too.
+                state['tokens'] = min(state['tokens'], 0)
+            else:
+                state['rate'] = min(self.max_rate, state['rate'] + self.increase)
+
+    @contextlib.contextmanager
+    def limit(self) -> typing.Iterator[None]:
+        """
+        Wait for a token before the call and report how it went after it.
+        """
+        self.acquire()
+        started_at: float = time.monotonic()
+
+        try:
+            yield
+        except Exception as ex:
+            self.report(latency=time.monotonic() - started_at, throttled=is_throttled(ex))
+            raise
+
+        self.report(latency=time.monotonic() - started_at)
+
+    @contextlib.contextmanager
+    def __state(self) -> typing.Iterator[typing.Dict[str, float]]:
+        with open(self.state_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content: str = f.read()
+                state: typing.Dict[str, float] = json.loads(content) if content else {
+                    'rate': self.rate,
+                    'tokens': self.burst,
+                    'updated_at': time.time(),
+                }
+
+                # Refill the bucket for the time since the last update.
+                now: float = time.time()
+                state['rate'] = min(self.max_rate, max(self.min_rate, state['rate']))
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated_at']) * state['rate'])
+                state['updated_at'] = now
+
+                yield state
+
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class UnlimitedRateLimiter(RateLimiter):
+    """
+    No limit, for the replays: there is no API behind them, their pace is
+    the one of the recorded latencies.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def acquire(self) -> float:
+        return 0
+
+    def report(self, latency: float, throttled: bool = False) -> None:
+        pass
+
+
+def is_throttled(ex: Exception) -> bool:
+    message: str = str(ex).lower()
+
+    return type(ex).__name__ == 'LimitExceededError' \
+        or '429' in message \
+        or 'too many requests' in message \
+        or 'rate limit' in message
+
+
+def get_state_folder() -> str:
+    """
+    `RATE_LIMIT_FOLDER`, by default a folder of the temporary directory of
+    the host, which the agents share.
+    """
+    return os.getenv('RATE_LIMIT_FOLDER', '') or os.path.join(tempfile.gettempdir(), 'quandlib-rate-limits')
+
+
+rate_limiters: typing.Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(
+    name: str,
+    config_file: str = 'quandlib-flows/tasks/configs/rate_limits.cfg',
+) -> RateLimiter:
+    """
+    The rate limiter of an API, from its section in the config file.
+    """
+    if get_replay_mode() == 'replay':
+        return UnlimitedRateLimiter(name)
+
+    if name not in rate_limiters:
+        config = configparser.ConfigParser()
+        config.read(config_file)
+
+        if name not in config:
+            raise Exception(f'No rate limit for: {name}')
+
+        section: configparser.SectionProxy = config[name]
+        rate_limiters[name] = RateLimiter(
+            name=name,
+            rate=section.getfloat('rate'),
+            min_rate=section.getfloat('min_rate'),
+            max_rate=section.getfloat('max_rate'),
+            burst=section.getfloat('burst', fallback=1),
+            increase=section.getfloat('increase', fallback=0.1),
+            decrease=section.getfloat('decrease', fallback=0.5),
+            slow_latency=section.getfloat('slow_latency', fallback=10),
+        )
+
+    return rate_limiters[name]
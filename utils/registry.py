@@ -0,0 +1,185 @@
+"""
+The shared state of the QuanDL tickers and FRED codes.
+
+One JSON blob holds an entry per item, by kind:
+
+    {
+        "quandl": {"CME_CL1_EN": {"last_date": ..., "rows": ..., "hash": ..., "fetched_at": ...}},
+        "fred": {"GDP": {...}},
+        "stages": {"quandl_combine_raw": {"items": {"CME_CL1_EN": hash, ...}, "finished_at": ...}},
+    }
+
+The stages compare the hashes of the registry with the ones of their last
+run (and of their config) to skip the unchanged items, instead of
+downloading them to find out.
+Updates are a read-modify-write which is retried when another writer
+changed the blob in between, so the parallel batches don't lose entries.
+"""
+import os
+import json
+import time
+import random
+import typing
+import hashlib
+import tempfile
+import configparser
+
+import numpy as np
+import pandas as pd
+
+from utils.replay import get_current_time
+from utils.storages import BaseStorage
+
+
+REGISTRY_BLOB: str = 'shared/data/registry.json'
+
+
+def get_frame_hash(df: pd.DataFrame) -> str:
+    """
+    MD5 of the rows of the DataFrame, whatever their order and index.
+    """
+    row_hashes: np.ndarray = np.sort(pd.util.hash_pandas_object(df, index=False).to_numpy())
+    md5 = hashlib.md5(','.join(str(column) for column in df.columns).encode('utf-8'))
+    md5.update(row_hashes.tobytes())
+
+    return md5.hexdigest()
+
+
+def get_frame_state(df: pd.DataFrame, date_column: str = 'date') -> typing.Dict[str, typing.Any]:
+    """
+    The registry entry of an item: its last date, rows and content hash.
+    """
+    last_date: typing.Any = df[date_column].max() if len(df) else None
+
+    return {
+        'last_date': pd.Timestamp(last_date).strftime('%Y-%m-%d') if pd.notna(last_date) else None,
+        'rows': len(df),
+        'hash': get_frame_hash(df),
+    }
+
+
+def get_config_hash(config: configparser.ConfigParser, prefixes: typing.List[str]) -> str:
+    """
+    MD5 of the sections of the config whose name starts with one of the
+    prefixes, a stage redoes its items when they change.
+    """
+    sections: typing.Dict[str, typing.Dict[str, str]] = {
+        section: dict(config[section]) for section in config.sections()
+        if any(section.startswith(prefix) for prefix in prefixes)
+    }
+
+    return hashlib.md5(json.dumps(sections, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_now() -> str:
+    return get_current_time().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class Registry:
+
+    def __init__(self, storage: BaseStorage, blob_name: str = REGISTRY_BLOB):
+        self.storage: BaseStorage = storage
+        self.blob_name: str = blob_name
+        self.entries: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Dict[str, typing.Any]]]] = None
+
+    def load(self, reload: bool = False) -> typing.Dict[str, typing.Dict[str, typing.Dict[str, typing.Any]]]:
+        """
+        Return the entries by kind, read once per instance.
+        """
+        if self.entries is None or reload:
+            self.entries, _ = self.__read()
+
+        return self.entries
+
+    def get(self, kind: str, key: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        return self.load().get(kind, {}).get(key)
+
+    def get_hashes(self, kind: str, keys: typing.List[str]) -> typing.Dict[str, str]:
+        """
+        Return the content hash of the keys which have one.
+        """
+        entries: typing.Dict[str, typing.Dict[str, typing.Any]] = self.load().get(kind, {})
+
+        return {key: entries[key]['hash'] for key in keys if 'hash' in entries.get(key, {})}
+
+    def is_unchanged(self, kind: str, key: str, field: str, value: typing.Any) -> bool:
+        entry: typing.Optional[typing.Dict[str, typing.Any]] = self.get(kind, key)
+
+        return entry is not None and value is not None and entry.get(field) == value
+
+    def update(
+        self,
+        kind: str,
+        items: typing.Dict[str, typing.Dict[str, typing.Any]],
+        retries: int = 20,
+    ) -> None:
+        """
+        Merge the fields of the items into their entries, atomically.
+        """
+        if not items:
+            return
+
+        def merge(entries: typing.Dict[str, typing.Any]) -> None:
+            for key, fields in items.items():
+                entries.setdefault(kind, {}).setdefault(key, {}).update(fields)
+
+        self.__modify(merge, retries=retries)
+
+    def remove(self, kind: str, keys: typing.List[str], retries: int = 20) -> None:
+        """
+        Remove the entries of the keys, atomically.
+        """
+        if not keys:
+            return
+
+        def remove(entries: typing.Dict[str, typing.Any]) -> None:
+            for key in keys:
+                entries.get(kind, {}).pop(key, None)
+
+        self.__modify(remove, retries=retries)
+
+    def __modify(self, change: typing.Callable[[typing.Dict[str, typing.Any]], None], retries: int) -> None:
+        for attempt in range(retries):
+            if attempt:
+                # Let the other writer finish.
+                time.sleep(random.uniform(0, 0.1 * attempt))
+
+            entries, generation = self.__read()
+            change(entries)
+
+            if self.__write(entries, generation=generation):
+                self.entries = entries
+                return
+
+        raise Exception(f'Unable to update the registry: {self.blob_name}')
+
+    def __read(self) -> typing.Tuple[typing.Dict[str, typing.Any], typing.Optional[str]]:
+        file_descriptor, local_file = tempfile.mkstemp(suffix='.json')
+        os.close(file_descriptor)
+        try:
+            generation: typing.Optional[str] = self.storage.download_versioned(
+                source_blob_name=self.blob_name,
+                destination_file_name=local_file,
+            )
+            if generation is None:
+                return {}, None
+
+            with open(local_file) as f:
+                return json.load(f), generation
+        finally:
+            os.remove(local_file)
+
+    def __write(self, entries: typing.Dict[str, typing.Any], generation: typing.Optional[str]) -> bool:
+        file_descriptor, local_file = tempfile.mkstemp(suffix='.json')
+        os.close(file_descriptor)
+        try:
+            with open(local_file, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+
+            return self.storage.put_file_if_generation(
+                source_file=local_file,
+                destination_blob=self.blob_name,
+                generation=generation,
+            )
+        finally:
+            os.remove(local_file)
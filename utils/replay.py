@@ -0,0 +1,478 @@
+"""
+Record the API traffic of a run, and replay it offline.
+
+    REPLAY_MODE=record REPLAY_BUNDLE=bundles/quandl python ...
+    REPLAY_MODE=replay REPLAY_BUNDLE=bundles/quandl REPLAY_LATENCY=zero python ...
+
+The bundle is a folder:
+
+    meta.json           the clock of the recorded run
+    calls/{service}/{key}/{time}-{pid}.pickle
+                        the responses (or errors) and latencies of the API
+                        calls, and the latencies of the storage operations
+    storage/{bucket}/   the blobs as the run found them, before it wrote them
+
+A replay serves the API calls from the bundle, in the order they were
+recorded by call, and the storage from a fresh copy of `storage/`, with
+the recorded latencies scaled by `REPLAY_LATENCY`: `recorded` (default),
+`zero` or a factor. The clock of the replay is the one of the recorded run,
+so it asks for the same tickers and date ranges. The rate limits don't
+apply to a replay, and it doesn't post to Slack.
+"""
+import os
+import json
+import time
+import atexit
+import pickle
+import shutil
+import typing
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+from utils.storages import BaseStorage, LocalFileSystemStorage
+
+
+def get_replay_mode() -> typing.Optional[str]:
+    """
+    `record`, `replay` or None, from `REPLAY_MODE`.
+    """
+    mode: str = os.getenv('REPLAY_MODE', '')
+    if mode == '':
+        return None
+    if mode not in ('record', 'replay'):
+        raise Exception(f'Unknown replay mode: {mode}')
+
+    return mode
+
+
+def get_latency_factor() -> float:
+    latency: str = os.getenv('REPLAY_LATENCY', '') or 'recorded'
+    if latency == 'recorded':
+        return 1.0
+    if latency == 'zero':
+        return 0.0
+
+    return float(latency)
+
+
+class RecordedCall(typing.NamedTuple):
+    call: str
+    latency: float
+    result: typing.Any = None
+    error: typing.Any = None
+
+
+class Bundle:
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.lock = threading.Lock()
+        # The next recorded call to replay, by key.
+        self.cursors: typing.Dict[typing.Tuple[str, str], int] = {}
+        self.scratch_root: typing.Optional[str] = None
+        self.written: typing.Set[str] = set()
+        # The blobs copied, or being copied, to the bundle.
+        self.kept: typing.Set[str] = set()
+        self.started_at: typing.Optional[datetime] = None
+
+        os.makedirs(os.path.join(self.path, 'calls'), exist_ok=True)
+
+    @staticmethod
+    def get_key(call: str) -> str:
+        return hashlib.sha1(call.encode('utf-8')).hexdigest()[:20]
+
+    def get_started_at(self) -> datetime:
+        """
+        The start of the recorded run, written by the first process recording.
+        """
+        meta_file: str = os.path.join(self.path, 'meta.json')
+
+        with self.lock:
+            if self.started_at is None:
+                if not os.path.isfile(meta_file):
+                    if get_replay_mode() == 'replay':
+                        raise Exception(f'Not a recorded bundle: {self.path}')
+                    _write_atomically(meta_file, json.dumps({
+                        'started_at': datetime.now(timezone.utc).isoformat(),
+                    }).encode('utf-8'))
+
+                with open(meta_file) as f:
+                    self.started_at = datetime.fromisoformat(json.load(f)['started_at'])
+
+            return self.started_at
+
+    def record(self, service: str, recorded: RecordedCall) -> None:
+        folder: str = os.path.join(self.path, 'calls', service, self.get_key(recorded.call))
+        os.makedirs(folder, exist_ok=True)
+
+        # Not every client error pickles, their type name and message are kept.
+        error: typing.Any = recorded.error
+        if error is not None:
+            recorded = recorded._replace(error=_RecordedError(type(error).__name__, str(error)))
+
+        _write_atomically(
+            os.path.join(folder, f'{time.time_ns():020d}-{os.getpid()}.pickle'),
+            pickle.dumps(recorded),
+        )
+
+    def replay(self, service: str, call: str) -> typing.Optional[RecordedCall]:
+        """
+        The next recorded call, the last one again once they are all served,
+        None if it was never recorded.
+        """
+        key: str = self.get_key(call)
+        folder: str = os.path.join(self.path, 'calls', service, key)
+        if not os.path.isdir(folder):
+            return None
+
+        file_names: typing.List[str] = sorted(os.listdir(folder))
+        with self.lock:
+            index: int = self.cursors.get((service, key), 0)
+            self.cursors[(service, key)] = index + 1
+
+        with open(os.path.join(folder, file_names[min(index, len(file_names) - 1)]), 'rb') as f:
+            recorded: RecordedCall = pickle.load(f)
+
+        if isinstance(recorded.error, _RecordedError):
+            recorded = recorded._replace(error=recorded.error.to_exception())
+
+        return recorded
+
+    def wait(self, recorded: typing.Optional[RecordedCall]) -> None:
+        if recorded is not None and recorded.latency > 0:
+            time.sleep(recorded.latency * get_latency_factor())
+
+    def get_storage_seed(self, bucket_name: typing.Optional[str]) -> str:
+        return os.path.join(self.path, 'storage', bucket_name or '')
+
+    def get_scratch_root(self) -> str:
+        """
+        A copy of the recorded blobs for the replays of this process, the
+        replay writes to it.
+        """
+        with self.lock:
+            if self.scratch_root is None:
+                self.scratch_root = tempfile.mkdtemp(prefix='quandlib-replay-')
+                atexit.register(shutil.rmtree, self.scratch_root, True)
+
+                seed: str = os.path.join(self.path, 'storage')
+                if os.path.isdir(seed):
+                    shutil.copytree(seed, self.scratch_root, dirs_exist_ok=True)
+
+            return self.scratch_root
+
+    def reset(self) -> None:
+        """
+        Start the next replay from the recorded state again.
+        """
+        with self.lock:
+            if self.scratch_root is not None:
+                shutil.rmtree(self.scratch_root, ignore_errors=True)
+            self.scratch_root = None
+            self.cursors = {}
+
+
+class _RecordedError(typing.NamedTuple):
+    name: str
+    message: str
+
+    def to_exception(self) -> Exception:
+        # The same type name, `is_throttled` and the logs only look at it.
+        return type(self.name, (Exception,), {})(self.message)
+
+
+def _write_atomically(file_path: str, content: bytes) -> None:
+    file_descriptor, temporary_file = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.write-')
+    with os.fdopen(file_descriptor, 'wb') as f:
+        f.write(content)
+    os.replace(temporary_file, file_path)
+
+
+def _format_call(method: str, args: typing.Tuple[typing.Any, ...], kwargs: typing.Dict[str, typing.Any]) -> str:
+    arguments: typing.List[str] = [repr(arg) for arg in args] + [
+        f'{name}={kwargs[name]!r}' for name in sorted(kwargs)
+    ]
+
+    return f'{method}({", ".join(arguments)})'
+
+
+bundles: typing.Dict[str, Bundle] = {}
+
+
+def get_bundle() -> Bundle:
+    path: str = os.getenv('REPLAY_BUNDLE', '')
+    if path == '':
+        raise Exception('REPLAY_BUNDLE is not set.')
+
+    path = os.path.abspath(path)
+    if path not in bundles:
+        bundles[path] = Bundle(path)
+
+    return bundles[path]
+
+
+def get_current_time(tz: typing.Optional[timezone] = None) -> datetime:
+    """
+    `datetime.now`, the start of the recorded run when replaying.
+    """
+    mode: typing.Optional[str] = get_replay_mode()
+    if mode is None:
+        return datetime.now(tz)
+
+    started_at: datetime = get_bundle().get_started_at()
+    if mode == 'record':
+        return datetime.now(tz)
+
+    return started_at.astimezone(tz) if tz is not None else started_at.astimezone().replace(tzinfo=None)
+
+
+class ApiProxy:
+    """
+    Forward the method calls to the client, recording them, or answer them
+    from the bundle without creating the client.
+    """
+
+    def __init__(self, service: str, create_client: typing.Callable[[], typing.Any]) -> None:
+        self.service: str = service
+        self.mode: typing.Optional[str] = get_replay_mode()
+        self.client: typing.Any = create_client() if self.mode != 'replay' else None
+
+    def __getattr__(self, name: str) -> typing.Any:
+        if self.mode is None:
+            return getattr(self.client, name)
+
+        def call(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            formatted: str = _format_call(name, args, kwargs)
+            if self.mode == 'replay':
+                return self.__replay(formatted)
+            return self.__record(formatted, getattr(self.client, name), args, kwargs)
+
+        return call
+
+    def __record(
+        self,
+        formatted: str,
+        method: typing.Callable[..., typing.Any],
+        args: typing.Tuple[typing.Any, ...],
+        kwargs: typing.Dict[str, typing.Any],
+    ) -> typing.Any:
+        started_at: float = time.monotonic()
+        try:
+            result: typing.Any = method(*args, **kwargs)
+        except Exception as ex:
+            get_bundle().record(self.service, RecordedCall(formatted, time.monotonic() - started_at, error=ex))
+            raise
+
+        get_bundle().record(self.service, RecordedCall(formatted, time.monotonic() - started_at, result=result))
+
+        return result
+
+    def __replay(self, formatted: str) -> typing.Any:
+        bundle: Bundle = get_bundle()
+        recorded: typing.Optional[RecordedCall] = bundle.replay(self.service, formatted)
+        if recorded is None:
+            raise Exception(f'Not recorded: {self.service} {formatted}')
+
+        bundle.wait(recorded)
+        if recorded.error is not None:
+            raise recorded.error
+
+        return recorded.result
+
+
+def wrap_api(service: str, create_client: typing.Callable[[], typing.Any]) -> typing.Any:
+    """
+    The client of an API, recorded or replayed as `REPLAY_MODE` says. The
+    replay doesn't create the client.
+    """
+    if get_replay_mode() is None:
+        return create_client()
+
+    return ApiProxy(service=service, create_client=create_client)
+
+
+class RecordingStorage(BaseStorage):
+    """
+    Forward to the storage, recording the latency of each operation. A blob
+    is copied to the bundle the first time the run reads, lists or checks
+    it, unless the run wrote it before: the blobs only written are not
+    needed to replay.
+    """
+
+    def __init__(self, storage: BaseStorage, bucket_name: typing.Optional[str]) -> None:
+        super().__init__()
+        self.storage: BaseStorage = storage
+        self.bundle: Bundle = get_bundle()
+        self.seed: str = self.bundle.get_storage_seed(bucket_name)
+
+    def __timed(self, method: str, blob_name: str, *args: typing.Any) -> typing.Any:
+        started_at: float = time.monotonic()
+        result: typing.Any = getattr(self.storage, method)(*args)
+        self.bundle.record('storage', RecordedCall(
+            call=_format_call(method, (blob_name,), {}),
+            latency=time.monotonic() - started_at,
+        ))
+
+        return result
+
+    def __keep(self, blob_name: str, local_file: typing.Optional[str] = None) -> None:
+        seed_file: str = os.path.join(self.seed, *blob_name.split('/'))
+
+        # Only claimed under the lock, the other reads don't wait for the copy.
+        with self.bundle.lock:
+            if blob_name in self.bundle.written or blob_name in self.bundle.kept or os.path.isfile(seed_file):
+                return
+            self.bundle.kept.add(blob_name)
+
+        os.makedirs(os.path.dirname(seed_file), exist_ok=True)
+        # Renamed once complete, another process recording in the bundle never sees a partial blob.
+        partial_file: str = f'{seed_file}.{os.getpid()}.{threading.get_ident()}.partial'
+        try:
+            if local_file is not None:
+                shutil.copyfile(local_file, partial_file)
+            else:
+                self.storage.download_a_file(source_blob_name=blob_name, destination_file_name=partial_file)
+            os.replace(partial_file, seed_file)
+        except Exception:
+            # The next read copies it again.
+            with self.bundle.lock:
+                self.bundle.kept.discard(blob_name)
+            if os.path.isfile(partial_file):
+                os.remove(partial_file)
+            raise
+
+    def __mark_written(self, blob_name: str) -> None:
+        with self.bundle.lock:
+            self.bundle.written.add(blob_name)
+
+    def put_file(self, source_file: str, destination_blob: str) -> None:
+        self.__mark_written(destination_blob)
+        self.__timed('put_file', destination_blob, source_file, destination_blob)
+
+    def list_hashes(self, prefix: str) -> typing.Dict[str, str]:
+        hashes: typing.Dict[str, str] = self.__timed('list_hashes', prefix, prefix)
+        for blob_name in hashes:
+            self.__keep(blob_name)
+
+        return hashes
+
+    def get_remote_hash(self, blob_name: str) -> typing.Optional[str]:
+        remote_hash: typing.Optional[str] = self.__timed('get_remote_hash', blob_name, blob_name)
+        if remote_hash is not None:
+            self.__keep(blob_name)
+
+        return remote_hash
+
+    def download_a_file(self, source_blob_name: str, destination_file_name: str) -> None:
+        self.__timed('download_a_file', source_blob_name, source_blob_name, destination_file_name)
+        self.__keep(source_blob_name, local_file=destination_file_name)
+
+    def is_file_exists(self, file_path: str) -> bool:
+        exists: bool = self.__timed('is_file_exists', file_path, file_path)
+        if exists:
+            self.__keep(file_path)
+
+        return exists
+
+    def list_files(self, prefix: str) -> typing.List[str]:
+        files: typing.List[str] = self.__timed('list_files', prefix, prefix)
+        for blob_name in files:
+            self.__keep(blob_name)
+
+        return files
+
+    def delete_a_file(self, file_path: str) -> None:
+        self.__keep(file_path)
+        self.__mark_written(file_path)
+        self.__timed('delete_a_file', file_path, file_path)
+
+    def download_versioned(self, source_blob_name: str, destination_file_name: str) -> typing.Optional[str]:
+        generation: typing.Optional[str] = self.__timed(
+            'download_versioned', source_blob_name, source_blob_name, destination_file_name,
+        )
+        if generation is not None:
+            self.__keep(source_blob_name, local_file=destination_file_name)
+
+        return generation
+
+    def put_file_if_generation(
+        self,
+        source_file: str,
+        destination_blob: str,
+        generation: typing.Optional[str],
+    ) -> bool:
+        written: bool = self.__timed(
+            'put_file_if_generation', destination_blob, source_file, destination_blob, generation,
+        )
+        if written:
+            self.__mark_written(destination_blob)
+
+        return written
+
+
+class ReplayingStorage(BaseStorage):
+    """
+    The recorded blobs, in a local copy which the replay modifies, with the
+    recorded latency of each operation.
+    """
+
+    def __init__(self, bucket_name: typing.Optional[str]) -> None:
+        super().__init__()
+        self.bundle: Bundle = get_bundle()
+        self.storage = LocalFileSystemStorage(root=self.bundle.get_scratch_root(), bucket_name=bucket_name)
+
+    def __timed(self, method: str, blob_name: str, *args: typing.Any) -> typing.Any:
+        self.bundle.wait(self.bundle.replay('storage', _format_call(method, (blob_name,), {})))
+
+        return getattr(self.storage, method)(*args)
+
+    def put_file(self, source_file: str, destination_blob: str) -> None:
+        self.__timed('put_file', destination_blob, source_file, destination_blob)
+
+    def list_hashes(self, prefix: str) -> typing.Dict[str, str]:
+        return self.__timed('list_hashes', prefix, prefix)
+
+    def get_remote_hash(self, blob_name: str) -> typing.Optional[str]:
+        return self.__timed('get_remote_hash', blob_name, blob_name)
+
+    def download_a_file(self, source_blob_name: str, destination_file_name: str) -> None:
+        self.__timed('download_a_file', source_blob_name, source_blob_name, destination_file_name)
+
+    def is_file_exists(self, file_path: str) -> bool:
+        return self.__timed('is_file_exists', file_path, file_path)
+
+    def list_files(self, prefix: str) -> typing.List[str]:
+        return self.__timed('list_files', prefix, prefix)
+
+    def delete_a_file(self, file_path: str) -> None:
+        self.__timed('delete_a_file', file_path, file_path)
+
+    def download_versioned(self, source_blob_name: str, destination_file_name: str) -> typing.Optional[str]:
+        return self.__timed('download_versioned', source_blob_name, source_blob_name, destination_file_name)
+
+    def put_file_if_generation(
+        self,
+        source_file: str,
+        destination_blob: str,
+        generation: typing.Optional[str],
+    ) -> bool:
+        return self.__timed('put_file_if_generation', destination_blob, source_file, destination_blob, generation)
+
+
+def wrap_storage(
+    create_storage: typing.Callable[[], BaseStorage],
+    bucket_name: typing.Optional[str],
+) -> BaseStorage:
+    """
+    The storage, recorded or replayed as `REPLAY_MODE` says. The replay
+    doesn't create the storage.
+    """
+    mode: typing.Optional[str] = get_replay_mode()
+    if mode == 'replay':
+        return ReplayingStorage(bucket_name=bucket_name)
+    if mode == 'record':
+        return RecordingStorage(storage=create_storage(), bucket_name=bucket_name)
+
+    return create_storage()
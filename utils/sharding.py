@@ -0,0 +1,103 @@
+"""
+The slice of the tickers or FRED codes a flow run processes, so a refresh
+can be split over several agents as the universe grows.
+
+A run of shard `index` of `count` (the `shard_index` and `shard_count`
+parameters of the flows, `SHARD_INDEX` and `SHARD_COUNT` without them)
+keeps the keys which rendezvous hashing assigns to it: a key goes to the
+shard with the highest hash of the key and the shard. Every run computes
+the same assignment from the keys and the count alone, and going from `n`
+to `n + 1` shards only moves the keys the new shard takes.
+
+The shards of a refresh report their output in the registry, under the
+`shards` kind:
+
+    {"shards": {"fred_download/2024-01-02": {"0-of-2": {"codes": ..., "rows": ..., "reported_at": ...}, ...}}}
+
+and the outputs are merged once all of them did. The merge prunes the
+reports of the older refreshes of the job.
+"""
+import os
+import typing
+import hashlib
+
+from utils.registry import Registry, get_now
+
+
+class Shard(typing.NamedTuple):
+    index: int = 0
+    count: int = 1
+
+    @property
+    def name(self) -> str:
+        return f'{self.index}-of-{self.count}'
+
+    def is_sharded(self) -> bool:
+        return self.count > 1
+
+    def select(self, keys: typing.List[str]) -> typing.List[str]:
+        """
+        The keys of the shard, in their order.
+        """
+        if not self.is_sharded():
+            return list(keys)
+
+        return [key for key in keys if get_key_shard(key, count=self.count) == self.index]
+
+
+def _get_weight(key: str, index: int) -> int:
+    # Not `hash`, it is salted by process.
+    return int.from_bytes(hashlib.md5(f'{key}/{index}'.encode()).digest()[:8], 'big')
+
+
+def get_key_shard(key: str, count: int) -> int:
+    return max(range(count), key=lambda index: _get_weight(key, index))
+
+
+def get_shard(index: typing.Optional[int] = None, count: typing.Optional[int] = None) -> Shard:
+    """
+    The shard of the parameters, of the environment without them.
+    """
+    index = int(os.getenv('SHARD_INDEX', '0')) if index is None else int(index)
+    count = int(os.getenv('SHARD_COUNT', '1')) if count is None else int(count)
+
+    if count < 1 or not 0 <= index < count:
+        raise Exception(f'Invalid shard: {index} of {count}')
+
+    return Shard(index=index, count=count)
+
+
+class ShardReports:
+
+    def __init__(self, registry: Registry, job: str, refresh: str):
+        self.registry: Registry = registry
+        # The shards of the same refresh of the job are merged together.
+        self.job: str = job
+        self.refresh: str = refresh
+        self.key: str = f'{job}/{refresh}'
+
+    def report(self, shard: Shard, output: typing.Dict[str, typing.Any]) -> None:
+        self.registry.update('shards', {self.key: {shard.name: {**output, 'reported_at': get_now()}}})
+
+    def get_outputs(self, count: int) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]:
+        """
+        The outputs of the `count` shards by index, None until all of them reported.
+        """
+        reports: typing.Dict[str, typing.Any] = self.registry.load(reload=True).get('shards', {}).get(self.key, {})
+        names: typing.List[str] = [Shard(index=index, count=count).name for index in range(count)]
+
+        if any(name not in reports for name in names):
+            return None
+
+        return [reports[name] for name in names]
+
+    def prune(self) -> None:
+        """
+        Remove the reports of the refreshes of the job before this one, a
+        later refresh may already be running.
+        """
+        keys: typing.List[str] = [
+            key for key in self.registry.load(reload=True).get('shards', {})
+            if key.startswith(f'{self.job}/') and key[len(self.job) + 1:] < self.refresh
+        ]
+        self.registry.remove('shards', keys)
@@ -6,6 +6,8 @@ import typing
 import calendar
 import requests
 
+from utils.replay import get_replay_mode
+
 
 class Slack:
     url = os.getenv('SLACK_URL', '')
@@ -14,7 +16,10 @@ class Slack:
         timestamp: str = str(calendar.timegm(time.gmtime()))
         self.title: str = f'{title} - {timestamp}'
 
-        if self.url is None or self.url == '':
+        # A replay doesn't post, it runs offline.
+        self.offline: bool = get_replay_mode() == 'replay'
+
+        if (self.url is None or self.url == '') and not self.offline:
             raise Exception('No Slack URL!')
 
     def __prepare_message_data(self, message: str) -> typing.Dict[str, typing.Any]:
@@ -40,6 +45,9 @@ class Slack:
         return slack_data
 
     def send(self, message: str):
+        if self.offline:
+            return
+
         data = self.__prepare_message_data(message=message)
         response = requests.post(
             self.url,
@@ -1,13 +1,153 @@
-from google.cloud import storage
+import os
+import fcntl
+import base64
+import shutil
+import typing
+import hashlib
+import tempfile
+import threading
+import contextlib
+import configparser
 
 
-class GoogleCloudStorage:
+def get_file_md5(file_path: str) -> str:
+    """
+    Return the base64 encoded MD5 of a file, the format of GCS `md5_hash`.
+    """
+    md5 = hashlib.md5()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            md5.update(chunk)
+
+    return base64.b64encode(md5.digest()).decode('ascii')
+
+
+class BaseStorage:
+    """
+    The interface every storage backend implements, blobs are addressed by
+    `/` separated names like `shared/data/quandl/raw.pickle`.
+
+    Uploads are skipped when the blob already has the same content. The
+    remote hashes come from one listing per folder, which is kept for the
+    lifetime of the storage instance.
+    """
+
+    def __init__(self) -> None:
+        self.remote_hashes: typing.Dict[str, typing.Dict[str, str]] = {}
+        self.bytes_uploaded: int = 0
+        self.bytes_skipped: int = 0
+        self.files_skipped: int = 0
+
+    def upload_a_file(
+        self,
+        source_file: str,
+        destination_blob: str,
+        skip_unchanged: bool = True,
+    ) -> bool:
+        """
+        Upload the file, return False when it was skipped as unchanged.
+        """
+        size: int = os.path.getsize(source_file)
+        local_hash: typing.Optional[str] = None
+
+        if skip_unchanged:
+            local_hash = get_file_md5(source_file)
+            if self.get_remote_hash(destination_blob) == local_hash:
+                self.bytes_skipped += size
+                self.files_skipped += 1
+                return False
+
+        self.put_file(source_file=source_file, destination_blob=destination_blob)
+        self.bytes_uploaded += size
+
+        folder: str = self.__get_folder(destination_blob)
+        if folder in self.remote_hashes:
+            self.remote_hashes[folder][destination_blob] = local_hash or get_file_md5(source_file)
+
+        return True
+
+    def get_remote_hash(self, blob_name: str) -> typing.Optional[str]:
+        folder: str = self.__get_folder(blob_name)
+
+        if folder not in self.remote_hashes:
+            self.remote_hashes[folder] = self.list_hashes(folder)
+
+        return self.remote_hashes[folder].get(blob_name)
+
+    def get_transfer_report(self) -> str:
+        return (
+            f'Uploaded {self.bytes_uploaded / 2 ** 20:.1f} MiB, '
+            f'skipped {self.files_skipped} unchanged files ({self.bytes_skipped / 2 ** 20:.1f} MiB saved)'
+        )
+
+    @staticmethod
+    def __get_folder(blob_name: str) -> str:
+        return blob_name.rsplit('/', 1)[0] + '/' if '/' in blob_name else ''
+
+    def put_file(
+        self,
+        source_file: str,
+        destination_blob: str,
+    ) -> None:
+        raise NotImplementedError
+
+    def list_hashes(self, prefix: str) -> typing.Dict[str, str]:
+        """
+        Return the MD5 (base64) of the blobs under the prefix, by blob name.
+        """
+        raise NotImplementedError
+
+    def download_a_file(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> None:
+        raise NotImplementedError
+
+    def is_file_exists(self, file_path: str) -> bool:
+        raise NotImplementedError
+
+    def list_files(self, prefix: str) -> typing.List[str]:
+        raise NotImplementedError
+
+    def delete_a_file(self, file_path: str) -> None:
+        raise NotImplementedError
+
+    def download_versioned(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> typing.Optional[str]:
+        """
+        Download the blob, return its generation (an opaque token), None
+        when the blob doesn't exist.
+        """
+        raise NotImplementedError
+
+    def put_file_if_generation(
+        self,
+        source_file: str,
+        destination_blob: str,
+        generation: typing.Optional[str],
+    ) -> bool:
+        """
+        Upload the file only if the blob is still at `generation` (None: if
+        it doesn't exist), return False when another writer changed it.
+        """
+        raise NotImplementedError
+
+
+class GoogleCloudStorage(BaseStorage):
 
     def __init__(self, bucket_name: str):
+        from google.cloud import storage
+
+        super().__init__()
         self.storage_client = storage.Client()
         self.bucket = self.storage_client.bucket(bucket_name)
 
-    def upload_a_file(
+    def put_file(
         self,
         source_file: str,
         destination_blob: str,
@@ -26,3 +166,283 @@ class GoogleCloudStorage:
     def is_file_exists(self, file_path: str) -> bool:
         blob = self.bucket.blob(file_path)
         return blob.exists()
+
+    def list_files(self, prefix: str) -> typing.List[str]:
+        return [blob.name for blob in self.storage_client.list_blobs(self.bucket, prefix=prefix)]
+
+    def list_hashes(self, prefix: str) -> typing.Dict[str, str]:
+        # Composite objects have no MD5, they are always uploaded.
+        blobs = self.storage_client.list_blobs(
+            self.bucket,
+            prefix=prefix,
+            fields='items(name,md5Hash),nextPageToken',
+        )
+
+        return {blob.name: blob.md5_hash for blob in blobs if blob.md5_hash}
+
+    def delete_a_file(self, file_path: str) -> None:
+        blob = self.bucket.blob(file_path)
+        blob.delete()
+
+    def download_versioned(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> typing.Optional[str]:
+        from google.api_core.exceptions import PreconditionFailed
+
+        blob = self.bucket.get_blob(source_blob_name)
+        if blob is None:
+            return None
+
+        try:
+            blob.download_to_filename(destination_file_name, if_generation_match=blob.generation)
+        except PreconditionFailed:
+            # Replaced between the metadata and the download.
+            return self.download_versioned(source_blob_name, destination_file_name)
+
+        return str(blob.generation)
+
+    def put_file_if_generation(
+        self,
+        source_file: str,
+        destination_blob: str,
+        generation: typing.Optional[str],
+    ) -> bool:
+        from google.api_core.exceptions import PreconditionFailed
+
+        blob = self.bucket.blob(destination_blob)
+        try:
+            # Generation 0 matches only a blob which doesn't exist.
+            blob.upload_from_filename(source_file, if_generation_match=int(generation) if generation else 0)
+        except PreconditionFailed:
+            return False
+
+        return True
+
+
+class LocalFileSystemStorage(BaseStorage):
+    """
+    Blobs are files under `{root}/{bucket_name}/`, e.g. on a volume shared by
+    the agents of one host. Uploads are written to a temporary file and moved
+    in place, so a reader never sees a partially written blob. The
+    conditional writes hold a lock file next to the blob, their generation
+    is the MD5 of the content.
+    """
+
+    def __init__(self, root: str, bucket_name: typing.Optional[str] = None):
+        super().__init__()
+        self.root: str = os.path.join(root, bucket_name) if bucket_name else root
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def get_path(self, blob_name: str) -> str:
+        return os.path.join(self.root, *blob_name.split('/'))
+
+    def put_file(
+        self,
+        source_file: str,
+        destination_blob: str,
+    ) -> None:
+        destination: str = self.get_path(destination_blob)
+        folder: str = os.path.dirname(destination)
+        os.makedirs(folder, exist_ok=True)
+
+        file_descriptor, temporary_file = tempfile.mkstemp(dir=folder, prefix='.upload-')
+        os.close(file_descriptor)
+        try:
+            shutil.copyfile(source_file, temporary_file)
+            os.replace(temporary_file, destination)
+        except BaseException:
+            os.remove(temporary_file)
+            raise
+
+    def download_a_file(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> None:
+        shutil.copyfile(self.get_path(source_blob_name), destination_file_name)
+
+    def is_file_exists(self, file_path: str) -> bool:
+        return os.path.isfile(self.get_path(file_path))
+
+    def list_files(self, prefix: str) -> typing.List[str]:
+        # Walk from the deepest folder of the prefix, then match the rest.
+        folder: str = self.get_path(prefix.rsplit('/', 1)[0]) if '/' in prefix else self.root
+        files: typing.List[str] = []
+
+        for path, _, file_names in os.walk(folder):
+            for file_name in file_names:
+                if file_name.startswith(('.upload-', '.lock-')):
+                    continue
+
+                blob_name: str = os.path.relpath(os.path.join(path, file_name), self.root).replace(os.sep, '/')
+                if blob_name.startswith(prefix):
+                    files.append(blob_name)
+
+        return sorted(files)
+
+    def delete_a_file(self, file_path: str) -> None:
+        os.remove(self.get_path(file_path))
+
+    def get_remote_hash(self, blob_name: str) -> typing.Optional[str]:
+        # Hashing the one local file is cheaper than hashing its whole folder.
+        path: str = self.get_path(blob_name)
+        return get_file_md5(path) if os.path.isfile(path) else None
+
+    def list_hashes(self, prefix: str) -> typing.Dict[str, str]:
+        return {blob_name: get_file_md5(self.get_path(blob_name)) for blob_name in self.list_files(prefix)}
+
+    def download_versioned(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> typing.Optional[str]:
+        with self.__lock(source_blob_name, exclusive=False):
+            if not self.is_file_exists(source_blob_name):
+                return None
+            self.download_a_file(source_blob_name, destination_file_name)
+
+        return get_file_md5(destination_file_name)
+
+    def put_file_if_generation(
+        self,
+        source_file: str,
+        destination_blob: str,
+        generation: typing.Optional[str],
+    ) -> bool:
+        with self.__lock(destination_blob, exclusive=True):
+            if self.get_remote_hash(destination_blob) != generation:
+                return False
+            self.put_file(source_file=source_file, destination_blob=destination_blob)
+
+        return True
+
+    @contextlib.contextmanager
+    def __lock(self, blob_name: str, exclusive: bool) -> typing.Iterator[None]:
+        folder, file_name = os.path.split(self.get_path(blob_name))
+        os.makedirs(folder, exist_ok=True)
+
+        with open(os.path.join(folder, f'.lock-{file_name}'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class InMemoryStorage(BaseStorage):
+    """
+    Blobs are kept in memory. The buckets are shared by every instance of the
+    process, so handlers created by different tasks see each other's uploads.
+    """
+    buckets: typing.Dict[str, typing.Dict[str, bytes]] = {}
+    lock = threading.Lock()
+
+    def __init__(self, bucket_name: typing.Optional[str] = None):
+        super().__init__()
+        with self.lock:
+            self.blobs: typing.Dict[str, bytes] = self.buckets.setdefault(bucket_name or '', {})
+
+    def put_file(
+        self,
+        source_file: str,
+        destination_blob: str,
+    ) -> None:
+        with open(source_file, 'rb') as f:
+            self.blobs[destination_blob] = f.read()
+
+    def download_a_file(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> None:
+        if source_blob_name not in self.blobs:
+            raise FileNotFoundError(source_blob_name)
+
+        with open(destination_file_name, 'wb') as f:
+            f.write(self.blobs[source_blob_name])
+
+    def is_file_exists(self, file_path: str) -> bool:
+        return file_path in self.blobs
+
+    def list_files(self, prefix: str) -> typing.List[str]:
+        return sorted(name for name in list(self.blobs) if name.startswith(prefix))
+
+    def delete_a_file(self, file_path: str) -> None:
+        del self.blobs[file_path]
+
+    def get_remote_hash(self, blob_name: str) -> typing.Optional[str]:
+        if blob_name not in self.blobs:
+            return None
+        return base64.b64encode(hashlib.md5(self.blobs[blob_name]).digest()).decode('ascii')
+
+    def list_hashes(self, prefix: str) -> typing.Dict[str, str]:
+        return {blob_name: self.get_remote_hash(blob_name) for blob_name in self.list_files(prefix)}
+
+    def download_versioned(
+        self,
+        source_blob_name: str,
+        destination_file_name: str,
+    ) -> typing.Optional[str]:
+        with self.lock:
+            if source_blob_name not in self.blobs:
+                return None
+            self.download_a_file(source_blob_name, destination_file_name)
+            return self.get_remote_hash(source_blob_name)
+
+    def put_file_if_generation(
+        self,
+        source_file: str,
+        destination_blob: str,
+        generation: typing.Optional[str],
+    ) -> bool:
+        with self.lock:
+            if self.get_remote_hash(destination_blob) != generation:
+                return False
+            self.put_file(source_file=source_file, destination_blob=destination_blob)
+
+        return True
+
+
+def get_storage(
+    bucket_name: typing.Optional[str],
+    config: typing.Optional[configparser.SectionProxy] = None,
+) -> BaseStorage:
+    """
+    Create the storage backend chosen by the `STORAGE_BACKEND` env variable,
+    or by `backend` in the `[storage]` section of the config: `gcs` (default),
+    `local` or `memory`. The local backend keeps its files under
+    `STORAGE_ROOT` (or `root` in the config). The storage is recorded or
+    replayed when `REPLAY_MODE` is set, see `utils.replay`.
+    """
+    from utils.replay import wrap_storage
+
+    return wrap_storage(
+        create_storage=lambda: _create_storage(bucket_name=bucket_name, config=config),
+        bucket_name=bucket_name,
+    )
+
+
+def _create_storage(
+    bucket_name: typing.Optional[str],
+    config: typing.Optional[configparser.SectionProxy],
+) -> BaseStorage:
+    backend: str = os.getenv('STORAGE_BACKEND', '') or (config.get('backend', '') if config else '') or 'gcs'
+
+    if backend == 'gcs':
+        assert bucket_name is not None
+        return GoogleCloudStorage(bucket_name=bucket_name)
+
+    if backend == 'local':
+        root: str = os.getenv('STORAGE_ROOT', '') or (config.get('root', '') if config else '')
+        if root == '':
+            raise Exception('STORAGE_ROOT is not set.')
+        return LocalFileSystemStorage(root=root, bucket_name=bucket_name)
+
+    if backend == 'memory':
+        return InMemoryStorage(bucket_name=bucket_name)
+
+    raise Exception(f'Unknown storage backend: {backend}')
@@ -0,0 +1,280 @@
+"""
+Schema-driven data quality checks, shared by every stage.
+
+`validate` goes once over each column of a DataFrame and returns a
+`QualityReport`: the schema violations are errors (missing columns, wrong
+dtypes, nulls where none are allowed), the rest are warnings (duplicated
+keys, unsorted dates, thin or stale groups) and statistics.
+"""
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+class Schema:
+
+    def __init__(
+        self,
+        name: str,
+        columns: typing.Dict[str, typing.Optional[str]],
+        nullable: typing.Optional[typing.List[str]] = None,
+        key_columns: typing.Optional[typing.List[str]] = None,
+        group_column: typing.Optional[str] = None,
+        date_column: typing.Optional[str] = None,
+        sorted_dates: bool = False,
+        min_rows_per_group: int = 1,
+        max_staleness_days: typing.Optional[int] = None,
+        allow_extra_columns: bool = False,
+    ) -> None:
+        """
+        `columns` maps the required columns to their dtype (e.g. `float64`),
+        None for any dtype. Only the `nullable` columns may have nulls.
+        The duplicates are counted on `key_columns`; the dates by group
+        (e.g. by ticker) for the coverage.
+        """
+        self.name: str = name
+        self.columns: typing.Dict[str, typing.Optional[str]] = columns
+        self.nullable: typing.List[str] = nullable or []
+        self.key_columns: typing.Optional[typing.List[str]] = key_columns
+        self.group_column: typing.Optional[str] = group_column
+        self.date_column: typing.Optional[str] = date_column
+        self.sorted_dates: bool = sorted_dates
+        self.min_rows_per_group: int = min_rows_per_group
+        self.max_staleness_days: typing.Optional[int] = max_staleness_days
+        self.allow_extra_columns: bool = allow_extra_columns
+
+
+class QualityReport:
+
+    def __init__(self, schema: Schema, rows: int) -> None:
+        self.schema: Schema = schema
+        self.rows: int = rows
+        self.errors: typing.List[str] = []
+        self.warnings: typing.List[str] = []
+        self.null_counts: typing.Dict[str, int] = {}
+        self.groups: int = 0
+        self.min_date: typing.Optional[pd.Timestamp] = None
+        self.max_date: typing.Optional[pd.Timestamp] = None
+
+    @property
+    def is_valid(self) -> bool:
+        return not self.errors
+
+    def summary(self, limit: int = 5) -> str:
+        """
+        One line report, with at most `limit` errors and warnings each.
+        """
+        summary: str = f'{self.schema.name}: {self.rows} rows'
+
+        if self.groups:
+            summary += f', {self.groups} {self.schema.group_column}'
+        if self.min_date is not None and self.max_date is not None:
+            summary += f', {self.min_date:%Y-%m-%d} to {self.max_date:%Y-%m-%d}'
+
+        summary += f' - {len(self.errors)} errors, {len(self.warnings)} warnings'
+
+        for title, messages in (('Errors', self.errors), ('Warnings', self.warnings)):
+            if messages:
+                more: str = f' (+{len(messages) - limit} more)' if len(messages) > limit else ''
+                summary += f' - {title}: ' + '; '.join(messages[:limit]) + more
+
+        return summary
+
+    def raise_for_errors(self) -> None:
+        if self.errors:
+            raise Exception(f'Invalid data: {self.summary()}')
+
+
+def validate(df: pd.DataFrame, schema: Schema) -> QualityReport:
+    report = QualityReport(schema=schema, rows=len(df))
+
+    # Columns.
+    missing_columns: typing.List[str] = [column for column in schema.columns if column not in df.columns]
+    if missing_columns:
+        report.errors.append(f'missing columns {missing_columns}')
+
+    extra_columns: typing.List[str] = [column for column in df.columns if column not in schema.columns]
+    if extra_columns and not schema.allow_extra_columns:
+        report.errors.append(f'unexpected columns {extra_columns}')
+
+    # Dtypes and nulls, one column at a time: no copy of the whole frame.
+    for column, expected_dtype in schema.columns.items():
+        if column not in df.columns:
+            continue
+
+        values: pd.Series = df[column]
+        if expected_dtype is not None and str(values.dtype) != expected_dtype:
+            report.errors.append(f'{column} is {values.dtype}, expected {expected_dtype}')
+
+        null_count: int = int(values.isna().sum())
+        report.null_counts[column] = null_count
+        if null_count and column not in schema.nullable:
+            report.errors.append(f'{null_count} nulls in {column}')
+
+    if schema.key_columns and all(column in df.columns for column in schema.key_columns):
+        duplicates: int = int(df.duplicated(subset=schema.key_columns).sum())
+        if duplicates:
+            report.warnings.append(f'{duplicates} duplicated {"/".join(schema.key_columns)}')
+
+    if schema.date_column in df.columns and len(df) > 0:
+        _check_dates(df=df, schema=schema, report=report)
+
+    return report
+
+
+def coerce_dtypes(df: pd.DataFrame, schema: Schema) -> pd.DataFrame:
+    """
+    Cast the columns to the dtypes of the schema, e.g. an int volume to
+    float, the values which are not numbers or dates become nulls.
+    """
+    columns: typing.Dict[str, pd.Series] = {}
+
+    for column, expected_dtype in schema.columns.items():
+        if column not in df.columns or expected_dtype is None or str(df[column].dtype) == expected_dtype:
+            continue
+
+        if expected_dtype.startswith('datetime64'):
+            columns[column] = pd.to_datetime(df[column], errors='coerce')
+        elif np.issubdtype(np.dtype(expected_dtype), np.number):
+            columns[column] = pd.to_numeric(df[column], errors='coerce').astype(expected_dtype)
+        else:
+            columns[column] = df[column].astype(expected_dtype)
+
+    return df.assign(**columns) if columns else df
+
+
+def _check_dates(df: pd.DataFrame, schema: Schema, report: QualityReport) -> None:
+    """
+    The date range, sorting and coverage of each group, vectorized over the
+    rows sorted by group.
+    """
+    assert schema.date_column is not None
+    dates: np.ndarray = df[schema.date_column].to_numpy()
+
+    if schema.group_column in df.columns:
+        codes, groups = pd.factorize(df[schema.group_column], sort=True)
+    else:
+        codes, groups = np.zeros(len(df), dtype=np.intp), pd.Index(['all'])
+
+    order: np.ndarray = np.argsort(codes, kind='stable')
+    codes, dates = codes[order], dates[order]
+    starts: np.ndarray = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    valid: np.ndarray = codes[starts] >= 0
+
+    group_names: np.ndarray = np.asarray(groups)[codes[starts][valid]]
+    group_rows: np.ndarray = np.diff(np.r_[starts, len(codes)])[valid]
+    group_min: np.ndarray = np.minimum.reduceat(dates, starts)[valid]
+    group_max: np.ndarray = np.maximum.reduceat(dates, starts)[valid]
+
+    report.groups = len(group_names) if schema.group_column in df.columns else 0
+    report.min_date = pd.Timestamp(group_min.min())
+    report.max_date = pd.Timestamp(group_max.max())
+
+    if schema.sorted_dates:
+        unsorted: np.ndarray = np.unique(codes[1:][(codes[1:] == codes[:-1]) & (dates[1:] < dates[:-1])])
+        if len(unsorted):
+            report.warnings.append(f'dates not sorted for {list(np.asarray(groups)[unsorted[unsorted >= 0]])}')
+
+    thin: np.ndarray = group_names[group_rows < schema.min_rows_per_group]
+    if len(thin):
+        report.warnings.append(f'less than {schema.min_rows_per_group} rows for {list(thin)}')
+
+    if schema.max_staleness_days is not None:
+        stale_before: np.datetime64 = group_max.max() - np.timedelta64(schema.max_staleness_days, 'D')
+        stale: np.ndarray = group_names[group_max < stale_before]
+        if len(stale):
+            report.warnings.append(f'no data in the last {schema.max_staleness_days} days for {list(stale)}')
+
+
+QUANDL_RAW_SCHEMA = Schema(
+    name='quandl_raw',
+    columns={
+        'name': 'object',
+        'quandl_code': 'object',
+        'exchange': 'object',
+        'symbol': 'object',
+        'depth': None,
+        'method': 'object',
+        'date': 'datetime64[ns]',
+        'open': 'float64',
+        'high': 'float64',
+        'low': 'float64',
+        'settle': 'float64',
+        'volume': 'float64',
+        'prev_day_open_interest': 'float64',
+        'front_contract': 'object',
+    },
+    nullable=['open', 'high', 'low', 'volume', 'prev_day_open_interest'],
+    key_columns=['quandl_code', 'date'],
+    group_column='quandl_code',
+    date_column='date',
+    max_staleness_days=10,
+)
+
+QUANDL_PROCESSED_SCHEMA = Schema(
+    name='quandl_processed',
+    columns={
+        'exchange': 'object',
+        'symbol': 'object',
+        'depth': None,
+        'method': 'object',
+        'date': 'datetime64[ns]',
+        'open': 'float64',
+        'high': 'float64',
+        'low': 'float64',
+        'settle': 'float64',
+        'volume': 'float64',
+        'prev_day_open_interest': 'float64',
+        'year': None,
+        'ticker': 'object',
+    },
+    key_columns=['ticker', 'date'],
+    group_column='ticker',
+    date_column='date',
+    max_staleness_days=10,
+)
+
+FRED_RAW_SCHEMA = Schema(
+    name='fred_raw',
+    columns={
+        'realtime_start': 'datetime64[ns]',
+        'date': 'datetime64[ns]',
+        'value': 'object',
+        'code': 'object',
+    },
+    nullable=['value'],
+    key_columns=['code', 'date', 'realtime_start'],
+    group_column='code',
+    date_column='date',
+)
+
+FRED_INFO_COLUMNS: typing.List[str] = [
+    'id',
+    'realtime_start',
+    'realtime_end',
+    'title',
+    'observation_start',
+    'observation_end',
+    'frequency',
+    'frequency_short',
+    'units',
+    'units_short',
+    'seasonal_adjustment',
+    'seasonal_adjustment_short',
+    'last_updated',
+    'popularity',
+    'notes',
+]
+
+FRED_INFO_SCHEMA = Schema(
+    name='fred_info',
+    columns={column: 'object' for column in FRED_INFO_COLUMNS},
+    nullable=[column for column in FRED_INFO_COLUMNS if column != 'id'],
+    key_columns=['id'],
+)
+
+SCHEMAS: typing.Dict[str, Schema] = {
+    schema.name: schema
+    for schema in [QUANDL_RAW_SCHEMA, QUANDL_PROCESSED_SCHEMA, FRED_RAW_SCHEMA, FRED_INFO_SCHEMA]
+}